@@ -0,0 +1,164 @@
+"""
+Compares the batch spec extraction of framework.wrapper.measure against the per design scipy path it replaced
+(a spline + brentq over the whole sweep for every crossing, a quadratic interp1d for the phase). The responses are
+synthetic two pole opamps on the ac sweep of the two stage testbenches (dec 10 1 10G), so no simulator is needed.
+Same for the settling time (a spline over the whole transient + brentq) and the DTSA sampling (quadratic interp1d),
+on synthetic second order step responses of about 10k time points.
+
+run from the root of the repository: python benchmarks/measure_benchmark.py
+"""
+import timeit
+
+import numpy as np
+import scipy.interpolate as interp
+import scipy.optimize as sciopt
+
+import sys
+sys.path.append('./')
+from framework.wrapper import measure
+
+n_designs = (1, 100, 1000)
+repeat = 5
+
+
+def two_stage_responses(n, seed=0):
+    """
+    :return: freq (n_points), vout (n x n_points) of two pole amplifiers with a right half plane zero
+    """
+    rng = np.random.RandomState(seed)
+    freq = np.logspace(0, 10, 101)
+    s = 2j * np.pi * freq
+    gain = 10 ** rng.uniform(1.5, 4, size=(n, 1))
+    p1 = 10 ** rng.uniform(2, 5, size=(n, 1))
+    p2 = 10 ** rng.uniform(6, 9, size=(n, 1))
+    z = 10 ** rng.uniform(8, 10, size=(n, 1))
+    vout = gain * (1 - s / (2 * np.pi * z)) / ((1 + s / (2 * np.pi * p1)) * (1 + s / (2 * np.pi * p2)))
+    return freq, vout
+
+
+def best_crossing(xvec, yvec, val):
+    interp_fun = interp.InterpolatedUnivariateSpline(xvec, yvec)
+
+    def fzero(x):
+        return interp_fun(x) - val
+
+    xstart, xstop = xvec[0], xvec[-1]
+    try:
+        return sciopt.brentq(fzero, xstart, xstop)
+    except ValueError:
+        if abs(fzero(xstart)) < abs(fzero(xstop)):
+            return xstart
+        return xstop
+
+
+def scipy_specs(freq, vout):
+    """
+    the old per design path: find_dc_gain, find_ugbw and find_phm (which searched the crossing again) and find_bw
+    """
+    specs = dict(gain=[], ugbw=[], phm=[], bw=[])
+    for row in vout:
+        gain = np.abs(row)
+        phase = np.rad2deg(np.unwrap(np.angle(row)))
+        specs['gain'].append(gain[0])
+        specs['ugbw'].append(best_crossing(freq, gain, 1))
+        phase_fun = interp.interp1d(freq, phase, kind='quadratic')
+        ugbw = best_crossing(freq, gain, 1)
+        phase_ugbw = phase_fun(ugbw)
+        specs['phm'].append(-180 + phase_ugbw if phase_ugbw > 0 else 180 + phase_ugbw)
+        specs['bw'].append(best_crossing(freq, gain, gain[0] / np.sqrt(2)))
+    return {key: np.array(value) for key, value in specs.items()}
+
+
+def step_responses(n, n_samples=10000, seed=0):
+    """
+    :return: t (n x n_samples) on a slightly different grid per design, vout and vin (n x n_samples) of unity gain
+    buffers with a 20 mV input step, underdamped with different speeds and dampings
+    """
+    rng = np.random.RandomState(seed)
+    t = np.sort(rng.uniform(0, 1e-6, size=(n, n_samples)), axis=1)
+    t[:, 0] = 0
+    wn = 2 * np.pi * 10 ** rng.uniform(7, 8.5, size=(n, 1))
+    zeta = rng.uniform(0.3, 0.95, size=(n, 1))
+    wd = wn * np.sqrt(1 - zeta ** 2)
+    step = 1 - np.exp(-zeta * wn * t) * (np.cos(wd * t) + zeta * wn / wd * np.sin(wd * t))
+    vin = 0.6 + 20e-3 * (t > 0)
+    vout = 0.6 + 20e-3 * step
+    return t, vout, vin
+
+
+def scipy_transient(t, vout, vin, fbck=1.0, tot_err=0.01):
+    """
+    the old per design path: EvaluationCore.get_tset and the DTSA sampling at two instants
+    """
+    tset, samples = [], []
+    for t_row, vout_row, vin_row in zip(t, vout, vin):
+        ref_value = 1/fbck * vin_row
+        y = (vout_row-vout_row[0])/(ref_value[-1]-ref_value[0])
+        last_idx = np.where(y < 1.0 - tot_err)[0][-1]
+        last_max_vec = np.where(y > 1.0 + tot_err)[0]
+        if last_max_vec.size > 0 and last_max_vec[-1] > last_idx:
+            last_idx = last_max_vec[-1]
+            last_val = 1.0 + tot_err
+        else:
+            last_val = 1.0 - tot_err
+        if last_idx == t_row.size - 1:
+            tset.append(t_row[-1])
+        else:
+            f = interp.InterpolatedUnivariateSpline(t_row, y - last_val)
+            tset.append(sciopt.brentq(f, t_row[last_idx], t_row[last_idx + 1]))
+        vout_func = interp.interp1d(t_row, vout_row, kind='quadratic')
+        samples.append([vout_func(sample_time) for sample_time in sample_times])
+    return dict(tset=np.array(tset), sample=np.array(samples))
+
+
+def batch_transient(t, vout, vin, refine=False, fbck=1.0, tot_err=0.01):
+    return dict(tset=measure.settling_time(t, vout, vin, fbck, tot_err=tot_err, refine=refine),
+                sample=measure.sample_at(t, vout, sample_times, refine=refine))
+
+
+sample_times = (7e-9, 9e-9)
+
+
+def batch_specs(freq, vout, refine=False):
+    specs = measure.ac_specs(freq, vout, refine=refine)
+    specs['bw'] = measure.bandwidth_3db(freq, vout, refine=refine)
+    return specs
+
+
+def max_error(specs, reference):
+    """
+    :return: dict(spec, largest relative error, absolute in degrees for the phase margin)
+    """
+    errors = dict()
+    for key, value in reference.items():
+        diff = np.abs(specs[key] - value)
+        errors[key] = np.max(diff if key == 'phm' else diff / np.abs(value))
+    return errors
+
+
+def compare(n, name, fn, baseline, reference, *args):
+    seconds = timeit.timeit(lambda: fn(*args), number=repeat) / repeat
+    errors = max_error(fn(*args), reference)
+    print('%-8d %-14s %12.3f %9.1fx   %s' % (n, name, seconds * 1e3, baseline / seconds,
+                                           ' '.join('%s=%.1e' % item for item in sorted(errors.items()))))
+
+
+if __name__ == '__main__':
+    print('%-8s %-14s %12s %10s   %s' % ('designs', 'path', 'time [ms]', 'speedup', 'max error (relative, phm in deg)'))
+    for n in n_designs:
+        freq, vout = two_stage_responses(n)
+        reference = scipy_specs(freq, vout)
+        baseline = timeit.timeit(lambda: scipy_specs(freq, vout), number=repeat) / repeat
+        print('%-8d %-14s %12.3f %10s' % (n, 'scipy', baseline * 1e3, '1.0x'))
+        for name, refine in (('batch', False), ('batch+refine', True)):
+            compare(n, name, batch_specs, baseline, reference, freq, vout, refine)
+
+    print()
+    print('%-8s %-14s %12s %10s   %s' % ('designs', 'transient', 'time [ms]', 'speedup', 'max relative error'))
+    for n in n_designs[:2]:
+        t, vout, vin = step_responses(n)
+        reference = scipy_transient(t, vout, vin)
+        baseline = timeit.timeit(lambda: scipy_transient(t, vout, vin), number=repeat) / repeat
+        print('%-8d %-14s %12.3f %10s' % (n, 'scipy', baseline * 1e3, '1.0x'))
+        for name, refine in (('batch', False), ('batch+refine', True)):
+            compare(n, name, batch_transient, baseline, reference, t, vout, vin, refine)
@@ -0,0 +1,46 @@
+"""
+Compares the ascii wrdata outputs parsed with np.genfromtxt against binary rawfiles read through memory maps.
+Every testbench is simulated once per output format with the default parameters of its netlist, then the
+parse_output method of the wrapper is timed on the files that were written.
+
+run from the root of the repository: python benchmarks/rawfile_benchmark.py
+"""
+import os
+import timeit
+
+import sys
+sys.path.append('./')
+from framework.wrapper.ngspice_wrapper import CsAmpClass
+from framework.wrapper.TwoStageComplete import TwoStageOpenLoop, TwoStageTransient
+from framework.wrapper.DTSA import DTSAOverdriveRecovery
+
+decks = [
+    ('cs_amp', CsAmpClass, './framework/netlist/cs_amp.cir'),
+    ('two_stage_ol', TwoStageOpenLoop, './framework/netlist/two_stage_full/two_stage_ol.cir'),
+    ('two_stage_tran', TwoStageTransient, './framework/netlist/two_stage_full/two_stage_tran.cir'),
+    ('dtsa', DTSAOverdriveRecovery, './framework/netlist/dtsa.cir'),
+]
+repeat = 20
+
+
+def file_size(env, design_folder):
+    return sum(os.path.getsize(os.path.join(design_folder, env.output_file(fname))) for fname in env.output_vectors)
+
+
+if __name__ == '__main__':
+    print('%-16s %-6s %12s %12s' % ('deck', 'format', 'size [kB]', 'parse [ms]'))
+    for name, env_cls, netlist in decks:
+        timings = {}
+        for output_format in ('csv', 'raw'):
+            with env_cls(num_process=1, design_netlist=netlist, output_format=output_format) as env:
+                _, _, info = env.run([{}])[0]
+                design_folder = env.get_design_folder({})
+                if info:
+                    print('%-16s %-6s simulation failed' % (name, output_format))
+                    continue
+                seconds = timeit.timeit(lambda: env.parse_output(design_folder), number=repeat) / repeat
+                timings[output_format] = seconds
+                print('%-16s %-6s %12.1f %12.3f' % (name, output_format, file_size(env, design_folder) / 1e3,
+                                                   seconds * 1e3))
+        if len(timings) == 2:
+            print('%-16s speedup %.1fx' % (name, timings['csv'] / timings['raw']))
@@ -9,56 +9,93 @@ import scipy.optimize as sciopt
 import random
 import time
 import pprint
+import math
 
 debug = False
 
 import sys
 sys.path.append('./')
 from framework.wrapper.ngspice_wrapper import NgSpiceWrapper
+from framework.wrapper import measure
+from framework.wrapper.evaluation_core import EvaluationCoreBase
 
 class DTSAOverdriveRecovery(NgSpiceWrapper):
 
-    def translate_result(self, output_path):
+    # needs measure_params t_prev and t_sample, the two sampling instants
+    MEASUREMENTS = {
+        'tran.csv': (
+            (None, 'let vout = {0}'),
+            (None, 'let ivdd = {2}'),
+            ('vsample_prev', 'meas tran vsample_prev find vout at={t_prev}'),
+            ('vsample', 'meas tran vsample find vout at={t_sample}'),
+            # time average, measure.time_average in the waveform path
+            ('iavg', 'meas tran iavg avg ivdd'),
+        ),
+    }
+
+    # the output and the supply current, the input is not used. The whole transient is, the supply current is
+    # averaged over all of it.
+    OUTPUTS = {
+        'tran.csv': dict(vectors=(0, 2)),
+    }
+
+    def translate_measurements(self, output_path):
         """
 
         :param output_path:
         :return
             result: dict(spec_kwds, spec_value)
         """
+        tran = self.load_measurements(output_path, 'tran.csv')
+        spec = dict(
+            vsample_prev=tran['vsample_prev'],
+            vsample=tran['vsample'],
+            iavg=tran['iavg']
+        )
 
-        # use parse output here
-        time, vout, vin, ibias = self.parse_output(output_path)
+        return spec
+
+    def translate_result(self, output_path):
+        """
 
-        raw_data = dict(
+        :param output_path:
+        :return
+            result: dict(spec_kwds, spec_value), the specs and the waveforms they were computed from
+        """
+
+        # use parse output here
+        time, vout, ibias = self.parse_output(output_path)
+        # vout at the sampling instants
+        times = (self.measure_params['t_prev'], self.measure_params['t_sample'])
+        vsample_prev, vsample = measure.sample_at(time, vout, times)[0]
+
+        spec = dict(
+            vsample_prev=vsample_prev,
+            vsample=vsample,
+            iavg=measure.time_average(time, ibias)[0],
             time=time,
             vout=vout,
-            vin=vin,
             ibias=ibias
         )
 
-        return raw_data
+        return spec
 
     def parse_output(self, output_path):
 
-        tran_fname = os.path.join(output_path, 'tran.csv')
+        tran_outputs = self.load_vectors(output_path, 'tran.csv')
+        t = tran_outputs.scale
+        vout = tran_outputs[0]
+        ivdd = tran_outputs[2]
 
-        if not os.path.isfile(tran_fname):
-            print("tran file doesn't exist: %s" % output_path)
+        return t, vout, ivdd
 
-        tran_raw_outputs = np.genfromtxt(tran_fname, skip_header=1)
-        t = tran_raw_outputs[:, 0]
-        vout = tran_raw_outputs[:, 1]
-        vin = tran_raw_outputs[:, 3]
-        ivdd = tran_raw_outputs[:, 5]
+class EvaluationCore(EvaluationCoreBase):
 
-        return t, vout, vin, ivdd
-
-class EvaluationCore(object):
+    result_keys = ('cost', 'vsample_prev', 'vsample', 'iavg')
 
     def __init__(self, cir_yaml):
-        import yaml
-        with open(cir_yaml, 'r') as f:
-            yaml_data = yaml.load(f)
+        super().__init__(cir_yaml)
+        yaml_data = self.yaml_data
 
         # specs
         specs = yaml_data['target_specs']
@@ -69,10 +106,13 @@ class EvaluationCore(object):
         self.cff        = specs['cff']
         self.bias_max   = 1e-3
 
-        num_process = yaml_data['num_process']
         dsn_netlist = yaml_data['dsn_netlist']
 
-        self.env = DTSAOverdriveRecovery(num_process=num_process, design_netlist=dsn_netlist)
+        t_prev, t_sample = self.sample_times()
+        self.env = self.make_env(DTSAOverdriveRecovery, dsn_netlist,
+                                 measure_params=dict(t_prev=t_prev, t_sample=t_sample),
+                                 tran_stop=self.transient_stop())
+        self.testbenches['tran'] = self.env
 
         params = yaml_data['params']
         self.param_vec_dict = {}
@@ -90,46 +130,67 @@ class EvaluationCore(object):
         :return:
         """
 
-        eval_start_time = time.time()
         if verbose:
             print("state_before_rounding:{}".format(kwds))
 
-        param_dict = kwds.copy()
-        # snap to the proper grid
-        for key, value in param_dict.items():
+        design = [kwds[key] for key in self.param_vec_dict.keys()]
+        results = self.cost_fun_batch([design], verbose=verbose)
+        return results['cost'][0]
+
+    def decode_batch(self, designs):
+        """
+        snaps the parameter values of all designs to the grid of the yaml file
+        :param designs: (n_designs x n_params) parameter values in the order of the params of the yaml file
+        :return: list of states, dict(param_kwds, param_value)
+        """
+        designs = np.asarray(designs, dtype=float).reshape(-1, len(self.param_vec_dict))
+        columns = []
+        for i, param_vec in enumerate(self.param_vec_dict.values()):
             # get the last index that is less than the value of that param. it can be the upper bound.
             # if there is not value in the vec that is less than the value of the param:
             # the value should be clipped to the lower bound
-            nearest_idx = np.where(self.param_vec_dict[key] <= int(value))[0][-1]
-            if nearest_idx != None:
-                param_dict[key] = self.param_vec_dict[key][nearest_idx]
-            else:
-                param_dict[key] = self.param_vec_dict[key][0]
-
+            nearest_idx = np.searchsorted(param_vec, designs[:, i].astype(int), side='right') - 1
+            columns.append(param_vec[np.clip(nearest_idx, 0, None)])
+
+        states = []
+        for values in zip(*columns):
+            param_dict = dict(zip(self.param_vec_dict.keys(), values))
+            param_dict['Tper'] = self.Tper
+            param_dict['cff'] = self.cff
+            param_dict['vi_final'] = self.vin_min
+            states.append(param_dict)
+        return states
+
+    def sample_times(self):
+        """
+        :return: the instants the output is sampled at, one setup time before the ends of the 4th and 5th period
+        """
+        return 3.5*self.Tper-self.tsetup, 4.5*self.Tper-self.tsetup
 
-        param_dict['Tper'] = self.Tper
-        param_dict['cff'] = self.cff
-        param_dict['vi_final'] = self.vin_min
-        state = [param_dict]
-        results = self.env.run(state, verbose=verbose)
+    def transient_stop(self):
+        """
+        stop time of the transient from the tran_stop policy of the yaml file: guard after the second sampling
+        instant, rounded up to a whole clock period so the average supply current still covers complete periods
+        :return: stop time in seconds, None to simulate the whole transient of the netlist
+        """
+        policy = self.yaml_data.get('tran_stop')
+        if not policy:
+            return None
+        periods = (self.sample_times()[1] + policy.get('guard', 0.0)) / self.Tper
+        # the small tolerance keeps round off from adding a period
+        return math.ceil(periods - 1e-9) * self.Tper
 
-        t = results[0][1]['time']
-        vout = results[0][1]['vout']
-        vin = results[0][1]['vin']
-        ibias = results[0][1]['ibias']
+    def evaluate_design(self, results, verbose=False):
 
-        if verbose:
+        tran = results['tran']
+        if verbose and 'time' in tran:
             import matplotlib.pyplot as plt
-            plt.plot(t, vout)
-            plt.plot(t, vin)
+            plt.plot(tran['time'], tran['vout'])
             plt.vlines(3.5*self.Tper, -1.2, 1.2, colors='r')
             plt.vlines(4.5*self.Tper, -1.2, 1.2, colors='b')
-        # power
-        iavg = np.mean(ibias)
-        # calculate vout at the correct sampling time
-        vout_func = interp.interp1d(t, vout, kind='quadratic')
-        vsample_prev = vout_func(3.5*self.Tper-self.tsetup)
-        vsample = vout_func(4.5*self.Tper-self.tsetup)
+        iavg = tran['iavg']
+        vsample_prev = tran['vsample_prev']
+        vsample = tran['vsample']
 
         if verbose:
             print('vsample=%f vs. vout_min=%f' %(vsample, self.vout_min))
@@ -143,9 +204,7 @@ class EvaluationCore(object):
 
         cost += abs(iavg/self.bias_max)/10
 
-        eval_end_time = time.time()
-        # print("eval_time    %s sec" %(eval_end_time-eval_start_time))
-        return cost
+        return dict(cost=cost, vsample_prev=vsample_prev, vsample=vsample, iavg=iavg)
 
 if __name__ == '__main__':
     eval_core = EvaluationCore('./framework/yaml_files/dtsa.yaml')
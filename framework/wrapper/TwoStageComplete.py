@@ -15,9 +15,63 @@ debug = False
 import sys
 sys.path.append('./')
 from framework.wrapper.ngspice_wrapper import NgSpiceWrapper
+from framework.wrapper import measure
+from framework.wrapper.evaluation_core import EvaluationCoreBase
 
 class TwoStageOpenLoop(NgSpiceWrapper):
 
+    MEASUREMENTS = {
+        'ac.csv': (
+            (None, 'let vout_mag = mag({0})'),
+            # cph follows the units variable, the phase is converted to degrees explicitly
+            (None, 'unset units'),
+            (None, 'let vout_phase = cph({0}) * 180 / pi'),
+            ('gain', 'let gain = vout_mag[0]'),
+            ('gain_last', 'let gain_last = vout_mag[length(vout_mag)-1]'),
+            ('phase_first', 'let phase_first = vout_phase[0]'),
+            ('phase_last', 'let phase_last = vout_phase[length(vout_phase)-1]'),
+            ('freq_first', 'let freq_first = real(frequency[0])'),
+            ('freq_last', 'let freq_last = real(frequency[length(frequency)-1])'),
+            ('ugbw', 'meas ac ugbw when vout_mag=1 cross=1'),
+            ('phase_ugbw', 'meas ac phase_ugbw find vout_phase when vout_mag=1 cross=1'),
+        ),
+        'dc.csv': (
+            ('ibias_dc', 'let ibias_dc = -{0}[0]'),
+        ),
+    }
+
+    def translate_measurements(self, output_path):
+        """
+
+        :param output_path:
+        :return
+            result: dict(spec_kwds, spec_value)
+        """
+        ac = self.load_measurements(output_path, 'ac.csv')
+        dc = self.load_measurements(output_path, 'dc.csv')
+        gain = ac['gain']
+        ugbw, phase = ac.get('ugbw'), ac.get('phase_ugbw')
+        if ugbw is None or phase is None:
+            # no unity gain crossing in the sweep, same fallback as measure.crossing
+            if abs(gain - 1) < abs(ac['gain_last'] - 1):
+                ugbw, phase = ac['freq_first'], ac['phase_first']
+            else:
+                ugbw, phase = ac['freq_last'], ac['phase_last']
+
+        # NaN if the phase does not start at or below 0 degrees, like measure.phase_margin
+        phm = np.nan
+        if ac['phase_first'] <= 0:
+            phm = -180 + phase if phase > 0 else 180 + phase
+
+        spec = dict(
+            ugbw=ugbw,
+            gain=gain,
+            phm=phm,
+            Ibias=dc['ibias_dc']
+        )
+
+        return spec
+
     def translate_result(self, output_path):
         """
 
@@ -28,9 +82,11 @@ class TwoStageOpenLoop(NgSpiceWrapper):
 
         # use parse output here
         freq, vout,  ibias = self.parse_output(output_path)
-        gain = self.find_dc_gain(vout)
-        ugbw = self.find_ugbw(freq, vout)
-        phm = self.find_phm(freq, vout)
+        # gain, ugbw and phase margin share one crossing search
+        ac_specs = measure.ac_specs(freq, vout)
+        gain = ac_specs['gain'][0]
+        ugbw = ac_specs['ugbw'][0]
+        phm = ac_specs['phm'][0]
 
 
         spec = dict(
@@ -44,62 +100,34 @@ class TwoStageOpenLoop(NgSpiceWrapper):
 
     def parse_output(self, output_path):
 
-        ac_fname = os.path.join(output_path, 'ac.csv')
-        dc_fname = os.path.join(output_path, 'dc.csv')
-
-        if not os.path.isfile(ac_fname) or not os.path.isfile(dc_fname):
-            print("ac/dc file doesn't exist: %s" % output_path)
-
-        ac_raw_outputs = np.genfromtxt(ac_fname, skip_header=1)
-        dc_raw_outputs = np.genfromtxt(dc_fname, skip_header=1)
-        freq = ac_raw_outputs[:, 0]
-        vout_real = ac_raw_outputs[:, 1]
-        vout_imag = ac_raw_outputs[:, 2]
-        vout = vout_real + 1j*vout_imag
-        ibias = -dc_raw_outputs[1]
+        ac_outputs = self.load_vectors(output_path, 'ac.csv')
+        dc_outputs = self.load_vectors(output_path, 'dc.csv')
+        freq = ac_outputs.scale
+        vout = ac_outputs[0]
+        ibias = -dc_outputs[0][0]
 
         return freq, vout, ibias
 
     def find_dc_gain (self, vout):
-        return np.abs(vout)[0]
+        return measure.dc_gain(vout)[0]
 
     def find_ugbw(self, freq, vout):
-        gain = np.abs(vout)
-        return self._get_best_crossing(freq, gain, val=1)
+        return measure.unity_gain_frequency(freq, vout)[0]
 
     def find_phm(self, freq, vout):
-        gain = np.abs(vout)
-        phase = np.angle(vout, deg=False)
-        phase = np.unwrap(phase) # unwrap the discontinuity
-        phase = np.rad2deg(phase) # convert to degrees
-
-        phase_fun = interp.interp1d(freq, phase, kind='quadratic')
-        ugbw = self._get_best_crossing(freq, gain, val=1)
-        if phase[0] <= 0:
-            if phase_fun(ugbw) > 0:
-                return -180+phase_fun(ugbw)
-            else:
-                return 180 + phase_fun(ugbw)
-        else:
-            print ('stuck in else statement')
-
-
-    def _get_best_crossing(cls, xvec, yvec, val):
-        interp_fun = interp.InterpolatedUnivariateSpline(xvec, yvec)
+        # NaN if the phase does not start at or below 0 degrees
+        return measure.phase_margin(freq, vout)[0]
 
-        def fzero(x):
-            return interp_fun(x) - val
+class TwoStageCommonModeGain(NgSpiceWrapper):
 
-        xstart, xstop = xvec[0], xvec[-1]
-        try:
-            return sciopt.brentq(fzero, xstart, xstop)
-        except ValueError:
-            # avoid no solution
-            if abs(fzero(xstart)) < abs(fzero(xstop)):
-                return xstart
-            return xstop
+    MEASUREMENTS = {
+        'cm.csv': (
+            ('cm_gain', 'let cm_gain = mag({0}[0])'),
+        ),
+    }
 
-class TwoStageCommonModeGain(NgSpiceWrapper):
+    def translate_measurements(self, output_path):
+        return dict(cm_gain=self.load_measurements(output_path, 'cm.csv')['cm_gain'])
 
     def translate_result(self, output_path):
         """
@@ -122,24 +150,26 @@ class TwoStageCommonModeGain(NgSpiceWrapper):
 
     def parse_output(self, output_path):
 
-        ac_fname = os.path.join(output_path, 'cm.csv')
-
-        if not os.path.isfile(ac_fname):
-            print("cm file doesn't exist: %s" % output_path)
-
-        ac_raw_outputs = np.genfromtxt(ac_fname, skip_header=1)
-        freq = ac_raw_outputs[:, 0]
-        vout_real = ac_raw_outputs[:, 1]
-        vout_imag = ac_raw_outputs[:, 2]
-        vout = vout_real + 1j*vout_imag
+        ac_outputs = self.load_vectors(output_path, 'cm.csv')
+        freq = ac_outputs.scale
+        vout = ac_outputs[0]
 
         return freq, vout
 
     def find_dc_gain (self, vout):
-        return np.abs(vout)[0]
+        return measure.dc_gain(vout)[0]
 
 class TwoStagePowerSupplyGain(NgSpiceWrapper):
 
+    MEASUREMENTS = {
+        'ps.csv': (
+            ('ps_gain', 'let ps_gain = mag({0}[0])'),
+        ),
+    }
+
+    def translate_measurements(self, output_path):
+        return dict(ps_gain=self.load_measurements(output_path, 'ps.csv')['ps_gain'])
+
     def translate_result(self, output_path):
         """
 
@@ -161,39 +191,77 @@ class TwoStagePowerSupplyGain(NgSpiceWrapper):
 
     def parse_output(self, output_path):
 
-        ac_fname = os.path.join(output_path, 'ps.csv')
-
-        if not os.path.isfile(ac_fname):
-            print("ps file doesn't exist: %s" % output_path)
-
-        ac_raw_outputs = np.genfromtxt(ac_fname, skip_header=1)
-        freq = ac_raw_outputs[:, 0]
-        vout_real = ac_raw_outputs[:, 1]
-        vout_imag = ac_raw_outputs[:, 2]
-        vout = vout_real + 1j*vout_imag
+        ac_outputs = self.load_vectors(output_path, 'ps.csv')
+        freq = ac_outputs.scale
+        vout = ac_outputs[0]
 
         return freq, vout
 
     def find_dc_gain (self, vout):
-        return np.abs(vout)[0]
+        return measure.dc_gain(vout)[0]
 
 class TwoStageTransient(NgSpiceWrapper):
 
+    # needs measure_params fbck (feedback factor) and tot_err (settling band), see EvaluationCore.get_tset
+    MEASUREMENTS = {
+        'tran.csv': (
+            # settling error relative to the final value of the ideal closed loop output, 0 once settled
+            (None, 'let ref_step = ({1}[length({1})-1] - {1}[0]) / {fbck}'),
+            (None, 'let settle_err = ({0} - {0}[0]) / ref_step - 1'),
+            ('settle_err_last', 'let settle_err_last = settle_err[length(settle_err)-1]'),
+            ('time_last', 'let time_last = time[length(time)-1]'),
+            # the last exits of the band through either of its edges
+            ('tset_low', 'meas tran tset_low when settle_err=-{tot_err} cross=last'),
+            ('tset_high', 'meas tran tset_high when settle_err={tot_err} cross=last'),
+            ('offset', 'let offset = abs({0}[0] - {1}[0] / {fbck})'),
+        ),
+    }
+
+    # the output and input of the step response, i(vdd) is not used. The whole transient is, the offset and the
+    # final value are taken from its first point.
+    OUTPUTS = {
+        'tran.csv': dict(vectors=(0, 1)),
+    }
+
+    def translate_measurements(self, output_path):
+        """
+
+        :param output_path:
+        :return
+            result: dict(spec_kwds, spec_value), tset and offset
+        """
+        tran = self.load_measurements(output_path, 'tran.csv')
+        if abs(tran['settle_err_last']) > self.measure_params['tot_err']:
+            # never settles within the simulated time
+            tset = tran['time_last']
+        else:
+            tset = max(tran.get('tset_low', 0.0), tran.get('tset_high', 0.0))
+
+        spec = dict(
+            tset=tset,
+            offset=tran['offset']
+        )
+
+        return spec
+
     def translate_result(self, output_path):
         """
 
         :param output_path:
         :return
-            result: dict(spec_kwds, spec_value)
+            result: dict(spec_kwds, spec_value), tset and offset and the waveforms they were computed from
         """
 
         # use parse output here
         time, vout, vin = self.parse_output(output_path)
-        # vout_norm = vout/vout[-1]
-        # settling_time = self.get_tset(time, vout_norm, tot_err=0.01)
-
+        fbck = self.measure_params['fbck']
+        # a batch of one, see measure.settling_time for whole batches. The refinement only fits the samples
+        # around the band exit, so it stays cheap
+        tset = measure.settling_time(time, vout, vin, fbck, tot_err=self.measure_params['tot_err'])[0]
 
         spec = dict(
+            tset=tset,
+            offset=measure.offset(vout, vin, fbck)[0],
             time=time,
             vout=vout,
             vin=vin
@@ -203,24 +271,87 @@ class TwoStageTransient(NgSpiceWrapper):
 
     def parse_output(self, output_path):
 
-        tran_fname = os.path.join(output_path, 'tran.csv')
+        tran_outputs = self.load_vectors(output_path, 'tran.csv')
+        time =  tran_outputs.scale
+        vout =  tran_outputs[0]
+        vin =   tran_outputs[1]
 
-        if not os.path.isfile(tran_fname):
-            print("tran file doesn't exist: %s" % output_path)
+        return time, vout, vin
 
-        tran_raw_outputs = np.genfromtxt(tran_fname, skip_header=1)
-        time =  tran_raw_outputs[:, 0]
-        vout =  tran_raw_outputs[:, 1]
-        vin =   tran_raw_outputs[:, 3]
+class TwoStageCombined(NgSpiceWrapper):
+    """
+    Runs the open loop, common mode, power supply and transient testbenches as a single deck
+    (two_stage_combined.cir): one ngspice invocation and one model parse per design instead of four.
+    The deck writes the same output files as the individual testbenches, so their translate_result methods
+    are reused to split the outputs back into the usual spec dicts.
+    """
+
+    def __init__(self, num_process, design_netlist, testbenches=None, **kwargs):
+        # dict(testbench_name, wrapper) whose translate_result is applied to the outputs of the combined deck
+        self.testbenches = testbenches
+        NgSpiceWrapper.__init__(self, num_process, design_netlist, **kwargs)
+
+    def measured_outputs(self):
+        # the measurements of the individual testbenches, on the same wrdata outputs of the combined deck
+        if not self.testbenches:
+            return []
+        return [fname for env in self.testbenches.values() for fname in env.measured_outputs()]
+
+    def measure_commands(self, fname, vectors):
+        for env in self.testbenches.values():
+            if fname in env.measured_outputs():
+                return env.measure_commands(fname, vectors)
+        raise KeyError(fname)
+
+    def declared_outputs(self):
+        # the outputs of the individual testbenches, the combined deck writes the same files
+        if not self.testbenches:
+            return {}
+        return {fname: output for env in self.testbenches.values() for fname, output in env.OUTPUTS.items()}
+
+    def output_window(self, fname):
+        for env in self.testbenches.values():
+            if fname in env.OUTPUTS:
+                return env.output_window(fname)
+        return None, None
+
+    def parser_settings(self):
+        # the outputs are parsed by the individual testbenches, with their own measure_params
+        settings = NgSpiceWrapper.parser_settings(self)
+        settings['testbenches'] = {name: env.parser_settings() for name, env in (self.testbenches or {}).items()}
+        return settings
+
+    def translate(self, output_path):
+        """
 
-        return time, vout, vin
+        :param output_path:
+        :return
+            result: dict(testbench_name, dict(spec_kwds, spec_value)), measured or parsed as by each testbench
+        """
+        spec = dict()
+        for name, env in self.testbenches.items():
+            spec[name] = env.translate(output_path)
+        return spec
 
-class EvaluationCore(object):
+    def translate_result(self, output_path):
+        """
+
+        :param output_path:
+        :return
+            result: dict(testbench_name, dict(spec_kwds, spec_value))
+        """
+        spec = dict()
+        for name, env in self.testbenches.items():
+            spec[name] = env.translate_result(output_path)
+        return spec
+
+class EvaluationCore(EvaluationCoreBase):
+
+    result_keys = ('cost', 'ugbw', 'gain', 'phm', 'tset', 'psrr', 'cmrr', 'offset', 'ibias')
 
     def __init__(self, cir_yaml):
-        import yaml
-        with open(cir_yaml, 'r') as f:
-            yaml_data = yaml.load(f)
+        super().__init__(cir_yaml)
+        yaml_data = self.yaml_data
 
         # specs
         self.specs = yaml_data['target_specs']
@@ -235,16 +366,30 @@ class EvaluationCore(object):
         self.offset_max = self.specs['offset_sys_max']
         self.bias_max   = self.specs['bias_max']
 
-        num_process = yaml_data['num_process']
         ol_dsn_netlist = yaml_data['ol_dsn_netlist']
         cm_dsn_netlist = yaml_data['cm_dsn_netlist']
         ps_dsn_netlist = yaml_data['ps_dsn_netlist']
         tran_dsn_netlist = yaml_data['tran_dsn_netlist']
 
-        self.ol_env = TwoStageOpenLoop(num_process=num_process, design_netlist=ol_dsn_netlist)
-        self.cm_env = TwoStageCommonModeGain(num_process=num_process, design_netlist=cm_dsn_netlist)
-        self.ps_env = TwoStagePowerSupplyGain(num_process=num_process, design_netlist=ps_dsn_netlist)
-        self.tran_env = TwoStageTransient(num_process=num_process, design_netlist=tran_dsn_netlist)
+        # all four testbenches share the executor of the core
+        self.ol_env = self.make_env(TwoStageOpenLoop, ol_dsn_netlist)
+        self.cm_env = self.make_env(TwoStageCommonModeGain, cm_dsn_netlist)
+        self.ps_env = self.make_env(TwoStagePowerSupplyGain, ps_dsn_netlist)
+        tran_stop = self.transient_stop()
+        self.tran_env = self.make_env(TwoStageTransient, tran_dsn_netlist,
+                                      measure_params=dict(fbck=self.fdbck, tot_err=self.tot_err),
+                                      tran_stop=tran_stop)
+        # with combined_testbench all four analyses run in the single deck of combined_dsn_netlist
+        if yaml_data.get('combined_testbench', False):
+            self.combined_env = self.make_env(TwoStageCombined, yaml_data['combined_dsn_netlist'],
+                                              testbenches=dict(ol=self.ol_env, cm=self.cm_env, ps=self.ps_env,
+                                                               tran=self.tran_env), tran_stop=tran_stop)
+            self.testbenches['combined'] = self.combined_env
+        else:
+            self.testbenches['ol'] = self.ol_env
+            self.testbenches['cm'] = self.cm_env
+            self.testbenches['ps'] = self.ps_env
+            self.testbenches['tran'] = self.tran_env
 
         self.params = yaml_data['params']
         self.params_vec = []
@@ -268,38 +413,66 @@ class EvaluationCore(object):
         :return:
         """
 
-        eval_start_time = time.time()
         if verbose:
             print("state_before_rounding:{}".format(design))
 
-        state_dict = dict()
-        for i, key in enumerate(self.params.keys()):
-            state_dict[key] = self.params_vec[i][design[i]]
-        state = [state_dict]
+        results = self.cost_fun_batch([design], verbose=verbose)
+        # updated the output because we want to have access to what each individual spec is
+        # return cost
+        return tuple(results[key][0] for key in self.result_keys)
 
-        ol_results = self.ol_env.run(state, verbose=verbose)
-        cm_results = self.cm_env.run(state, verbose=verbose)
-        ps_results = self.ps_env.run(state, verbose=verbose)
-        tran_results = self.tran_env.run(state, verbose=verbose)
+    def transient_stop(self):
+        """
+        stop time of the transient testbench from the tran_stop policy of the yaml file, horizon * tset_max + guard.
+        Settling times up to horizon * tset_max are resolved with the output inside the tot_err band for at least
+        the guard time, slower designs get the stop time as their settling time (which caps their cost).
+        :return: stop time in seconds, None to simulate the whole transient of the netlist
+        """
+        policy = self.yaml_data.get('tran_stop')
+        if not policy:
+            return None
+        return policy.get('horizon', 3.0) * self.tset_max + policy.get('guard', 0.0)
 
-        ugbw_cur = ol_results[0][1]['ugbw']
-        gain_cur = ol_results[0][1]['gain']
-        phm_cur = ol_results[0][1]['phm']
-        ibias_cur = ol_results[0][1]['Ibias']
+    def decode_batch(self, designs):
+        """
+        maps index vectors to parameter values for all designs in one vectorized lookup per parameter
+        :param designs: (n_designs x n_params) indices according to the params of the yaml file
+        :return: list of states, dict(param_kwds, param_value)
+        """
+        designs = np.asarray(designs, dtype=int).reshape(-1, len(self.params_vec))
+        columns = [param_vec[designs[:, i]] for i, param_vec in enumerate(self.params_vec)]
+        return [dict(zip(self.params.keys(), values)) for values in zip(*columns)]
+
+    def evaluate_design(self, results, verbose=False):
+
+        if 'combined' in results:
+            # the combined deck already returns the specs grouped per testbench
+            results = results['combined']
+
+        ugbw_cur = results['ol']['ugbw']
+        gain_cur = results['ol']['gain']
+        phm_cur = results['ol']['phm']
+        ibias_cur = results['ol']['Ibias']
+        if phm_cur is None or np.isnan(phm_cur):
+            # no phase margin to compare against phm_min, the design counts as failed
+            if verbose:
+                print('phm undefined, the phase does not start at or below 0 degrees')
+            return self.failure_row()
         # common mode gain and cmrr
-        cm_gain_cur = cm_results[0][1]['cm_gain']
-        cmrr_cur = 20*np.log10(gain_cur/cm_gain_cur) # in db
+        cm_gain_cur = results['cm']['cm_gain']
+        cmrr_cur = measure.rejection_ratio(gain_cur, cm_gain_cur) # in db
         # power supply gain and psrr
-        ps_gain_cur = ps_results[0][1]['ps_gain']
-        psrr_cur = 20*np.log10(gain_cur/ps_gain_cur) # in db
+        ps_gain_cur = results['ps']['ps_gain']
+        psrr_cur = measure.rejection_ratio(gain_cur, ps_gain_cur) # in db
 
         # transient settling time and offset calculation
-        t = tran_results[0][1]['time']
-        vout = tran_results[0][1]['vout']
-        vin = tran_results[0][1]['vin']
-
-        tset_cur = EvaluationCore.get_tset(t, vout, vin, self.fdbck, tot_err=self.tot_err, plt=verbose)
-        offset_curr = abs(vout[0]-vin[0]/self.fdbck)
+        tran = results['tran']
+        tset_cur = tran['tset']
+        offset_curr = tran['offset']
+        if verbose and 'time' in tran:
+            # plots the normalized step response
+            EvaluationCore.get_tset(tran['time'], tran['vout'], tran['vin'], self.fdbck, tot_err=self.tot_err,
+                                    plt=True)
 
         if verbose:
             print('gain = %f vs. gain_min = %f' %(gain_cur, self.gain_min))
@@ -329,11 +502,8 @@ class EvaluationCore(object):
 
         cost += abs(ibias_cur/self.bias_max)/10
 
-        eval_end_time = time.time()
-        # print("eval_time    %s sec" %(eval_end_time-eval_start_time))
-        # updated the output because we want to have access to what each individual spec is
-        # return cost
-        return cost, ugbw_cur, gain_cur, phm_cur, tset_cur, psrr_cur, cmrr_cur, offset_curr, ibias_cur
+        return dict(cost=cost, ugbw=ugbw_cur, gain=gain_cur, phm=phm_cur, tset=tset_cur, psrr=psrr_cur,
+                    cmrr=cmrr_cur, offset=offset_curr, ibias=ibias_cur)
 
     @classmethod
     def get_tset(cls, t, vout, vin, fbck, tot_err=0.1, plt=False):
@@ -351,20 +521,9 @@ class EvaluationCore(object):
             plt.plot(t, vout)
             plt.plot(t,vin)
 
-        last_idx = np.where(y < 1.0 - tot_err)[0][-1]
-        last_max_vec = np.where(y > 1.0 + tot_err)[0]
-        if last_max_vec.size > 0 and last_max_vec[-1] > last_idx:
-            last_idx = last_max_vec[-1]
-            last_val = 1.0 + tot_err
-        else:
-            last_val = 1.0 - tot_err
-
-        if last_idx == t.size - 1:
-            return t[-1]
-        f = interp.InterpolatedUnivariateSpline(t, y - last_val)
-        t0 = t[last_idx]
-        t1 = t[last_idx + 1]
-        return sciopt.brentq(f, t0, t1)
+        # a batch of one, see measure.settling_time for whole batches. The refinement only fits the samples
+        # around the band exit, so it stays cheap
+        return measure.settling_time(t, vout, vin, fbck, tot_err=tot_err, refine=True)[0]
 
 
 if __name__ == '__main__':
@@ -379,7 +538,8 @@ if __name__ == '__main__':
     ol_env = TwoStageOpenLoop(num_process=num_process, design_netlist=ol_dsn_netlist)
     cm_env = TwoStageCommonModeGain(num_process=num_process, design_netlist=cm_dsn_netlist)
     ps_env = TwoStagePowerSupplyGain(num_process=num_process, design_netlist=ps_dsn_netlist)
-    tran_env = TwoStageTransient(num_process=num_process, design_netlist=tran_dsn_netlist)
+    tran_env = TwoStageTransient(num_process=num_process, design_netlist=tran_dsn_netlist,
+                                 measure_params=dict(fbck=1, tot_err=0.1))
 
     # example of running it for one example point and getting back the data
     state_list = [{'mp1': 18,
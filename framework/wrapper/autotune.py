@@ -0,0 +1,273 @@
+import collections
+import json
+import math
+import os
+import resource
+import threading
+import time
+
+import numpy as np
+
+
+class DeckSizeTuner(object):
+    """
+    Picks how many designs are packed into one ngspice deck from measured run times.
+
+    A deck of k designs is modelled as t(k) = overhead + k * per_design, fitted by least squares over the most
+    recent decks. The chosen size is the smallest one for which the overhead (process startup, model parsing)
+    is at most target_overhead of the deck run time, capped at max_size. Until decks of two different sizes
+    have been timed the tuner explores with sizes 1 and 2.
+    """
+
+    def __init__(self, max_size=32, target_overhead=0.1, history=64):
+        self.max_size = max_size
+        self.target_overhead = target_overhead
+        self._samples = collections.deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._size = 1
+
+    def record(self, size, elapsed):
+        """
+        :param size: number of designs in the deck
+        :param elapsed: wall time it took to simulate the deck
+        """
+        with self._lock:
+            self._samples.append((size, elapsed))
+            self._size = self._fit()
+
+    def size(self):
+        with self._lock:
+            return self._size
+
+    def model(self):
+        """
+        :return: (overhead, per_design) in seconds, or None while there is not enough data
+        """
+        sizes = np.array([sample[0] for sample in self._samples], dtype=float)
+        if np.unique(sizes).size < 2:
+            return None
+        times = np.array([sample[1] for sample in self._samples], dtype=float)
+        per_design, overhead = np.polyfit(sizes, times, 1)
+        return max(overhead, 0.0), per_design
+
+    def _fit(self):
+        model = self.model()
+        if model is None:
+            # explore: alternate between 1 and 2 designs per deck until the model can be fitted
+            return 2 if self._samples[-1][0] == 1 else 1
+        overhead, per_design = model
+        if per_design <= 0:
+            return self.max_size
+        size = math.ceil(overhead * (1 - self.target_overhead) / (self.target_overhead * per_design))
+        return int(min(max(size, 1), self.max_size))
+
+
+def memory_usage():
+    """
+    :return: fraction of the physical memory in use (from /proc/meminfo), None where it can't be read
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            info = dict(line.split(':', 1) for line in f)
+        total = float(info['MemTotal'].split()[0])
+        available = float(info['MemAvailable'].split()[0])
+    except (OSError, KeyError, ValueError):
+        return None
+    return 1.0 - available / total
+
+
+def cpu_time():
+    """
+    :return: CPU seconds used by this process and its finished children (the ngspice processes)
+    """
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (self_usage.ru_utime + self_usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime)
+
+
+class ConcurrencyController(object):
+    """
+    Picks the number of simulations in flight (workers) and the designs per deck at run time by hill climbing on
+    the measured throughput (simulations per second).
+
+    The scheduler reports every finished simulation (observe) and brackets its batches (begin/end), so only the
+    time spent simulating counts. After every window of measurements one knob is moved a step (workers by one,
+    the deck size by a factor of two) and the move is kept if the throughput improved by more than tolerance,
+    otherwise it is undone and the opposite direction or the other knob is tried. Once no move helps the operating
+    point is logged (and appended to log_file as json), it is probed again every reprobe_every windows.
+
+    No worker is added while the CPUs are saturated (cpu_ceiling) or memory use is above memory_ceiling, and
+    workers are taken away while memory use stays above it.
+
+    The controller stands in for the DeckSizeTuner of the wrappers (size, max_size, record).
+    """
+
+    def __init__(self, max_workers=None, max_deck_size=16, tune_deck=True, window=10.0, tolerance=0.05,
+                 memory_ceiling=0.85, cpu_ceiling=0.95, reprobe_every=30, log_file=None):
+        """
+        :param max_workers: upper bound of the workers, defaults to the number of CPUs
+        :param tune_deck: if False the deck size stays at 1
+        :param window: seconds of simulation between two moves
+        """
+        self.n_cpus = os.cpu_count() or 1
+        self.max_workers = max_workers or self.n_cpus
+        self.max_size = max_deck_size if tune_deck else 1
+        self.window = window
+        self.tolerance = tolerance
+        self.memory_ceiling = memory_ceiling
+        self.cpu_ceiling = cpu_ceiling
+        self.reprobe_every = reprobe_every
+        self.log_file = log_file
+
+        self.workers = 1
+        self.deck_size = 1
+        # (throughput, workers, deck_size) of the best operating point of the current climb
+        self._best = None
+        # the move being measured, (knob, direction)
+        self._move = None
+        self._failed = set()
+        self._idle_windows = 0
+        self.last_measurement = None
+
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._busy_since = None
+        self._busy_time = 0.0
+        self._n_done = 0
+        self._window_cpu = cpu_time()
+
+    # DeckSizeTuner interface, used by the wrappers
+
+    def size(self):
+        return self.deck_size
+
+    def record(self, size, elapsed):
+        # throughput is measured by the scheduler, deck timings are not needed
+        pass
+
+    # measurements, called by the scheduler
+
+    def begin(self):
+        with self._lock:
+            if self._busy == 0:
+                self._busy_since = time.time()
+            self._busy += 1
+
+    def end(self):
+        with self._lock:
+            self._busy -= 1
+            if self._busy == 0:
+                self._busy_time += time.time() - self._busy_since
+                self._busy_since = None
+
+    def observe(self, n_done=1):
+        """
+        reports finished simulations, moves a knob once the window is complete
+        """
+        with self._lock:
+            self._n_done += n_done
+            busy_time = self._busy_time
+            if self._busy_since is not None:
+                busy_time += time.time() - self._busy_since
+            # enough simulations for the throughput to mean something
+            if busy_time < self.window or self._n_done < 2 * self.workers * self.deck_size:
+                return
+            throughput = self._n_done / busy_time
+            cpu_now = cpu_time()
+            cpu_util = (cpu_now - self._window_cpu) / (busy_time * self.n_cpus)
+            self._window_cpu = cpu_now
+            self._n_done = 0
+            self._busy_time = 0.0
+            if self._busy_since is not None:
+                self._busy_since = time.time()
+            self._step(throughput, cpu_util, memory_usage())
+
+    # hill climbing
+
+    def _step(self, throughput, cpu_util, mem_util):
+        self.last_measurement = dict(throughput=throughput, cpu=cpu_util, memory=mem_util, workers=self.workers,
+                                     deck_size=self.deck_size)
+        memory_full = mem_util is not None and mem_util > self.memory_ceiling
+        if memory_full and self.workers > 1:
+            self.workers -= 1
+            self._best, self._move = None, None
+            self._failed.add(('workers', 1))
+            print('[autotune] memory use %.0f%% above the ceiling, down to %d workers' % (100 * mem_util,
+                                                                                           self.workers))
+            return
+
+        if self._move is not None:
+            if throughput > self._best[0] * (1 + self.tolerance):
+                self._best = (throughput, self.workers, self.deck_size)
+                # the step back would only return to a point known to be worse
+                knob, direction = self._move
+                self._failed = {(knob, -direction)}
+                print('[autotune] workers=%d deck_size=%d: %.2f sims/s, cpu %.0f%%' % (
+                    self.workers, self.deck_size, throughput, 100 * cpu_util))
+            else:
+                self._failed.add(self._move)
+                _, self.workers, self.deck_size = self._best
+                self._move = None
+        else:
+            if self._best is None:
+                self._best = (throughput, self.workers, self.deck_size)
+            elif self._idle_windows < self.reprobe_every:
+                self._idle_windows += 1
+                return
+            else:
+                # conditions may have changed (other jobs on the machine, another testbench mix), climb again
+                self._best = (throughput, self.workers, self.deck_size)
+                self._failed.clear()
+            self._idle_windows = 0
+
+        move = self._next_move(cpu_util, memory_full)
+        if move is None:
+            self._move = None
+            self._log_operating_point()
+            return
+        self._move = move
+        knob, direction = move
+        if knob == 'workers':
+            self.workers += direction
+        else:
+            self.deck_size = self.deck_size * 2 if direction > 0 else self.deck_size // 2
+
+    def _next_move(self, cpu_util, memory_full):
+        # keep going in the direction that just paid off
+        candidates = [self._move] if self._move is not None else []
+        candidates += [('workers', 1), ('workers', -1), ('deck', 1), ('deck', -1)]
+        for knob, direction in candidates:
+            if (knob, direction) in self._failed:
+                continue
+            if knob == 'workers':
+                if direction > 0 and (self.workers >= self.max_workers or cpu_util > self.cpu_ceiling or
+                                      memory_full):
+                    continue
+                if direction < 0 and self.workers <= 1:
+                    continue
+            else:
+                if direction > 0 and self.deck_size * 2 > self.max_size:
+                    continue
+                if direction < 0 and self.deck_size <= 1:
+                    continue
+            return knob, direction
+        return None
+
+    def operating_point(self):
+        """
+        :return: dict(num_process, designs_per_deck, throughput) of the best point so far, not of a move on trial
+        """
+        if self._best is None:
+            return dict(num_process=self.workers, designs_per_deck=self.deck_size)
+        throughput, workers, deck_size = self._best
+        return dict(num_process=workers, designs_per_deck=deck_size, throughput=throughput)
+
+    def _log_operating_point(self):
+        point = self.operating_point()
+        print('[autotune] operating point: num_process: %d, designs_per_deck: %d (%.2f sims/s), pin it in the '
+              'yaml file to skip tuning' % (point['num_process'], point['designs_per_deck'],
+                                             point.get('throughput', 0.0)))
+        if self.log_file is not None:
+            point['time'] = time.time()
+            with open(self.log_file, 'a') as f:
+                f.write(json.dumps(point) + '\n')
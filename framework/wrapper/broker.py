@@ -0,0 +1,425 @@
+import concurrent.futures
+import hashlib
+import itertools
+import os
+import pickle
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from multiprocessing.managers import BaseManager
+
+# environment variable the workers read the shared secret from, so it does not show up in ps
+AUTHKEY_ENV = 'CIRCUIT_DRL_BROKER_KEY'
+
+
+def parse_address(address):
+    """
+    :param address: 'host:port' or (host, port)
+    :return: (host, port)
+    """
+    if isinstance(address, str):
+        host, port = address.rsplit(':', 1)
+        return host, int(port)
+    return tuple(address)
+
+
+class JobBoard(object):
+    """
+    The state of the broker: queued jobs, the jobs leased to each worker and the last heartbeat of every worker.
+    Lives in the process of the broker, workers reach it through a manager proxy.
+
+    A job is lost when its worker misses heartbeats for heartbeat_timeout seconds, it is queued again (at the front)
+    up to max_attempts times. When a requeued job is finished twice the first result wins.
+    """
+
+    def __init__(self, heartbeat_timeout=30.0, max_attempts=3):
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self.n_requeued = 0
+        self._queue = deque()
+        # dict(job_id, [payload, future, attempts]), only unfinished jobs
+        self._jobs = dict()
+        # dict(worker_id, dict(host, slots, last_seen, leased=set of job ids))
+        self._workers = dict()
+        self._closed = False
+        self._cond = threading.Condition()
+
+    # broker side
+
+    def add(self, job_id, payload, future):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('the broker is shut down')
+            self._jobs[job_id] = [payload, future, 0]
+            self._queue.append(job_id)
+            self._cond.notify()
+
+    def reap(self):
+        """
+        drops the workers that missed their heartbeats and requeues their jobs
+        """
+        now = time.time()
+        with self._cond:
+            lost = [worker_id for worker_id, worker in self._workers.items()
+                    if now - worker['last_seen'] > self.heartbeat_timeout]
+            for worker_id in lost:
+                self._drop_worker(worker_id)
+
+    def _drop_worker(self, worker_id):
+        worker = self._workers.pop(worker_id)
+        for job_id in worker['leased']:
+            job = self._jobs.get(job_id)
+            if job is None:
+                continue
+            if job[2] >= self.max_attempts:
+                del self._jobs[job_id]
+                job[1].set_exception(RuntimeError('job %s was lost by %d workers' % (job_id, job[2])))
+            else:
+                self.n_requeued += 1
+                self._queue.appendleft(job_id)
+        self._cond.notify_all()
+
+    def n_slots(self):
+        with self._cond:
+            return sum(worker['slots'] for worker in self._workers.values())
+
+    def stats(self):
+        with self._cond:
+            return dict(workers=len(self._workers), slots=sum(worker['slots'] for worker in self._workers.values()),
+                        queued=len(self._queue), unfinished=len(self._jobs), requeued=self.n_requeued)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            jobs, self._jobs = self._jobs, dict()
+            self._queue.clear()
+            self._cond.notify_all()
+        for _, future, _ in jobs.values():
+            if not future.done():
+                future.set_exception(RuntimeError('the broker was shut down before the job finished'))
+
+    # worker side, called through the proxy
+
+    def register(self, worker_id, host, slots):
+        with self._cond:
+            self._workers[worker_id] = dict(host=host, slots=slots, last_seen=time.time(), leased=set())
+
+    def unregister(self, worker_id):
+        with self._cond:
+            if worker_id in self._workers:
+                self._drop_worker(worker_id)
+
+    def heartbeat(self, worker_id):
+        """
+        :return: False if the worker was declared lost, it has to register again
+        """
+        with self._cond:
+            worker = self._workers.get(worker_id)
+            if worker is None:
+                return False
+            worker['last_seen'] = time.time()
+            return True
+
+    def get_job(self, worker_id, timeout=1.0):
+        """
+        leases the next job to a worker
+        :return: (job_id, payload), None if no job showed up within timeout, False once the broker is shut down
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    return False
+                worker = self._workers.get(worker_id)
+                while worker is not None and self._queue:
+                    job_id = self._queue.popleft()
+                    job = self._jobs.get(job_id)
+                    if job is None:
+                        continue
+                    if job[2] == 0 and not job[1].set_running_or_notify_cancel():
+                        del self._jobs[job_id]
+                        continue
+                    job[2] += 1
+                    worker['leased'].add(job_id)
+                    return job_id, job[0]
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    def put_result(self, worker_id, job_id, ok, blob):
+        """
+        :param ok: True if blob is the pickled return value of the job, False if it is the exception it raised
+        """
+        with self._cond:
+            worker = self._workers.get(worker_id)
+            if worker is not None:
+                worker['leased'].discard(job_id)
+                worker['last_seen'] = time.time()
+            job = self._jobs.pop(job_id, None)
+        if job is None:
+            # a late copy of a requeued job
+            return
+        try:
+            value = pickle.loads(blob)
+        except Exception as e:
+            job[1].set_exception(e)
+            return
+        if ok:
+            job[1].set_result(value)
+        else:
+            job[1].set_exception(value)
+
+
+class _WorkerManager(BaseManager):
+    pass
+
+
+_WorkerManager.register('get_board')
+
+
+class BrokerExecutor(object):
+    """
+    Executor that hands the jobs to worker processes on any host instead of running them locally. It implements
+    the interface of SimulationExecutor (submit, starmap, num_workers, shutdown), so evaluation cores and wrappers
+    use it as is (executor: broker in the yaml files).
+
+    The broker listens on address with a multiprocessing manager, workers connect with the same authkey, pull
+    pickled jobs, run them and push the pickled results back. Workers need the same checkout of the repository
+    (they run from its root) and the simulator on their path.
+
+        python -m framework.wrapper.broker --connect host:port --slots 4
+
+    The authkey protects a pickle based protocol, anyone holding it can run code on the broker and the workers.
+    """
+
+    def __init__(self, address='127.0.0.1:0', authkey=None, heartbeat_timeout=30.0, max_attempts=3,
+                 local_workers=0, worker_slots=1):
+        """
+        :param address: 'host:port' the broker listens on, port 0 picks a free one (see self.address)
+        :param authkey: shared secret of broker and workers, defaults to the CIRCUIT_DRL_BROKER_KEY environment
+        variable or a random key
+        :param heartbeat_timeout: seconds without heartbeat after which the jobs of a worker are requeued
+        :param max_attempts: number of workers a job may be lost by before its future fails
+        :param local_workers: number of worker processes started on this host right away
+        :param worker_slots: jobs run concurrently by each of the local workers
+        """
+        if authkey is None:
+            authkey = os.environ.get(AUTHKEY_ENV) or uuid.uuid4().hex
+        self.authkey = authkey.encode() if isinstance(authkey, str) else authkey
+        self.board = JobBoard(heartbeat_timeout=heartbeat_timeout, max_attempts=max_attempts)
+        self._job_ids = itertools.count()
+
+        board = self.board
+        manager_cls = type('BrokerManager', (BaseManager,), {})
+        manager_cls.register('get_board', callable=lambda: board)
+        self._server = manager_cls(address=parse_address(address), authkey=self.authkey).get_server()
+        self._server.stop_event = threading.Event()
+        self.address = self._server.address
+
+        self._stop = threading.Event()
+        threading.Thread(target=self._serve, daemon=True).start()
+        self._monitor = threading.Thread(target=self._reap, daemon=True)
+        self._monitor.start()
+        self._local_workers = []
+        if local_workers:
+            self.spawn_local_workers(local_workers, worker_slots)
+
+    def _serve(self):
+        # Server.serve_forever can't be stopped without exiting the process, this is its accept loop
+        while not self._stop.is_set():
+            try:
+                conn = self._server.listener.accept()
+            except Exception:
+                # failed handshakes, or the wake up connection of shutdown
+                continue
+            threading.Thread(target=self._server.handle_request, args=(conn,), daemon=True).start()
+        self._server.listener.close()
+
+    def _reap(self):
+        interval = max(0.1, self.board.heartbeat_timeout / 4)
+        while not self._stop.wait(interval):
+            self.board.reap()
+
+    @property
+    def num_workers(self):
+        """
+        number of jobs the connected workers run at once (at least 1, jobs wait in the queue until a worker shows up)
+        """
+        return max(1, self.board.n_slots())
+
+    def spawn_local_workers(self, n_workers, slots=1):
+        """
+        starts worker processes on this host, they exit when the broker is shut down
+        """
+        env = dict(os.environ)
+        env[AUTHKEY_ENV] = self.authkey.decode()
+        host, port = self.address
+        for _ in range(n_workers):
+            self._local_workers.append(subprocess.Popen(
+                [sys.executable, '-m', 'framework.wrapper.broker', '--connect', '%s:%d' % (host, port),
+                 '--slots', str(slots)], env=env))
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        payload = (pickle.dumps(fn, protocol=pickle.HIGHEST_PROTOCOL),
+                   pickle.dumps((args, kwargs), protocol=pickle.HIGHEST_PROTOCOL))
+        self.board.add(next(self._job_ids), payload, future)
+        return future
+
+    def map(self, fn, *iterables, ordered=True):
+        """
+        :param ordered: if True the results come in the order of the arguments, otherwise as they complete
+        :return: generator of the results of fn
+        """
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+        for future in (futures if ordered else concurrent.futures.as_completed(futures)):
+            yield future.result()
+
+    def starmap(self, fn, arg_list):
+        """
+        same semantics as multiprocessing.Pool.starmap, results are returned in the order of arg_list
+        """
+        futures = [self.submit(fn, *args) for args in arg_list]
+        return [future.result() for future in futures]
+
+    def stats(self):
+        return self.board.stats()
+
+    def shutdown(self, wait=True):
+        """
+        fails the unfinished jobs, stops the workers and closes the listener
+        """
+        self.board.close()
+        self._stop.set()
+        if wait:
+            # workers notice the shut down on their next poll
+            for proc in self._local_workers:
+                try:
+                    proc.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+        # wake the accept loop up so it sees the stop flag
+        try:
+            socket.create_connection(self.address, timeout=1).close()
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+
+class BrokerWorker(object):
+    """
+    Pulls jobs from a broker and runs them in slots threads. Callables are cached by the digest of their pickle,
+    so the wrapper a job is bound to (and its simulator backend) stays warm across jobs.
+    """
+
+    def __init__(self, address, authkey, slots=1, heartbeat_interval=5.0, max_cached=32):
+        self.address = parse_address(address)
+        self.authkey = authkey.encode() if isinstance(authkey, str) else authkey
+        self.slots = slots
+        self.heartbeat_interval = heartbeat_interval
+        self.max_cached = max_cached
+        self.worker_id = '%s-%d-%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self._fns = OrderedDict()
+        self._fns_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _connect(self):
+        manager = _WorkerManager(address=self.address, authkey=self.authkey)
+        manager.connect()
+        return manager.get_board()
+
+    def _load_fn(self, fn_blob):
+        key = hashlib.blake2b(fn_blob, digest_size=16).digest()
+        with self._fns_lock:
+            fn = self._fns.get(key)
+            if fn is not None:
+                self._fns.move_to_end(key)
+                return fn
+        fn = pickle.loads(fn_blob)
+        with self._fns_lock:
+            self._fns[key] = fn
+            while len(self._fns) > self.max_cached:
+                self._fns.popitem(last=False)
+        return fn
+
+    def _run_job(self, payload):
+        try:
+            fn_blob, args_blob = payload
+            args, kwargs = pickle.loads(args_blob)
+            return True, pickle.dumps(self._load_fn(fn_blob)(*args, **kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            try:
+                return False, pickle.dumps(e, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                return False, pickle.dumps(RuntimeError(repr(e)), protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _slot(self):
+        try:
+            board = self._connect()
+            while not self._stop.is_set():
+                job = board.get_job(self.worker_id, 1.0)
+                if job is False:
+                    break
+                if job is None:
+                    continue
+                job_id, payload = job
+                ok, blob = self._run_job(payload)
+                board.put_result(self.worker_id, job_id, ok, blob)
+        except (EOFError, OSError):
+            # the broker went away
+            pass
+        self._stop.set()
+
+    def _heartbeat(self):
+        try:
+            board = self._connect()
+            while not self._stop.wait(self.heartbeat_interval):
+                if not board.heartbeat(self.worker_id):
+                    # declared lost (e.g. suspended for too long), its jobs went to others
+                    board.register(self.worker_id, socket.gethostname(), self.slots)
+        except (EOFError, OSError):
+            self._stop.set()
+
+    def run(self):
+        """
+        serves jobs until the broker shuts down or goes away
+        """
+        board = self._connect()
+        board.register(self.worker_id, socket.gethostname(), self.slots)
+        threads = [threading.Thread(target=self._heartbeat, daemon=True)]
+        threads += [threading.Thread(target=self._slot, daemon=True) for _ in range(self.slots)]
+        for thread in threads:
+            thread.start()
+        try:
+            while not self._stop.wait(1.0):
+                pass
+        except KeyboardInterrupt:
+            self._stop.set()
+        try:
+            board.unregister(self.worker_id)
+        except (EOFError, OSError):
+            pass
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connect', type=str, required=True, help='host:port of the broker')
+    parser.add_argument('--slots', type=int, default=1, help='jobs run concurrently by this worker')
+    parser.add_argument('--heartbeat', type=float, default=5.0, help='seconds between heartbeats')
+    args = parser.parse_args()
+
+    authkey = os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        parser.error('set %s to the authkey of the broker' % AUTHKEY_ENV)
+    BrokerWorker(args.connect, authkey, slots=args.slots, heartbeat_interval=args.heartbeat).run()
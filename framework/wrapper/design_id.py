@@ -0,0 +1,92 @@
+import hashlib
+import json
+import numbers
+import os
+import sqlite3
+import threading
+import time
+
+
+def canonical_value(value):
+    """
+    text of a parameter value that does not depend on its type, 18, 18.0 and np.float64(18) are the same value
+    """
+    if isinstance(value, numbers.Real):
+        return repr(float(value))
+    return str(value)
+
+
+def design_id(base_name, state, length=16):
+    """
+    :param base_name: name of the testbench the design is simulated in
+    :param state: dict(param_kwds, param_value)
+    :param length: number of hex digits of the id
+    :return: a fixed length digest identifying the design, stable across runs and processes
+    """
+    digest = hashlib.blake2b(base_name.encode(), digest_size=32)
+    for key in sorted(state):
+        digest.update(('\0%s=%s' % (key, canonical_value(state[key]))).encode())
+    return digest.hexdigest()[:length]
+
+
+def shard_path(root, name, design_hash):
+    """
+    :return: root/ab/cd/name where abcd... is the design hash, so no directory grows beyond 256 entries per level
+    """
+    return os.path.join(root, design_hash[:2], design_hash[2:4], name)
+
+
+class DesignIndex(object):
+    """
+    Sidecar SQLite index that maps design ids back to the parameters of the designs. Safe to share between
+    threads and processes.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._known = set()
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_known'] = set()
+        state['_local'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS designs (id TEXT PRIMARY KEY, base_name TEXT, params TEXT, '
+                         'created REAL)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def add(self, name, base_name, state):
+        """
+        records the parameters of a design, designs that are already known are skipped
+        """
+        if name in self._known:
+            return
+        params = json.dumps({key: float(value) if isinstance(value, numbers.Real) else str(value)
+                             for key, value in state.items()}, sort_keys=True)
+        self._connect().execute('INSERT OR IGNORE INTO designs VALUES (?, ?, ?, ?)',
+                                (name, base_name, params, time.time()))
+        self._known.add(name)
+
+    def lookup(self, name):
+        """
+        :return: dict(param_kwds, param_value) of the design, None if it is not in the index
+        """
+        row = self._connect().execute('SELECT params FROM designs WHERE id = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM designs').fetchone()[0]
@@ -0,0 +1,350 @@
+import importlib
+import math
+import os
+import socket
+import threading
+from collections import OrderedDict, deque
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from framework.wrapper.scheduler import TestbenchScheduler
+from framework.wrapper.single_flight import SingleFlight
+
+DEFAULT_SOCKET = '/tmp/circuit_drl/eval_daemon.sock'
+
+
+class _ClientState(object):
+
+    def __init__(self, client_id, quota=None):
+        self.client_id = client_id
+        self.quota = quota
+        # (key, design, verbose, future) waiting for a free slot
+        self.queue = deque()
+        self.in_flight = 0
+        self.n_designs = 0
+
+
+class _ClientView(object):
+    """
+    the evaluation core as seen by one client, cost_fun_batch goes through the fair queue of the daemon. The
+    cost_fun of the core class runs on top of it, whatever its signature.
+    """
+
+    def __init__(self, daemon, client):
+        self._daemon = daemon
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._daemon.core, name)
+
+    def cost_fun_batch(self, designs, verbose=False):
+        return self._daemon.core.to_columns(self._daemon.evaluate(self._client, designs, verbose))
+
+
+class EvaluationDaemon(object):
+    """
+    Long running evaluation service shared by many optimizer processes on the same host. It owns one evaluation
+    core, so the executor, warm simulator backends, memo and simulation cache are shared by all of its clients.
+    Clients connect to a Unix socket (see EvaluationClient).
+
+    Scheduling: the designs of all clients wait in one queue per client and are handed to the core round-robin,
+    at most max_in_flight at once. A client holds at most its quota of those slots, clients without an explicit
+    quota get an equal share of max_in_flight among the clients that have work. A design that is already queued or
+    in flight for any client is not evaluated again, the new request waits for the same result (see SingleFlight).
+    """
+
+    def __init__(self, core, socket_path=DEFAULT_SOCKET, authkey=None, max_in_flight=None, quotas=None):
+        """
+        :param core: an evaluation core (see EvaluationCoreBase)
+        :param authkey: optional shared secret, access is otherwise limited by the permissions of the socket (0600)
+        :param max_in_flight: designs evaluated at once, defaults to twice the parallelism of the executor
+        :param quotas: dict(client_id, max designs in flight) for clients that should not get an equal share
+        """
+        self.core = core
+        self.socket_path = os.path.abspath(socket_path)
+        self.authkey = authkey.encode() if isinstance(authkey, str) else authkey
+        self.max_in_flight = max_in_flight
+        self.quotas = dict(quotas or {})
+        self.n_requests = 0
+        self.n_evaluated = 0
+        # designs that are queued or in flight, for any client. Not the one of the core, its calls would wait for
+        # the designs the daemon claimed.
+        self.single_flight = SingleFlight()
+
+        self._clients = OrderedDict()
+        self._n_in_flight = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._listener = None
+
+    def get_max_in_flight(self):
+        if self.max_in_flight is not None:
+            return self.max_in_flight
+        executor = self.core.executor
+        return 2 * executor.num_workers * TestbenchScheduler._deck_size(self.core.testbenches)
+
+    def get_client(self, client_id):
+        with self._cond:
+            client = self._clients.get(client_id)
+            if client is None:
+                client = _ClientState(client_id, self.quotas.get(client_id))
+                self._clients[client_id] = client
+            return client
+
+    def evaluate(self, client, designs, verbose=False):
+        """
+        evaluates designs on behalf of a client, blocks until all of them are done
+        :return: list of rows, dict(result_key, value), in the order of designs
+        """
+        futures = []
+        with self._cond:
+            self.n_requests += 1
+            for design in designs:
+                key = self.core.memo_key(design)
+                future, leader = self.single_flight.claim(key)
+                if leader:
+                    client.queue.append((key, design, verbose, future))
+                    client.n_designs += 1
+                futures.append(future)
+            self._cond.notify_all()
+        return [future.result() for future in futures]
+
+    def _quota(self, client, n_active):
+        if client.quota is not None:
+            return client.quota
+        return max(1, int(math.ceil(self.get_max_in_flight() / max(1, n_active))))
+
+    def _next_round(self):
+        """
+        takes designs from the client queues round-robin until the free slots are used up
+        :return: list of (client, key, design, verbose, future), empty once the daemon is closed
+        """
+        with self._cond:
+            while True:
+                if self._closed:
+                    return []
+                max_in_flight = self.get_max_in_flight()
+                active = [client for client in self._clients.values() if client.queue or client.in_flight]
+                picked = []
+                progress = True
+                while progress and self._n_in_flight < max_in_flight:
+                    progress = False
+                    for client in active:
+                        if self._n_in_flight >= max_in_flight:
+                            break
+                        if client.queue and client.in_flight < self._quota(client, len(active)):
+                            client.in_flight += 1
+                            self._n_in_flight += 1
+                            picked.append((client,) + client.queue.popleft())
+                            progress = True
+                if picked:
+                    # the next round starts with the client after the last one served
+                    last = picked[-1][0].client_id
+                    self._clients.move_to_end(last)
+                    return picked
+                self._cond.wait()
+
+    def _dispatch(self):
+        while True:
+            picked = self._next_round()
+            if not picked:
+                return
+            verbose = any(verbose for _, _, _, verbose, _ in picked)
+            futures = self.core.cost_fun_submit([design for _, _, design, _, _ in picked], verbose=verbose)
+            for (client, key, _, _, claimed), future in zip(picked, futures):
+                future.add_done_callback(lambda future, client=client, key=key, claimed=claimed:
+                                         self._finish(client, key, claimed, future))
+
+    def _finish(self, client, key, claimed, future):
+        with self._cond:
+            client.in_flight -= 1
+            self._n_in_flight -= 1
+            self.n_evaluated += 1
+            self._cond.notify_all()
+        error = future.exception()
+        self.single_flight.resolve(key, claimed, None if error is not None else future.result(), error)
+
+    def _handle(self, conn):
+        client = None
+        try:
+            while True:
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    return
+                op = message.get('op')
+                try:
+                    if op == 'hello':
+                        client = self.get_client(message['client_id'])
+                        value = None
+                    elif client is None:
+                        raise RuntimeError('the client did not say hello')
+                    elif op == 'cost_fun_batch':
+                        value = self.core.to_columns(self.evaluate(client, message['designs'], message['verbose']))
+                    elif op == 'cost_fun':
+                        view = _ClientView(self, client)
+                        value = type(self.core).cost_fun(view, *message['args'], **message['kwargs'])
+                    elif op == 'getattr':
+                        value = getattr(self.core, message['name'])
+                        if callable(value):
+                            raise AttributeError('%s is a method of the core, only data attributes are served'
+                                                 % message['name'])
+                    elif op == 'stats':
+                        value = self.stats()
+                    else:
+                        raise ValueError('unknown operation %s' % op)
+                    response = dict(ok=True, value=value)
+                except Exception as e:
+                    response = dict(ok=False, error=e)
+                try:
+                    conn.send(response)
+                except (EOFError, OSError):
+                    return
+        finally:
+            conn.close()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn = self._listener.accept()
+            except Exception:
+                # failed handshakes, or the listener was closed
+                continue
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def start(self):
+        """
+        starts serving in background threads
+        """
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            # left behind by a daemon that did not shut down cleanly
+            os.remove(self.socket_path)
+        self._listener = Listener(self.socket_path, family='AF_UNIX', authkey=self.authkey)
+        os.chmod(self.socket_path, 0o600)
+        threading.Thread(target=self._accept, daemon=True).start()
+        threading.Thread(target=self._dispatch, daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        self.start()
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def stats(self):
+        with self._cond:
+            clients = {client.client_id: dict(designs=client.n_designs, queued=len(client.queue),
+                                              in_flight=client.in_flight)
+                       for client in self._clients.values()}
+            return dict(requests=self.n_requests, evaluated=self.n_evaluated,
+                        coalesced=self.single_flight.n_coalesced, in_flight=self._n_in_flight, clients=clients)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            queued = [item for client in self._clients.values() for item in client.queue]
+            self._cond.notify_all()
+        for key, _, _, claimed in queued:
+            self.single_flight.resolve(key, claimed, exception=RuntimeError('the evaluation daemon was shut down'))
+        if self._listener is not None:
+            # wake the accept loop up so it sees the flag
+            try:
+                Client(self.socket_path, family='AF_UNIX', authkey=self.authkey).close()
+            except Exception:
+                pass
+            self._listener.close()
+        self.core.close()
+
+
+class EvaluationClient(object):
+    """
+    Thin client of an EvaluationDaemon with the interface of the evaluation cores: cost_fun (with the signature of
+    the core served by the daemon) and cost_fun_batch. Data attributes of the core (params, result_keys, ...) are
+    fetched from the daemon the first time they are used. Safe to share between threads, calls are serialized.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, authkey=None, client_id=None):
+        """
+        :param client_id: identifies the client for the quotas of the daemon, defaults to host and pid
+        """
+        self._conn = Client(os.path.abspath(socket_path), family='AF_UNIX',
+                            authkey=authkey.encode() if isinstance(authkey, str) else authkey)
+        self._lock = threading.Lock()
+        self._attrs = dict()
+        self.client_id = client_id or '%s-%d' % (socket.gethostname(), os.getpid())
+        self._call('hello', client_id=self.client_id)
+
+    def _call(self, op, **kwargs):
+        kwargs['op'] = op
+        with self._lock:
+            self._conn.send(kwargs)
+            response = self._conn.recv()
+        if not response['ok']:
+            raise response['error']
+        return response['value']
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name not in self._attrs:
+            self._attrs[name] = self._call('getattr', name=name)
+        return self._attrs[name]
+
+    def cost_fun(self, *args, **kwargs):
+        return self._call('cost_fun', args=args, kwargs=kwargs)
+
+    def cost_fun_batch(self, designs, verbose=False):
+        """
+        :return: dict(result_key, np.array) with one entry per design in each column, as the core returns it
+        """
+        # plain lists, the daemon does not need the classes of the caller (e.g. Design) to unpickle them
+        designs = [np.asarray(design).tolist() for design in designs]
+        return self._call('cost_fun_batch', designs=designs, verbose=verbose)
+
+    def stats(self):
+        return self._call('stats')
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('cir_yaml', type=str, help='yaml file of the circuit, e.g. ./framework/yaml_files/dtsa.yaml')
+    parser.add_argument('--core', type=str, default=None,
+                        help='module.Class of the evaluation core, defaults to the core_name class (EvaluationCore '
+                             'if missing) of the wrapper_name module of the yaml file')
+    parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET)
+    parser.add_argument('--max_in_flight', type=int, default=None)
+    parser.add_argument('--quota', type=str, action='append', default=[], help='client_id=n, can be repeated')
+    args = parser.parse_args()
+
+    if args.core is None:
+        import yaml
+        with open(args.cir_yaml, 'r') as f:
+            yaml_data = yaml.load(f, Loader=yaml.FullLoader)
+        if 'wrapper_name' not in yaml_data:
+            parser.error('%s has no wrapper_name, pass the evaluation core with --core' % args.cir_yaml)
+        module_name = 'framework.wrapper.%s' % yaml_data['wrapper_name']
+        class_name = yaml_data.get('core_name', 'EvaluationCore')
+    else:
+        module_name, class_name = args.core.rsplit('.', 1)
+    core_cls = getattr(importlib.import_module(module_name), class_name)
+    quotas = {client_id: int(n) for client_id, n in (quota.rsplit('=', 1) for quota in args.quota)}
+
+    daemon = EvaluationDaemon(core_cls(args.cir_yaml), socket_path=args.socket, max_in_flight=args.max_in_flight,
+                              quotas=quotas)
+    print('[info] serving %s on %s' % (args.cir_yaml, daemon.socket_path))
+    daemon.serve_forever()
@@ -0,0 +1,370 @@
+import os
+import pickle
+import threading
+import asyncio
+import concurrent.futures
+from collections import OrderedDict
+
+import numpy as np
+
+from framework.wrapper.executor import SimulationExecutor
+from framework.wrapper.broker import BrokerExecutor
+from framework.wrapper.scheduler import TestbenchScheduler
+from framework.wrapper.autotune import ConcurrencyController
+from framework.wrapper.sim_cache import SimulationCache
+from framework.wrapper.memo import CostMemo
+from framework.wrapper.single_flight import SingleFlight
+from framework.wrapper.workspace import Workspace
+
+
+class EvaluationCoreBase(object):
+    """
+    Common plumbing of the evaluation cores: reads the yaml file and owns the simulation executor that all
+    testbenches of the core share. Use it as a context manager (or call close()) to shut the executor down.
+
+    yaml keys (all optional but num_process, the defaults run every design in a folder of its own with the batch
+    backend, without memo, cache or time limits. The yaml files of the circuits only set what is specific to them):
+        num_process: number of workers of the executor, or auto to let a ConcurrencyController pick the number of
+        simulations in flight (and the deck size if designs_per_deck is auto as well) while the run goes on
+        autotune: dict of ConcurrencyController arguments (max_workers, max_deck_size, window, memory_ceiling,
+        cpu_ceiling, log_file, ...) used with num_process: auto
+        executor: thread, process or forkserver (see SimulationExecutor), defaults to thread. broker sends the jobs
+        to worker processes on any host instead (see BrokerExecutor)
+        broker: dict of BrokerExecutor arguments (address, authkey, local_workers, worker_slots, heartbeat_timeout)
+        backend: simulation backend of the wrappers (see NgSpiceWrapper.BACKENDS), defaults to batch. shared needs a
+        process or forkserver executor when num_process is above 1
+        designs_per_deck: designs simulated by one ngspice process of the batch backend, an int or auto
+        output_format: csv or raw (see NgSpiceWrapper.OUTPUT_FORMATS), defaults to csv
+        sim_cache: path of a persistent SimulationCache shared across runs, no caching if missing or null
+        sim_cache_max_mb: size limit of the cache, unlimited if missing or null
+        sim_cache_waveforms: if True the output files are cached as well
+        memo_entries: size of the in-memory memo of evaluated designs (see CostMemo), no memo if missing or null
+        (designs that timed out or hit an ngspice error are not memoized)
+        memo_mb: memory budget of the memo, unlimited if missing or null
+        workspace: dict of Workspace arguments (root, keep, top_k, rank_by, rank_order), the jobs then run in
+        recycled scratch folders. If missing or null every design keeps a permanent folder under /tmp/circuit_drl
+        sim_timeout: wall-clock seconds a design may spend in one testbench before ngspice is killed, null waits
+        sim_cpu_limit: same for the CPU time of the ngspice process
+        testbench_limits: per testbench overrides of sim_timeout/sim_cpu_limit, keyed by the netlist file name
+        without extension, e.g. {two_stage_tran: {sim_timeout: 300}}
+        failure_cost: cost of designs whose simulation failed or was killed, their specs are NaN. Defaults to 100
+        speculate_after: fraction of a batch that must be done before straggling simulations get a second copy
+        (see TestbenchScheduler), needs a workspace. Missing or null disables speculation
+        speculate_factor: a simulation straggles once it takes that many times the median simulation, default 2
+        measure: if True the testbenches that declare MEASUREMENTS have ngspice compute their specs (.meas) and
+        only those scalars are parsed, instead of exporting and parsing the waveforms. Defaults to False
+        export_waveforms: with measure, write the waveforms as well (debugging, plots of verbose runs)
+        tran_stop: dict of the early termination policy of the transient testbenches, turned into their stop time
+        by the core (see the transient_stop of the cores). Missing or null simulates the transient of the netlists
+
+    Subclasses register their wrappers in self.testbenches and implement decode_batch and evaluate_design,
+    cost_fun_batch then takes care of scheduling every (design x testbench) job on the executor.
+    """
+
+    # names of the columns returned by cost_fun_batch, the first one is always the cost
+    result_keys = ('cost',)
+
+    def __init__(self, cir_yaml):
+        import yaml
+        with open(cir_yaml, 'r') as f:
+            self.yaml_data = yaml.load(f, Loader=yaml.FullLoader)
+
+        self.num_process = self.yaml_data['num_process']
+        self.backend = self.yaml_data.get('backend', 'batch')
+        self.designs_per_deck = self.yaml_data.get('designs_per_deck', 1)
+        self.controller = None
+        if self.num_process == 'auto':
+            # decks are only packed by the batch backend
+            tune_deck = self.designs_per_deck == 'auto' and self.backend == 'batch'
+            self.controller = ConcurrencyController(tune_deck=tune_deck, **(self.yaml_data.get('autotune') or {}))
+            # the executor gets all the workers the controller may use, the scheduler limits how many are busy
+            self.num_process = self.controller.max_workers
+        self.output_format = self.yaml_data.get('output_format', 'csv')
+        self.cache = None
+        if self.yaml_data.get('sim_cache'):
+            max_mb = self.yaml_data.get('sim_cache_max_mb')
+            self.cache = SimulationCache(self.yaml_data['sim_cache'],
+                                         max_bytes=int(max_mb * 2**20) if max_mb is not None else None,
+                                         store_waveforms=self.yaml_data.get('sim_cache_waveforms', False))
+        executor_kind = self.yaml_data.get('executor', 'thread')
+        if executor_kind == 'broker':
+            self.executor = BrokerExecutor(**(self.yaml_data.get('broker') or {}))
+        else:
+            self.executor = SimulationExecutor(num_workers=self.num_process, kind=executor_kind)
+        self.memo = None
+        if self.yaml_data.get('memo_entries') is not None or self.yaml_data.get('memo_mb') is not None:
+            memo_mb = self.yaml_data.get('memo_mb')
+            self.memo = CostMemo(max_entries=self.yaml_data.get('memo_entries'),
+                                 max_bytes=int(memo_mb * 2**20) if memo_mb is not None else None)
+        workspace_kwargs = self.yaml_data.get('workspace')
+        self.workspace = Workspace(**workspace_kwargs) if workspace_kwargs is not None else None
+        self.failure_cost = self.yaml_data.get('failure_cost', 100.0)
+        speculate_after = self.yaml_data.get('speculate_after')
+        if speculate_after is not None and self.workspace is None:
+            raise ValueError('speculate_after needs a workspace, copies of a design would share its folder')
+        # designs being simulated right now, concurrent calls for the same design wait for the running simulation
+        self.single_flight = SingleFlight()
+        self.testbenches = OrderedDict()
+        self.scheduler = TestbenchScheduler(self.executor, speculate_after=speculate_after,
+                                            speculate_factor=self.yaml_data.get('speculate_factor', 2.0),
+                                            controller=self.controller)
+
+    def make_env(self, env_cls, design_netlist, **kwargs):
+        """
+        instantiates a testbench wrapper that runs on the shared executor of this core
+        """
+        limits = dict(sim_timeout=self.yaml_data.get('sim_timeout'), sim_cpu_limit=self.yaml_data.get('sim_cpu_limit'))
+        netlist_name = os.path.splitext(os.path.basename(design_netlist))[0]
+        # the controller picks the deck size when both are auto, otherwise the wrapper handles designs_per_deck
+        deck_tuner = self.controller if self.controller is not None and self.controller.max_size > 1 else None
+        limits.update((self.yaml_data.get('testbench_limits') or {}).get(netlist_name) or {})
+        return env_cls(num_process=self.num_process, design_netlist=design_netlist, backend=self.backend,
+                       executor=self.executor, designs_per_deck=self.designs_per_deck,
+                       output_format=self.output_format, cache=self.cache,
+                       workspace=self.workspace, wall_timeout=limits['sim_timeout'],
+                       cpu_timeout=limits['sim_cpu_limit'], deck_tuner=deck_tuner,
+                       measure=self.yaml_data.get('measure', False),
+                       export_waveforms=self.yaml_data.get('export_waveforms', False), **kwargs)
+
+    def transient_savings(self):
+        """
+        :return: dict(testbench_name, savings) for the testbenches whose transient is stopped early, see
+        NgSpiceWrapper.transient_savings
+        """
+        savings = OrderedDict()
+        for name, env in self.testbenches.items():
+            env_savings = env.transient_savings()
+            if env_savings is not None:
+                savings[name] = env_savings
+        return savings
+
+    def decode_batch(self, designs):
+        """
+        maps the designs to parameter values of the netlists
+        :param designs: sequence of designs as accepted by cost_fun of the core
+        :return: list of states, dict(param_kwds, param_value)
+        """
+        raise NotImplementedError
+
+    def evaluate_design(self, results, verbose=False):
+        """
+        computes the cost of a single design
+        :param results: dict(testbench_name, specs returned by that testbench)
+        :param verbose: if True will print the specification performance of the design
+        :return: dict with a value for each of result_keys
+        """
+        raise NotImplementedError
+
+    def cost_fun_batch(self, designs, verbose=False):
+        """
+        evaluates a whole batch of designs. The testbenches of each design run concurrently on the executor and
+        the cost of a design is computed as soon as all of its simulations are done (see TestbenchScheduler).
+
+        :param designs: sequence of designs as accepted by cost_fun of the core
+        :param verbose: if True will print the design names and the specification performance of each design
+        :return:
+            dict(result_key, np.array) with one entry per design in each column, see result_keys
+        """
+        designs = list(designs)
+        rows = [None for _ in designs]
+        for idx, row in self.cost_fun_iter(designs, verbose=verbose):
+            rows[idx] = row
+        return self.to_columns(rows)
+
+    def cost_fun_iter(self, designs, verbose=False):
+        """
+        streaming version of cost_fun_batch. Designs found in the memo come out first, designs that appear more
+        than once in the batch are only simulated once, and designs that another call (thread, coroutine) is
+        already simulating are waited for instead of simulated again (see single_flight).
+        :return:
+            generator of (design_idx, dict(result_key, value)) in the order the designs finish
+        """
+        designs = list(designs)
+        # dict(memo_key, indices of the designs with that key) of the designs that have to be simulated
+        pending = OrderedDict()
+        for idx, design in enumerate(designs):
+            key = self.memo_key(design)
+            row = self.memo.get(key) if self.memo is not None and key not in pending else None
+            if row is not None:
+                yield idx, row
+            else:
+                pending.setdefault(key, []).append(idx)
+        if not pending:
+            return
+
+        # designs this call simulates (leaders) and designs it waits for
+        leaders, followers = [], dict()
+        for key, indices in pending.items():
+            future, leader = self.single_flight.claim(key, len(indices))
+            if not leader:
+                followers[future] = indices
+                continue
+            # another call may have finished the design since the memo was checked
+            row = self.memo.get(key) if self.memo is not None else None
+            if row is not None:
+                self.single_flight.resolve(key, future, row)
+                for idx in indices:
+                    yield idx, row
+            else:
+                leaders.append((key, indices, future))
+
+        try:
+            states = self.decode_batch([designs[indices[0]] for _, indices, _ in leaders])
+            for group_idx, (row, memoize) in self.scheduler.run_iter(states, self.testbenches,
+                                                                     self._reduce_fn(verbose), verbose=verbose):
+                key, indices, future = leaders[group_idx]
+                if self.memo is not None and memoize:
+                    self.memo.put(key, row)
+                self.single_flight.resolve(key, future, row)
+                for idx in indices:
+                    yield idx, row
+        except BaseException as e:
+            # the waiters of other calls must not hang on designs this call gave up on
+            for key, _, future in leaders:
+                self.single_flight.resolve(key, future, exception=self._abandoned(e))
+            raise
+
+        for future in concurrent.futures.as_completed(followers):
+            row = future.result()
+            for idx in followers[future]:
+                yield idx, row
+
+    @classmethod
+    def _abandoned(cls, exception):
+        if isinstance(exception, Exception):
+            return exception
+        return RuntimeError('the call simulating the design was interrupted (%s)' % type(exception).__name__)
+
+    def cost_fun_submit(self, designs, callback=None, verbose=False):
+        """
+        non-blocking version of cost_fun_batch, the batch is scheduled from a background thread
+        :param callback: if given, called with (design_idx, dict(result_key, value)) as soon as a design is done
+        :return:
+            list of futures that resolve to dict(result_key, value), in the order of designs
+        """
+        designs = list(designs)
+        futures = [concurrent.futures.Future() for _ in designs]
+
+        def consume():
+            done = set()
+            try:
+                for idx, row in self.cost_fun_iter(designs, verbose=verbose):
+                    done.add(idx)
+                    futures[idx].set_result(row)
+                    if callback is not None:
+                        callback(idx, row)
+            except Exception as e:
+                for idx, future in enumerate(futures):
+                    if idx not in done:
+                        future.set_exception(e)
+
+        threading.Thread(target=consume, daemon=True).start()
+        return futures
+
+    async def cost_fun_async(self, design, verbose=False):
+        """
+        coroutine that evaluates a single design, the testbenches of the design are simulated concurrently.
+        Any number of them can be awaited at once (e.g. with asyncio.gather), the number of ngspice processes is
+        bounded by NgSpiceWrapper.async_max_processes.
+        :return: dict(result_key, value)
+        """
+        key = self.memo_key(design)
+        if self.memo is not None:
+            row = self.memo.get(key)
+            if row is not None:
+                return row
+        future, leader = self.single_flight.claim(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            state = self.decode_batch([design])[0]
+            names = list(self.testbenches.keys())
+            outputs = await asyncio.gather(*(self.testbenches[name].simulate_async(state, verbose)
+                                             for name in names))
+            row, memoize = self._reduce_fn(verbose)({name: output[1] for name, output in zip(names, outputs)},
+                                                    {name: output[2] for name, output in zip(names, outputs)})
+        except BaseException as e:
+            self.single_flight.resolve(key, future, exception=self._abandoned(e))
+            raise
+        if self.memo is not None and memoize:
+            self.memo.put(key, row)
+        self.single_flight.resolve(key, future, row)
+        return row
+
+    async def cost_fun_batch_async(self, designs, verbose=False):
+        """
+        coroutine version of cost_fun_batch
+        :return: dict(result_key, np.array) with one entry per design in each column
+        """
+        rows = await asyncio.gather(*(self.cost_fun_async(design, verbose) for design in designs))
+        return self.to_columns(rows)
+
+    def memo_key(self, design):
+        """
+        :return: hashable key of a design for the memo, the tuple of its entries (indices for most cores)
+        """
+        return tuple(np.asarray(design).ravel().tolist())
+
+    def preload_memo(self, designs):
+        """
+        fills the memo with designs evaluated in earlier runs
+        :param designs: (nested lists of) evaluated designs, e.g. the Design objects of a pickled population or
+        history. Their cost and specs (in the order of result_keys) are used, designs with missing values are skipped.
+        :return: number of designs added
+        """
+        if self.memo is None:
+            return 0
+        return self.memo.preload(self._logged_rows(designs))
+
+    def preload_memo_file(self, fname):
+        """
+        same as preload_memo for a pickle file, e.g. genetic_nn/checkpoint/two_stage/init_data.pkl
+        """
+        with open(fname, 'rb') as f:
+            return self.preload_memo(pickle.load(f))
+
+    def _logged_rows(self, designs):
+        for design in designs:
+            if hasattr(design, 'cost') and hasattr(design, 'specs'):
+                values = [design.cost] + list(design.specs.values())
+                if len(values) >= len(self.result_keys) and all(value is not None for value in values):
+                    yield self.memo_key(design), dict(zip(self.result_keys, values))
+            elif isinstance(design, (list, tuple)):
+                yield from self._logged_rows(design)
+
+    def failure_row(self):
+        """
+        :return: the row of a design whose simulation failed or was killed, failure_cost and NaN specs
+        """
+        row = OrderedDict((key, np.nan) for key in self.result_keys)
+        row[self.result_keys[0]] = self.failure_cost
+        return row
+
+    def _reduce_fn(self, verbose):
+        """
+        :return: the reduction of the scheduler, it returns (row, memoize). Designs that timed out or hit an error
+        in any testbench are not memoized, they may well succeed the next time.
+        """
+        def reduce_fn(results, infos):
+            memoize = not any(info in self.testbenches[name].TRANSIENT_INFOS for name, info in infos.items())
+            failed = [name for name, specs in results.items() if specs is None]
+            if failed:
+                if verbose:
+                    print('simulation failed in testbench %s' % ', '.join(failed))
+                return self.failure_row(), memoize
+            return self.evaluate_design(results, verbose=verbose), memoize
+        return reduce_fn
+
+    def to_columns(self, rows):
+        return OrderedDict((key, np.array([row[key] for row in rows])) for key in self.result_keys)
+
+    def close(self):
+        self.executor.shutdown()
+        if self.workspace is not None:
+            self.workspace.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
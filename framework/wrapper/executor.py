@@ -0,0 +1,49 @@
+import concurrent.futures
+import multiprocessing
+
+
+class SimulationExecutor(object):
+    """
+    A persistent pool that runs simulation jobs (create_design_and_simulate calls). It is created once and reused
+    by every run() call, and by every testbench of an evaluation core when they are handed the same instance.
+
+    kind:
+        thread: a thread pool, fine when the backend spends its time in an ngspice subprocess. Not with the shared
+        backend, the threads would take turns on the single libngspice of the process
+        process: a process pool (default start method), parsing and spec extraction run in the workers as well
+        forkserver: same as process but workers are forked from a clean server process
+    """
+
+    KINDS = ('thread', 'process', 'forkserver')
+
+    def __init__(self, num_workers=1, kind='thread'):
+        if kind not in SimulationExecutor.KINDS:
+            raise ValueError('unknown executor kind %s, expected one of %s' % (kind, SimulationExecutor.KINDS))
+        self.num_workers = max(1, num_workers)
+        self.kind = kind
+
+        if kind == 'thread':
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.num_workers)
+        else:
+            mp_context = multiprocessing.get_context('forkserver' if kind == 'forkserver' else None)
+            self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.num_workers,
+                                                                mp_context=mp_context)
+
+    def submit(self, fn, *args, **kwargs):
+        return self._pool.submit(fn, *args, **kwargs)
+
+    def starmap(self, fn, arg_list):
+        """
+        same semantics as multiprocessing.Pool.starmap, results are returned in the order of arg_list
+        """
+        futures = [self.submit(fn, *args) for args in arg_list]
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
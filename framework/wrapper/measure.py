@@ -0,0 +1,320 @@
+"""
+Spec extraction kernels for a whole batch of designs at once. Waveforms are stacked into (n_designs x n_points)
+arrays, real or complex, over a frequency (or time) vector that is either shared by all designs (n_points) or given per
+design (n_designs x n_points). A single design is a batch of one.
+
+Crossings are found by vectorized sign change detection and interpolated inside the bracketing segment only,
+linearly over log frequency (and log magnitude for magnitudes). refine re-solves the crossing of every design
+on a spline of its response, restricted to the bracketing segment, which is what the per design scipy path used to do.
+The spec functions refine by default so they return the values of the scipy path, refine=False is the fast path for
+large batches that can live with the linear interpolation (see benchmarks/measure_benchmark.py).
+"""
+import numpy as np
+import scipy.interpolate as interp
+import scipy.optimize as sciopt
+
+
+def as_batch(x, y):
+    """
+    :return: x and y as (n_designs x n_points) arrays, x broadcast to the shape of y
+    """
+    y = np.atleast_2d(y)
+    x = np.broadcast_to(np.asarray(x, dtype=float), y.shape)
+    return x, y
+
+
+def crossing(x, y, val, log_x=True, log_y=False, refine=False):
+    """
+    first crossing of every row of y through val. Rows that never cross get the end point where y is closest to
+    val, the fallback of the old _get_best_crossing.
+
+    :param x: (n_points) or (n_designs x n_points) increasing, e.g. the frequencies of an ac sweep
+    :param y: (n_designs x n_points) real values
+    :param val: scalar or one value per design
+    :param log_x: interpolate over log10(x)
+    :param log_y: interpolate over log10(y), only for positive y and val (magnitudes)
+    :param refine: solve the crossing on a spline of the whole row instead (slower, spline accurate)
+    :return:
+        x_cross: (n_designs) crossing of every row
+        idx: (n_designs) index of the segment [idx, idx + 1] the crossing is in
+        found: (n_designs) False for the rows that took the fallback
+    """
+    x, y = as_batch(x, y)
+    rows = np.arange(y.shape[0])
+    val = np.broadcast_to(np.asarray(val, dtype=float), rows.shape)
+
+    above = y >= val[:, None]
+    change = above[:, :-1] != above[:, 1:]
+    found = change.any(axis=1)
+    idx = np.argmax(change, axis=1)
+
+    # no crossing: the closer end point, as the segment next to it with the interpolation weight at its end
+    closer_first = np.abs(y[:, 0] - val) < np.abs(y[:, -1] - val)
+    last = y.shape[1] - 2
+    idx = np.where(found, idx, np.where(closer_first, 0, last))
+
+    x0, x1 = x[rows, idx], x[rows, idx + 1]
+    y0, y1, target = y[rows, idx], y[rows, idx + 1], val
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if log_y:
+            y0, y1, target = np.log10(y0), np.log10(y1), np.log10(val)
+        weight = np.where(found, (target - y0) / (y1 - y0), np.where(closer_first, 0.0, 1.0))
+    x_cross = _interpolate(x0, x1, weight, log_x)
+
+    if refine:
+        for row in np.flatnonzero(found):
+            spline = interp.InterpolatedUnivariateSpline(x[row], y[row] - val[row])
+            try:
+                x_cross[row] = sciopt.brentq(spline, x0[row], x1[row])
+            except ValueError:
+                # the spline does not change sign exactly at the data points, keep the interpolated crossing
+                pass
+    return x_cross, idx, found
+
+
+def sample(x, y, x_at, idx, log_x=True, refine=False):
+    """
+    values of every row of y at x_at, interpolated inside the segments idx found by crossing
+
+    :param refine: use a quadratic interpolation of the whole row instead, like the old phase margin computation
+    :return: (n_designs) values
+    """
+    x, y = as_batch(x, y)
+    rows = np.arange(y.shape[0])
+    if refine:
+        return np.array([interp.interp1d(x[row], y[row], kind='quadratic')(x_at[row]) for row in rows])
+
+    x0, x1 = x[rows, idx], x[rows, idx + 1]
+    if log_x:
+        weight = (np.log10(x_at) - np.log10(x0)) / (np.log10(x1) - np.log10(x0))
+    else:
+        weight = (x_at - x0) / (x1 - x0)
+    return y[rows, idx] + weight * (y[rows, idx + 1] - y[rows, idx])
+
+
+def _interpolate(x0, x1, weight, log_x):
+    if log_x:
+        return 10 ** (np.log10(x0) + weight * (np.log10(x1) - np.log10(x0)))
+    return x0 + weight * (x1 - x0)
+
+
+def dc_gain(vout):
+    """
+    :return: (n_designs) magnitude at the first point of the sweep
+    """
+    return np.abs(np.atleast_2d(vout)[:, 0])
+
+
+def phase(vout):
+    """
+    :return: (n_designs x n_points) unwrapped phase in degrees
+    """
+    return np.rad2deg(np.unwrap(np.angle(np.atleast_2d(vout)), axis=1))
+
+
+def unity_gain_frequency(freq, vout, refine=True):
+    """
+    :return: (n_designs) frequency where the magnitude crosses 1
+    """
+    ugbw, _, _ = crossing(freq, np.abs(np.atleast_2d(vout)), 1.0, log_y=True, refine=refine)
+    return ugbw
+
+
+def phase_margin(freq, vout, refine=True):
+    """
+    :return: (n_designs) phase margin in degrees at the unity gain frequency, NaN for designs whose phase starts
+    above 0 (the responses are expected to be inverting or to start at 0 degrees)
+    """
+    return ac_specs(freq, vout, refine=refine)['phm']
+
+
+def bandwidth_3db(freq, vout, refine=True):
+    """
+    :return: (n_designs) frequency where the magnitude falls to the dc gain / sqrt(2)
+    """
+    gain = np.abs(np.atleast_2d(vout))
+    bw, _, _ = crossing(freq, gain, gain[:, 0] / np.sqrt(2), log_y=True, refine=refine)
+    return bw
+
+
+def rejection_ratio(gain, other_gain):
+    """
+    CMRR or PSRR in dB
+    :param gain: differential dc gain, e.g. dc_gain of the open loop responses
+    :param other_gain: common mode or power supply dc gain
+    """
+    return 20 * np.log10(np.asarray(gain) / np.asarray(other_gain))
+
+
+def ac_specs(freq, vout, refine=True):
+    """
+    dc gain, unity gain frequency and phase margin of open loop responses, sharing the crossing between the last two
+    :return: dict(gain, ugbw, phm) of (n_designs) arrays
+    """
+    freq, vout = as_batch(freq, vout)
+    gain = np.abs(vout)
+    ugbw, idx, _ = crossing(freq, gain, 1.0, log_y=True, refine=refine)
+    phases = phase(vout)
+    phase_ugbw = sample(freq, phases, ugbw, idx, refine=refine)
+    phm = np.where(phase_ugbw > 0, phase_ugbw - 180, phase_ugbw + 180)
+    phm = np.where(phases[:, 0] <= 0, phm, np.nan)
+    return dict(gain=gain[:, 0], ugbw=ugbw, phm=phm)
+
+
+# transient kernels, (n_designs x n_samples) matrices over a time axis that can differ per design. Transients of
+# different lengths are stacked with stack, the missing samples at the end of the shorter rows are NaN.
+
+def stack(rows):
+    """
+    :param rows: sequence of 1-d waveforms, possibly of different lengths
+    :return:
+        matrix: (n_designs x longest length) with NaN after the end of each row
+        lengths: (n_designs) number of samples of each row
+    """
+    lengths = np.array([len(row) for row in rows])
+    matrix = np.full((len(rows), lengths.max()), np.nan)
+    for i, row in enumerate(rows):
+        matrix[i, :lengths[i]] = row
+    return matrix, lengths
+
+
+def _lengths(y, lengths):
+    if lengths is None:
+        return np.full(y.shape[0], y.shape[1])
+    return np.asarray(lengths)
+
+
+def _last_true(mask):
+    """
+    :return: index of the last True of every row, -1 for the rows without any
+    """
+    last = mask.shape[1] - 1 - np.argmax(mask[:, ::-1], axis=1)
+    return np.where(mask.any(axis=1), last, -1)
+
+
+def last_values(y, lengths=None):
+    """
+    :return: (n_designs) last valid sample of every row
+    """
+    y = np.atleast_2d(y)
+    return y[np.arange(y.shape[0]), _lengths(y, lengths) - 1]
+
+
+def settling_time(t, vout, vin, fbck, tot_err=0.1, lengths=None, refine=True):
+    """
+    time at which the step responses enter the tot_err band around their final value for good, the final value
+    being the one of the ideal closed loop output vin / fbck. Designs that are still outside the band at the end of
+    the transient get the last time point.
+
+    :param t: (n_samples) or (n_designs x n_samples)
+    :param vout: (n_designs x n_samples)
+    :param vin: (n_designs x n_samples)
+    :param lengths: valid samples of every row, for NaN padded matrices (see stack)
+    :param refine: solve the band exit on a cubic spline of the samples around it instead of a straight line
+    :return: (n_designs) settling times
+    """
+    t, vout = as_batch(t, vout)
+    vin = np.atleast_2d(vin)
+    rows = np.arange(vout.shape[0])
+    lengths = _lengths(vout, lengths)
+    valid = np.arange(vout.shape[1]) < lengths[:, None]
+
+    # step response normalized to the step of the ideal output, 1 once settled
+    ref_step = (last_values(vin, lengths) - vin[:, 0]) / fbck
+    y = (vout - vout[:, :1]) / ref_step[:, None]
+
+    with np.errstate(invalid='ignore'):
+        last_low = _last_true(valid & (y < 1.0 - tot_err))
+        last_high = _last_true(valid & (y > 1.0 + tot_err))
+    # the last sample outside the band and the edge of the band it crosses on its way in
+    high = last_high > last_low
+    idx = np.where(high, last_high, last_low)
+    edge = np.where(high, 1.0 + tot_err, 1.0 - tot_err)
+
+    settled = (idx >= 0) & (idx < lengths - 1)
+    seg = np.clip(idx, 0, vout.shape[1] - 2)
+    t0, t1 = t[rows, seg], t[rows, seg + 1]
+    y0, y1 = y[rows, seg], y[rows, seg + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tset = t0 + (edge - y0) / (y1 - y0) * (t1 - t0)
+    if refine:
+        for row in np.flatnonzero(settled):
+            # a few samples on both sides of the exit are enough for the spline
+            start = max(seg[row] - 3, 0)
+            stop = min(seg[row] + 5, lengths[row])
+            spline = interp.InterpolatedUnivariateSpline(t[row, start:stop], y[row, start:stop] - edge[row])
+            try:
+                tset[row] = sciopt.brentq(spline, t0[row], t1[row])
+            except ValueError:
+                pass
+
+    never_left = idx < 0
+    return np.where(settled, tset, np.where(never_left, t[:, 0], t[rows, lengths - 1]))
+
+
+def offset(vout, vin, fbck):
+    """
+    :return: (n_designs) systematic offset, the difference between the output and the ideal closed loop output at
+    the first time point
+    """
+    return np.abs(np.atleast_2d(vout)[:, 0] - np.atleast_2d(vin)[:, 0] / fbck)
+
+
+def sample_at(t, y, times, lengths=None, refine=True):
+    """
+    values of the waveforms at given times, e.g. the sampling instants of a comparator
+
+    :param t: (n_samples) or (n_designs x n_samples)
+    :param y: (n_designs x n_samples)
+    :param times: (n_times) instants, the same for every design
+    :param refine: quadratic interpolation through the three samples around every instant instead of a straight line
+    :return: (n_designs x n_times) values
+    """
+    t, y = as_batch(t, y)
+    rows = np.arange(y.shape[0])[:, None]
+    lengths = _lengths(y, lengths)
+    times = np.atleast_1d(np.asarray(times, dtype=float))
+
+    # segment [idx, idx + 1] holding each instant, NaN padding compares False
+    with np.errstate(invalid='ignore'):
+        idx = (t[:, :, None] <= times[None, None, :]).sum(axis=1) - 1
+    idx = np.clip(idx, 0, (lengths - 2)[:, None])
+    t0, t1 = t[rows, idx], t[rows, idx + 1]
+    y0, y1 = y[rows, idx], y[rows, idx + 1]
+    if not refine:
+        return y0 + (times - t0) / (t1 - t0) * (y1 - y0)
+
+    # Lagrange polynomial through the samples idx - 1, idx, idx + 1 (idx, idx + 1, idx + 2 at the start)
+    mid = np.clip(idx, 1, (lengths - 2)[:, None])
+    ta, tb, tc = t[rows, mid - 1], t[rows, mid], t[rows, mid + 1]
+    ya, yb, yc = y[rows, mid - 1], y[rows, mid], y[rows, mid + 1]
+    return (ya * (times - tb) * (times - tc) / ((ta - tb) * (ta - tc)) +
+            yb * (times - ta) * (times - tc) / ((tb - ta) * (tb - tc)) +
+            yc * (times - ta) * (times - tb) / ((tc - ta) * (tc - tb)))
+
+
+def mean(y, lengths=None):
+    """
+    :return: (n_designs) mean over the valid samples of every row
+    """
+    y = np.atleast_2d(y)
+    valid = np.arange(y.shape[1]) < _lengths(y, lengths)[:, None]
+    return np.where(valid, y, 0.0).sum(axis=1) / valid.sum(axis=1)
+
+
+def time_average(t, y, lengths=None):
+    """
+    average over time of the valid samples of every row, the trapezoidal integral divided by the time span. This is
+    what meas avg of ngspice returns, the time steps of a transient are not uniform so mean would weight the busy
+    parts of the waveform more
+
+    :param t: (n_samples) or (n_designs x n_samples)
+    :param y: (n_designs x n_samples)
+    :return: (n_designs) averages
+    """
+    t, y = as_batch(t, y)
+    lengths = _lengths(y, lengths)
+    # segment [k, k + 1] is valid if both of its samples are, NaN padding is masked out before summing
+    valid = np.arange(1, y.shape[1]) < lengths[:, None]
+    areas = np.where(valid, 0.5 * (y[:, 1:] + y[:, :-1]) * np.diff(t, axis=1), 0.0)
+    return areas.sum(axis=1) / (last_values(t, lengths) - t[:, 0])
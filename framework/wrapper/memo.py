@@ -0,0 +1,93 @@
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class CostMemo(object):
+    """
+    In-memory LRU memo of evaluated designs, keyed by the tuple of design indices. Values are the result rows of
+    an evaluation core, dict(result_key, value).
+
+    The memo is bounded by max_entries and/or max_bytes (estimated size of the rows), None means unbounded.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def row_size(cls, row):
+        size = sys.getsizeof(row)
+        for value in row.values():
+            size += value.nbytes if isinstance(value, np.ndarray) else sys.getsizeof(value)
+        return size
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def get(self, key):
+        """
+        :return: the memoized row of the design, None if it was not evaluated yet
+        """
+        with self._lock:
+            entry = self._rows.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._rows.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, row):
+        size = self.row_size(row)
+        with self._lock:
+            if key in self._rows:
+                self.nbytes -= self._rows.pop(key)[1]
+            self._rows[key] = (row, size)
+            self.nbytes += size
+            while self._rows and ((self.max_entries is not None and len(self._rows) > self.max_entries) or
+                                  (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                _, (_, evicted_size) = self._rows.popitem(last=False)
+                self.nbytes -= evicted_size
+                self.evictions += 1
+
+    def preload(self, items):
+        """
+        :param items: iterable of (key, row), e.g. designs evaluated in earlier runs
+        :return: number of rows added
+        """
+        count = 0
+        for key, row in items:
+            self.put(key, row)
+            count += 1
+        return count
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, hit_rate=self.hits / lookups if lookups else 0.0,
+                    evictions=self.evictions, entries=len(self._rows), bytes=self.nbytes)
@@ -0,0 +1,144 @@
+import io
+import os
+import re
+
+
+class NetlistTemplate(object):
+    """
+    A netlist parsed once into literal text and slots, so that a design is rendered with a single join instead of
+    rewriting the template lines with regular expressions on every call.
+
+    slots:
+        param: the value of a name=value assignment on a .param line, filled from the state (or the template default)
+        output: the file name of a wrdata command, filled with the path of the output inside the design folder. Same
+        for the .meas files that the measurements of a testbench are printed to (see NgSpiceWrapper.MEASUREMENTS),
+        those are plain text whatever the output format.
+    """
+
+    PARAM_REGEX = re.compile(r"(\w+)=(\S+)")
+    WRDATA_REGEX = re.compile(r"wrdata\s*(\w+\.\w+)\s*")
+    # redirection of a command (echo, print) into a measurement file
+    MEAS_REGEX = re.compile(r">>?\s*(\w+\.meas)\s*$")
+    # a number with an optional scale factor (and unit, which is ignored), or a parameter name
+    TOKEN_REGEX = re.compile(r"(?P<number>(?:\d+\.?\d*|\.\d+)(?:e[-+]?\d+)?)(?P<scale>meg|[tgkmunpf])?[a-z]*|"
+                             r"(?P<name>[a-z_]\w*)", re.IGNORECASE)
+    SCALES = dict(t=1e12, g=1e9, meg=1e6, k=1e3, m=1e-3, u=1e-6, n=1e-9, p=1e-12, f=1e-15)
+
+    def __init__(self, lines, output_format='csv', output_file=None):
+        """
+        :param lines: template lines
+        :param output_format: csv keeps the wrdata commands, raw turns them into binary rawfile writes
+        :param output_file: maps the file name of a wrdata command to the one written in the design folder
+        """
+        self.output_format = output_format
+        self.output_file = output_file
+        # literal text with None where a slot goes, slots are (position, kind, name, default)
+        self._parts = []
+        self._slots = []
+        self.defaults = dict()
+        self.output_fnames = []
+
+        for line in lines:
+            if '.param' in line:
+                self._compile_params(line)
+            elif self.WRDATA_REGEX.search(line):
+                self._compile_output(line)
+            elif self.MEAS_REGEX.search(line):
+                self._compile_measurement(line)
+            else:
+                self._parts.append(line)
+                if output_format == 'raw' and line.strip().lower().startswith('.control'):
+                    self._parts.append('set filetype=binary\n')
+
+        self.param_names = frozenset(self.defaults)
+
+    def _add_slot(self, kind, name, default=None):
+        self._slots.append((len(self._parts), kind, name, default))
+        self._parts.append(None)
+
+    def _compile_params(self, line):
+        start = 0
+        for found in self.PARAM_REGEX.finditer(line):
+            name, default = found.group(1), found.group(2)
+            self._parts.append(line[start:found.start(2)])
+            self._add_slot('param', name, default)
+            self.defaults[name] = default
+            start = found.end(2)
+        self._parts.append(line[start:])
+
+    def _compile_output(self, line):
+        found = self.WRDATA_REGEX.search(line)
+        fname = found.group(1)
+        if self.output_format == 'raw':
+            self._parts.append(line[:found.start()] + 'write ')
+            self._add_slot('output', fname)
+            self._parts.append(' ' + line[found.end():])
+        else:
+            self._parts.append(line[:found.start(1)])
+            self._add_slot('output', fname)
+            self._parts.append(line[found.end(1):])
+        self.output_fnames.append(fname)
+
+    def _compile_measurement(self, line):
+        found = self.MEAS_REGEX.search(line)
+        fname = found.group(1)
+        self._parts.append(line[:found.start(1)])
+        self._add_slot('output', fname)
+        self._parts.append(line[found.end(1):])
+        if fname not in self.output_fnames:
+            self.output_fnames.append(fname)
+
+    def check_state(self, state):
+        """
+        raises ValueError if the state sets parameters that are not defined in the template
+        """
+        unknown = set(state) - self.param_names
+        if unknown:
+            raise ValueError('parameters %s are not defined in the netlist (known parameters: %s)'
+                             % (sorted(unknown), sorted(self.param_names)))
+
+    def evaluate(self, text, state=None):
+        """
+        numeric value of a netlist field, a number with scale factor (1u, 10p) or an expression of the parameters
+        in braces ({10*Tper}), the parameters taking their values from the state or the template defaults
+        """
+        params = dict(self.defaults)
+        params.update(state or {})
+
+        def replace(found):
+            if found.group('name') is not None:
+                if found.group('name') not in params:
+                    raise ValueError('%s is not a parameter of the netlist' % found.group('name'))
+                return repr(self.evaluate(str(params[found.group('name')]), state))
+            scale = found.group('scale')
+            return repr(float(found.group('number')) * (self.SCALES[scale.lower()] if scale else 1.0))
+
+        expression = self.TOKEN_REGEX.sub(replace, text.strip().strip('{}'))
+        return float(eval(expression, {'__builtins__': {}}, {}))
+
+    def render(self, state, design_folder):
+        """
+        :param state: dict(param_kwds, param_value)
+        :param design_folder: folder the outputs are written to
+        :return: the netlist of the design as a single string
+        """
+        self.check_state(state)
+        parts = list(self._parts)
+        for position, kind, name, default in self._slots:
+            if kind == 'param':
+                parts[position] = str(state[name]) if name in state else default
+            else:
+                fname = self.output_file(name) if self.output_file is not None else name
+                parts[position] = os.path.join(design_folder, fname)
+        return ''.join(parts)
+
+    def render_buffer(self, state, design_folder):
+        """
+        same as render but returns an in-memory text buffer, for backends that do not need a netlist on disk
+        """
+        return io.StringIO(self.render(state, design_folder))
+
+    def write(self, fpath, state, design_folder):
+        with open(fpath, 'w') as f:
+            f.write(self.render(state, design_folder))
+        return fpath
@@ -0,0 +1,241 @@
+import atexit
+import os
+import queue
+import selectors
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from framework.wrapper.ngspice_wrapper import NgSpiceWrapper
+
+debug = False
+
+
+class NgSpiceProcess(object):
+    """
+    A long lived ngspice process driven through its stdin in pipe mode (ngspice -p).
+    The circuit is sourced once when the process starts, after that every design is a handful of
+    alterparam/reset/run commands. The end of a job is detected by echoing a sentinel line.
+    """
+
+    SENTINEL = '__ngspice_pool_done__'
+
+    def __init__(self, circuit_lines, worker_id=0, timeout=300):
+        self.worker_id = worker_id
+        self.timeout = timeout
+        self.n_jobs = 0
+        self.n_failures = 0
+        self.n_timeouts = 0
+        self.n_restarts = 0
+        self.busy_time = 0.0
+        self.start_time = time.time()
+
+        fd, self.circuit_fname = tempfile.mkstemp(prefix='ngspice_pool_', suffix='.cir')
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(circuit_lines)
+
+        self._proc = None
+        self._selector = None
+        self.start()
+
+    def start(self):
+        # stdout of ngspice is block buffered when it is not a tty, force line buffering when possible
+        cmd = ['ngspice', '-p']
+        if shutil.which('stdbuf'):
+            cmd = ['stdbuf', '-oL'] + cmd
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT, bufsize=0)
+        self._buffer = b''
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._proc.stdout, selectors.EVENT_READ)
+        self._send(['set noaskquit', 'source %s' % self.circuit_fname])
+        ok, _ = self._wait_for_sentinel()
+        if not ok:
+            raise RuntimeError('ngspice worker %d failed to load %s' % (self.worker_id, self.circuit_fname))
+
+    def restart(self):
+        self.kill()
+        self.n_restarts += 1
+        self.start()
+
+    def kill(self):
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+        if self._selector is not None:
+            self._selector.close()
+        self._proc = None
+        self._selector = None
+
+    def close(self):
+        if self._proc is not None and self._proc.poll() is None:
+            try:
+                self._proc.stdin.write(b'quit\n')
+                self._proc.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        self.kill()
+        if os.path.isfile(self.circuit_fname):
+            os.remove(self.circuit_fname)
+
+    def _send(self, commands):
+        job = '\n'.join(commands + ['echo %s' % self.SENTINEL]) + '\n'
+        self._proc.stdin.write(job.encode())
+
+    def _readline(self, deadline):
+        """
+        reads one line of output without blocking past the deadline
+        :return: the line, or None on timeout or if the process exited
+        """
+        while b'\n' not in self._buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self._selector.select(timeout=remaining):
+                return None
+            chunk = os.read(self._proc.stdout.fileno(), 4096)
+            if not chunk:
+                return None
+            self._buffer += chunk
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return line.decode(errors='replace')
+
+    def _wait_for_sentinel(self):
+        """
+        reads the output until the sentinel shows up.
+        :return:
+            ok: False if the process died or did not answer within the timeout
+            errors: the error lines ngspice printed on the way
+        """
+        errors = []
+        deadline = time.time() + self.timeout
+        while True:
+            line = self._readline(deadline)
+            if line is None:
+                return False, errors
+            line = line.strip()
+            if debug:
+                print('[worker %d] %s' % (self.worker_id, line))
+            if line == self.SENTINEL:
+                return True, errors
+            if line.lower().startswith('error'):
+                errors.append(line)
+
+    def run_job(self, state, commands):
+        """
+        :param state: dict(param_kwds, param_value)
+        :param commands: the control commands of the testbench
+        :return:
+            info: INFO_OK, INFO_TIMEOUT if the worker did not answer within the timeout or INFO_ERROR otherwise
+        """
+        job_start = time.time()
+        job = ['alterparam %s=%s' % (key, str(value)) for key, value in state.items()]
+        job += ['reset'] + commands
+        try:
+            self._send(job)
+            ok, errors = self._wait_for_sentinel()
+        except OSError:
+            ok, errors = False, []
+
+        if ok:
+            info = NgSpiceWrapper.INFO_OK if not errors else NgSpiceWrapper.INFO_ERROR
+        else:
+            # a process that used up the timeout hangs on a non-convergent design, otherwise it crashed
+            timed_out = time.time() - job_start >= self.timeout
+            info = NgSpiceWrapper.INFO_TIMEOUT if timed_out else NgSpiceWrapper.INFO_ERROR
+            # get a fresh process for the next job
+            self.restart()
+
+        self.n_jobs += 1
+        self.n_failures += info != NgSpiceWrapper.INFO_OK
+        self.n_timeouts += info == NgSpiceWrapper.INFO_TIMEOUT
+        self.busy_time += time.time() - job_start
+        return info
+
+    def stats(self):
+        wall_time = time.time() - self.start_time
+        return dict(
+            worker_id=self.worker_id,
+            n_jobs=self.n_jobs,
+            n_failures=self.n_failures,
+            n_timeouts=self.n_timeouts,
+            n_restarts=self.n_restarts,
+            busy_time=self.busy_time,
+            jobs_per_sec=self.n_jobs / self.busy_time if self.busy_time > 0 else 0.0,
+            utilization=self.busy_time / wall_time if wall_time > 0 else 0.0,
+        )
+
+
+class NgSpiceWorkerPool(object):
+    """
+    A fixed set of NgSpiceProcess workers that all hold the same testbench. Jobs block until a worker is idle.
+    """
+
+    def __init__(self, circuit_lines, size=1, timeout=300):
+        self.size = size
+        self.workers = [NgSpiceProcess(circuit_lines, worker_id=i, timeout=timeout) for i in range(size)]
+        self._idle = queue.Queue()
+        for worker in self.workers:
+            self._idle.put(worker)
+
+    def run_job(self, state, commands):
+        worker = self._idle.get()
+        try:
+            return worker.run_job(state, commands)
+        finally:
+            self._idle.put(worker)
+
+    def stats(self):
+        return [worker.stats() for worker in self.workers]
+
+    def report(self):
+        for worker_stats in self.stats():
+            print('[worker %(worker_id)d] jobs=%(n_jobs)d failures=%(n_failures)d timeouts=%(n_timeouts)d restarts=%(n_restarts)d '
+                  'throughput=%(jobs_per_sec).2f jobs/s utilization=%(utilization).2f' % worker_stats)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+
+# pools are shared by every wrapper of the same testbench in this process and live until the interpreter exits
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_worker_pool(key, circuit_lines, size=1, timeout=300):
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = NgSpiceWorkerPool(circuit_lines, size=size, timeout=timeout)
+            _pools[key] = pool
+        return pool
+
+
+def close_worker_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+atexit.register(close_worker_pools)
+
+
+class PoolBackend(object):
+    """
+    Runs the testbench of a wrapper on a persistent NgSpiceWorkerPool. Outputs are written by the wrdata commands
+    into the design folder, exactly as in batch mode.
+    """
+
+    def __init__(self, wrapper):
+        key = (wrapper.base_design_name, ''.join(wrapper.circuit_lines))
+        # a worker that does not answer within the wall-clock limit is restarted, the job then times out
+        timeout = wrapper.wall_timeout if wrapper.wall_timeout is not None else 300
+        self.pool = get_worker_pool(key, wrapper.circuit_lines, size=max(1, wrapper.num_process), timeout=timeout)
+        self.wrapper = wrapper
+
+    def simulate(self, state, design_folder):
+        commands = [line.strip() for line in self.wrapper.get_control_commands(design_folder)]
+        info = self.pool.run_job(state, [cmd for cmd in commands if cmd and not cmd.startswith('*')])
+        return info, None
@@ -0,0 +1,258 @@
+import ctypes
+import ctypes.util
+import os
+import re
+import threading
+
+import numpy as np
+
+from framework.wrapper.netlist_template import NetlistTemplate
+
+debug = False
+
+# Each wrdata argument is either a plain vector or a {...} expression
+WRDATA_ARG_REGEX = re.compile(r"\{[^}]*\}|\S+")
+
+# Name of the scale vector for each kind of plot ngspice creates
+PLOT_SCALES = dict(
+    tran='time',
+    ac='frequency',
+    noise='frequency',
+    sp='frequency',
+)
+
+
+class NgComplex(ctypes.Structure):
+    _fields_ = [
+        ('cx_real', ctypes.c_double),
+        ('cx_imag', ctypes.c_double),
+    ]
+
+
+class VectorInfo(ctypes.Structure):
+    _fields_ = [
+        ('v_name', ctypes.c_char_p),
+        ('v_type', ctypes.c_int),
+        ('v_flags', ctypes.c_short),
+        ('v_realdata', ctypes.POINTER(ctypes.c_double)),
+        ('v_compdata', ctypes.POINTER(NgComplex)),
+        ('v_length', ctypes.c_int),
+    ]
+
+
+SendChar = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p)
+SendStat = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p)
+ControlledExit = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_int, ctypes.c_bool, ctypes.c_bool, ctypes.c_int,
+                                  ctypes.c_void_p)
+SendData = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_void_p)
+SendInitData = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p)
+BGThreadRunning = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_bool, ctypes.c_int, ctypes.c_void_p)
+
+
+class NgSpiceShared(object):
+    """
+    Thin ctypes binding around libngspice.
+
+    The library keeps global state, so there is exactly one instance per process (see get_instance). Every
+    circuit loaded through it stays resident together with the models it includes, which is what makes
+    repeated simulations cheap. Calls are serialized by its lock, simulations run in parallel only across processes
+    (process or forkserver executor).
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, library_path=None):
+        if library_path is None:
+            library_path = os.environ.get('NGSPICE_LIBRARY_PATH') or ctypes.util.find_library('ngspice')
+        if library_path is None:
+            raise RuntimeError('could not find libngspice, set NGSPICE_LIBRARY_PATH')
+
+        self.lock = threading.RLock()
+        self.alive = True
+        self._errors = []
+        self._circuits = []
+
+        self._lib = ctypes.CDLL(library_path)
+        self._lib.ngSpice_Command.argtypes = [ctypes.c_char_p]
+        self._lib.ngSpice_Circ.argtypes = [ctypes.POINTER(ctypes.c_char_p)]
+        self._lib.ngGet_Vec_Info.argtypes = [ctypes.c_char_p]
+        self._lib.ngGet_Vec_Info.restype = ctypes.POINTER(VectorInfo)
+        self._lib.ngSpice_CurPlot.restype = ctypes.c_char_p
+
+        # keep references to the callbacks, otherwise they are garbage collected while ngspice still uses them
+        self._send_char = SendChar(self._on_send_char)
+        self._send_stat = SendStat(self._on_send_stat)
+        self._controlled_exit = ControlledExit(self._on_controlled_exit)
+        self._lib.ngSpice_Init(self._send_char, self._send_stat, self._controlled_exit,
+                               None, None, None, None)
+
+    @classmethod
+    def get_instance(cls, library_path=None):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(library_path)
+            return cls._instance
+
+    def _on_send_char(self, output, lib_id, user_data):
+        line = output.decode(errors='replace')
+        if line.startswith('stderr'):
+            line = line[len('stderr'):].strip()
+            if line.lower().startswith('error'):
+                self._errors.append(line)
+        if debug:
+            print(line)
+        return 0
+
+    def _on_send_stat(self, status, lib_id, user_data):
+        return 0
+
+    def _on_controlled_exit(self, status, unload, quit_exit, lib_id, user_data):
+        # ngspice hit a fatal error and wants the host to unload it, we can't recover in this process
+        self.alive = False
+        self._errors.append('ngspice requested exit with status %d' % status)
+        return status
+
+    def pop_errors(self):
+        errors, self._errors = self._errors, []
+        return errors
+
+    def command(self, cmd):
+        if not self.alive:
+            raise RuntimeError('ngspice shared library is no longer usable in this process')
+        if debug:
+            print(cmd)
+        return self._lib.ngSpice_Command(cmd.encode())
+
+    def load_circuit(self, key, lines):
+        """
+        loads a circuit once and remembers it under key so that it can be selected again later on.
+        :param key: any hashable identifier for the circuit
+        :param lines: netlist lines (without a .control section)
+        """
+        circ_lines = [line.rstrip('\n').encode() for line in lines] + [None]
+        circ_array = (ctypes.c_char_p * len(circ_lines))(*circ_lines)
+        self._lib.ngSpice_Circ(circ_array)
+        self._circuits.append(key)
+
+    def has_circuit(self, key):
+        return key in self._circuits
+
+    def select_circuit(self, key):
+        # ngspice prepends newly loaded circuits, so setcirc counts them from the most recent one
+        setcirc_idx = len(self._circuits) - self._circuits.index(key)
+        self.command('setcirc %d' % setcirc_idx)
+
+    def current_plot(self):
+        return self._lib.ngSpice_CurPlot().decode()
+
+    def get_vector(self, name):
+        info_ptr = self._lib.ngGet_Vec_Info(name.encode())
+        if not info_ptr:
+            raise KeyError('vector %s does not exist' % name)
+        info = info_ptr.contents
+        if info.v_realdata:
+            return np.ctypeslib.as_array(info.v_realdata, shape=(info.v_length,)).copy()
+        comp_data = np.ctypeslib.as_array(info.v_compdata, shape=(info.v_length,))
+        return comp_data['cx_real'] + 1j * comp_data['cx_imag']
+
+
+class SharedBackend(object):
+    """
+    Runs the testbench of a wrapper inside the ngspice shared library. The circuit is loaded once per process,
+    every design only swaps the parameters (alterparam + reset) and re-runs the control commands. wrdata commands
+    are not executed, the same columns are instead pulled out of memory and handed back to the wrapper. So are the
+    measurements printed to .meas files in measurement mode.
+    """
+
+    def __init__(self, wrapper, library_path=None):
+        self.ngspice = NgSpiceShared.get_instance(library_path)
+        self.circuit_key = (wrapper.base_design_name, ''.join(wrapper.circuit_lines))
+        self.circuit_lines = wrapper.circuit_lines
+        self.control_lines = wrapper.control_lines
+
+    def simulate(self, state, design_folder):
+        """
+        :param state: dict(param_kwds, param_value)
+        :param design_folder: not used, the outputs never touch the disk
+        :return:
+            info: 0 if no error occurred, 1 otherwise
+            outputs: dict(wrdata_fname, np.array with the same columns wrdata would have written) and
+            dict(meas_fname, dict(name, value)) for the measurements
+        """
+        ngspice = self.ngspice
+        outputs = {}
+        with ngspice.lock:
+            try:
+                if not ngspice.has_circuit(self.circuit_key):
+                    ngspice.load_circuit(self.circuit_key, self.circuit_lines)
+                else:
+                    ngspice.select_circuit(self.circuit_key)
+                ngspice.pop_errors()
+
+                for key, value in state.items():
+                    ngspice.command('alterparam %s=%s' % (key, str(value)))
+                ngspice.command('reset')
+
+                for line in self.control_lines:
+                    cmd = line.strip()
+                    if not cmd or cmd.startswith('*'):
+                        continue
+                    meas_found = NetlistTemplate.MEAS_REGEX.search(cmd)
+                    if cmd.startswith('wrdata'):
+                        fname, vec_exprs = self.parse_wrdata(cmd)
+                        outputs[fname] = self.capture(vec_exprs)
+                    elif meas_found is not None:
+                        measurements = outputs.setdefault(meas_found.group(1), dict())
+                        if cmd.startswith('print'):
+                            for name in cmd[len('print'):meas_found.start()].split():
+                                self.capture_scalar(name, measurements)
+                    else:
+                        ngspice.command(cmd)
+            except (RuntimeError, KeyError) as e:
+                if debug:
+                    print(e)
+                return 1, outputs
+            info = 1 if ngspice.pop_errors() else 0
+        return info, outputs
+
+    @classmethod
+    def parse_wrdata(cls, cmd):
+        args = WRDATA_ARG_REGEX.findall(cmd)[1:]
+        fname = args[0]
+        vec_exprs = [arg.strip('{}') for arg in args[1:]]
+        return fname, vec_exprs
+
+    def capture_scalar(self, name, measurements):
+        """
+        adds the value of a scalar vector of the current plot to measurements, measurements that failed did not
+        create their vector and are left out
+        """
+        try:
+            value = self.ngspice.get_vector(name)
+        except KeyError:
+            return
+        measurements[name.lower()] = float(np.real(value[0]))
+
+    def capture(self, vec_exprs):
+        """
+        collects the vectors of the current plot into the same layout wrdata uses:
+        for every vector a scale column followed by one (real) or two (complex) value columns.
+        """
+        ngspice = self.ngspice
+        plot_type = re.sub(r'\d+$', '', ngspice.current_plot())
+        scale = None
+        if plot_type in PLOT_SCALES:
+            scale = ngspice.get_vector(PLOT_SCALES[plot_type])
+
+        columns = []
+        for i, expr in enumerate(vec_exprs):
+            vec_name = '_wrdata%d' % i
+            ngspice.command('let %s = %s' % (vec_name, expr))
+            vec = ngspice.get_vector(vec_name)
+            columns.append(scale if scale is not None else np.arange(vec.size, dtype=float))
+            if np.iscomplexobj(vec):
+                columns += [vec.real, vec.imag]
+            else:
+                columns.append(vec)
+        return np.column_stack(columns)
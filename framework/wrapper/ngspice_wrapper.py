@@ -1,14 +1,35 @@
 import re
 import numpy as np
 import copy
-from multiprocessing.dummy import Pool as ThreadPool
+import json
 import os
 import abc
 import scipy.interpolate as interp
 import scipy.optimize as sciopt
 import random
 import time
+import math
+import signal
+import resource
+import subprocess
 import pprint
+import tempfile
+import threading
+import concurrent.futures
+import asyncio
+import weakref
+from collections import OrderedDict
+
+import sys
+sys.path.append('./')
+from framework.wrapper.executor import SimulationExecutor
+from framework.wrapper.autotune import DeckSizeTuner
+from framework.wrapper.rawfile import Vectors, read_raw
+from framework.wrapper import measure
+from framework.wrapper.netlist_template import NetlistTemplate
+from framework.wrapper.sim_cache import SimulationCache, model_files
+from framework.wrapper.design_id import DesignIndex, design_id, shard_path
+from framework.wrapper.evaluation_core import EvaluationCoreBase
 
 debug = False
 
@@ -16,81 +37,761 @@ class NgSpiceWrapper(object):
 
     BASE_TMP_DIR = os.path.abspath("/tmp/circuit_drl")
 
-    def __init__(self, num_process, design_netlist):
+    # simulation backends that can be selected with the backend keyword (backend: in the yaml files)
+    # batch: one ngspice -b subprocess per design
+    # shared: libngspice loaded once per process, models stay resident and only parameters are swapped. The library
+    # runs one simulation at a time, so several workers need a process or forkserver executor
+    # pool: persistent interactive ngspice processes (ngspice -p) that keep the testbench loaded
+    BACKENDS = ('batch', 'shared', 'pool')
+
+    # how the outputs of file based backends are written
+    # csv: the wrdata commands of the testbench, ascii tables parsed with np.genfromtxt
+    # raw: wrdata commands are turned into binary rawfile writes that are memory mapped when read
+    OUTPUT_FORMATS = ('csv', 'raw')
+
+    # info returned next to the specs of a design, specs are None for all failures but INFO_ERROR
+    INFO_OK = 0
+    INFO_ERROR = 1  # ngspice exited with an error, the outputs it wrote were parsed anyway
+    INFO_TIMEOUT = 2  # killed for exceeding its wall-clock or CPU time limit, nothing is parsed
+    INFO_MISSING = 3  # some outputs were not written
+    INFO_PARSE_ERROR = 4  # translate_result raised on the outputs
+    # failures that may not happen again (load of the machine, crashes), their results are neither memoized nor cached
+    TRANSIENT_INFOS = (INFO_ERROR, INFO_TIMEOUT)
+
+    WRDATA_REGEX = re.compile("wrdata\s*(\w+\.\w+)\s*")
+    WRDATA_ARG_REGEX = re.compile(r"\{[^}]*\}|\S+")
+    MEAS_LINE_REGEX = re.compile(r"^\s*(\w+)\s*=\s*([^\s,]+)")
+    # .tran tstep tstop ... (or the tran command of a control section), group 2 is the stop time
+    TRAN_REGEX = re.compile(r"^(\s*\.?tran\s+\S+\s+)(\{[^}]*\}|\S+)", re.IGNORECASE)
+
+    # specs computed by ngspice itself in measurement mode (measure=True), keyed by the wrdata output of the
+    # testbench they are computed from: [(name, command)] run in place of the wrdata command, where {0}, {1}, ...
+    # stand for the vectors of the wrdata command and {key} for the entries of measure_params. The vector called
+    # name is written to the .meas file of the output, commands with name None only compute intermediate vectors.
+    # Subclasses that declare measurements implement translate_measurements, which returns the same specs as
+    # translate_result.
+    MEASUREMENTS = {}
+
+    # parts of the wrdata outputs used by translate_result, keyed by the wrdata file name: dict(vectors, window)
+    # vectors: positions of the vectors of the wrdata command that are used, the others are not written
+    # window: (start, stop) of the scale (time, frequency) that is used, None for an open end or a {key} of
+    # measure_params. The earliest start is the tstart of the transient analysis of the testbench, provided all of
+    # its declared outputs have one.
+    # Outputs that are not listed are written and read in full. Testbenches that declare outputs only save the
+    # nodes and branches their control commands refer to (.save).
+    OUTPUTS = {}
+    # node voltages and branch currents referred to by a control command
+    NODE_REGEX = re.compile(r"\b[vi]\([^()]*\)", re.IGNORECASE)
+
+    # tables captured in memory by non-file backends, keyed by design folder (see load_output)
+    _mem_outputs = {}
+
+    # number of ngspice processes the coroutine API runs at once, over all wrappers (see set_async_concurrency)
+    async_max_processes = os.cpu_count() or 1
+    _async_semaphores = weakref.WeakKeyDictionary()
+
+    def __init__(self, num_process, design_netlist, backend='batch', executor=None, designs_per_deck=1,
+                 output_format='csv', cache=None, workspace=None, wall_timeout=None, cpu_timeout=None,
+                 deck_tuner=None, measure=False, export_waveforms=False, measure_params=None, tran_stop=None):
+        """
+        :param designs_per_deck: number of designs packed into one ngspice deck by the batch backend, or 'auto'
+        to pick it from the measured per-run overhead (see DeckSizeTuner). Small testbenches spend most of their
+        time starting ngspice, packing amortizes that over several designs.
+        :param output_format: one of OUTPUT_FORMATS
+        :param cache: a SimulationCache consulted before simulating a design, None disables caching
+        :param workspace: a Workspace handing out recycled scratch folders to the jobs, if None every design is
+        simulated in its own permanent folder under gen_dir
+        :param wall_timeout: seconds of wall-clock time a design may take before its ngspice process is killed,
+        None waits forever. Enforced by the batch and pool backends, decks get the limit once per design.
+        :param cpu_timeout: same for the CPU time of the ngspice process (batch backend)
+        :param deck_tuner: picks the deck size instead of designs_per_deck (e.g. a ConcurrencyController shared by
+        the testbenches of an evaluation core), anything with size(), max_size and record(size, elapsed)
+        :param measure: if True the specs declared in MEASUREMENTS are computed by ngspice and only those scalars
+        are parsed (translate_measurements), instead of exporting and parsing the waveforms (translate_result).
+        Wrappers without MEASUREMENTS ignore it.
+        :param export_waveforms: in measurement mode, write the waveforms as well (for debugging and the plots of
+        verbose runs)
+        :param measure_params: values filled into the {key} fields of the MEASUREMENTS commands and OUTPUTS windows,
+        e.g. spec limits
+        :param tran_stop: stop time of the transient analysis in seconds, replaces the one of the netlist so that
+        the simulation ends once the specs can be extracted. None simulates the transient of the netlist.
+        """
+
+        if backend not in NgSpiceWrapper.BACKENDS:
+            raise ValueError('unknown backend %s, expected one of %s' % (backend, NgSpiceWrapper.BACKENDS))
+        if output_format not in NgSpiceWrapper.OUTPUT_FORMATS:
+            raise ValueError('unknown output format %s, expected one of %s' % (output_format,
+                                                                              NgSpiceWrapper.OUTPUT_FORMATS))
 
         _, dsg_netlist_fname = os.path.split(design_netlist)
         self.base_design_name = os.path.splitext(dsg_netlist_fname)[0]
         self.num_process = num_process
+        self.backend = backend
+        self.output_format = output_format
+        self.cache = cache
+        self.workspace = workspace
+        self.wall_timeout = wall_timeout
+        self.cpu_timeout = cpu_timeout
+        self._backend = None
+        # executors handed in (e.g. by an evaluation core) are shared and not shut down by this wrapper
+        self.executor = executor
+        self._owns_executor = executor is None
+        thread_executor = executor is None or getattr(executor, 'kind', None) == 'thread'
+        if backend == 'shared' and num_process > 1 and thread_executor:
+            raise ValueError('the shared backend runs one simulation at a time per process, use a process or '
+                             'forkserver executor for %d workers' % num_process)
         self.gen_dir = os.path.join(NgSpiceWrapper.BASE_TMP_DIR, "designs_" + self.base_design_name)
 
         os.makedirs(NgSpiceWrapper.BASE_TMP_DIR, exist_ok=True)
         os.makedirs(self.gen_dir, exist_ok=True)
+        # maps the design names (hashes) back to their parameters
+        self.design_index = DesignIndex(os.path.join(self.gen_dir, 'index.db'))
 
         raw_file = open(design_netlist, 'r')
         self.tmp_lines = raw_file.readlines()
         raw_file.close()
+        # stop time of the netlist, the simulated time saved by tran_stop is measured against it
+        self.tran_stop = tran_stop
+        self.full_tran_stop = None
+        if tran_stop is not None:
+            self.tmp_lines = self.stop_transient(self.tmp_lines)
+        self.transient_time = dict(designs=0, simulated=0.0, full=0.0)
+        self._transient_lock = threading.Lock()
+        self.measure_params = dict(measure_params or {})
+        self.export_waveforms = export_waveforms
+        self.measure = measure and bool(self.measured_outputs())
+        if self.measure:
+            self.tmp_lines = self.measure_lines(self.tmp_lines)
+        # dict(wrdata_fname, (positions of the vectors written, number of vectors of the command in the netlist))
+        self.output_positions = dict()
+        if self.declared_outputs():
+            self.tmp_lines = self.reduce_outputs(self.tmp_lines)
+        self.circuit_lines, self.control_lines = self.split_control(self.tmp_lines)
+        self.template = NetlistTemplate(self.tmp_lines, output_format, self.output_file)
+        self.control_template = NetlistTemplate(self.control_lines, output_format, self.output_file)
+        self.model_paths = model_files(self.tmp_lines, os.path.dirname(os.path.abspath(design_netlist)))
+        # dict(wrdata_fname, vector expressions written to it)
+        self.output_vectors = OrderedDict()
+        # dict(meas_fname, names of the measurements printed to it)
+        self.output_measurements = OrderedDict()
+        for line in self.control_lines:
+            found = NetlistTemplate.MEAS_REGEX.search(line)
+            if self.WRDATA_REGEX.search(line):
+                args = self.WRDATA_ARG_REGEX.findall(line.strip())[1:]
+                self.output_vectors[args[0]] = args[1:]
+            elif found is not None:
+                names = self.output_measurements.setdefault(found.group(1), [])
+                if line.strip().startswith('print'):
+                    names.extend(line.strip()[len('print'):found.start()].split())
+
+        self.designs_per_deck = designs_per_deck
+        if deck_tuner is None and designs_per_deck == 'auto':
+            deck_tuner = DeckSizeTuner()
+        self.deck_tuner = deck_tuner
+        self._pending_deck = []
+        self._deck_lock = threading.Lock()
+
+    def __getstate__(self):
+        # wrappers are shipped to worker processes by process executors, backends and pools stay behind
+        state = self.__dict__.copy()
+        state['_backend'] = None
+        state['executor'] = None
+        state['deck_tuner'] = None
+        state['_pending_deck'] = []
+        state['_deck_lock'] = None
+        state['_transient_lock'] = None
+        # run-time counters stay behind as well, the pickle of a wrapper is the same from job to job (see
+        # BrokerWorker, which keeps the wrappers it unpickled by the digest of their pickle)
+        state['transient_time'] = dict(designs=0, simulated=0.0, full=0.0)
+        return state
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = SimulationExecutor(num_workers=self.num_process, kind='thread')
+            self._owns_executor = True
+        return self.executor
+
+    def close(self):
+        if self._owns_executor and self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def measured_outputs(self):
+        """
+        :return: the wrdata file names of the testbench that have measurements
+        """
+        return list(self.MEASUREMENTS)
+
+    def measure_commands(self, fname, vectors):
+        """
+        :param fname: file name of a wrdata command
+        :param vectors: the vector expressions of the wrdata command
+        :return: [(name, command)] of the measurements of that output, ready to be run
+        """
+        return [(name, command.format(*vectors, **self.measure_params))
+                for name, command in self.MEASUREMENTS[fname]]
+
+    @classmethod
+    def measure_file(cls, fname):
+        """
+        :return: name of the file the measurements computed from the wrdata output fname are printed to
+        """
+        return os.path.splitext(fname)[0] + '.meas'
 
+    def measure_lines(self, lines):
+        """
+        replaces the wrdata commands that have measurements with the commands computing them and printing the
+        results to the .meas file of the output. The wrdata commands stay if export_waveforms is set.
+        """
+        measured = set(self.measured_outputs())
+        new_lines = []
+        for line in lines:
+            found = self.WRDATA_REGEX.search(line)
+            if found is None or found.group(1) not in measured:
+                new_lines.append(line)
+                continue
+            args = self.WRDATA_ARG_REGEX.findall(line.strip())[1:]
+            # {...} expressions of wrdata become plain (...) sub expressions of the measurements
+            vectors = ['(%s)' % arg[1:-1] if arg.startswith('{') else arg for arg in args[1:]]
+            meas_fname = self.measure_file(args[0])
+            if self.export_waveforms:
+                new_lines.append(line)
+            # the file exists even if every measurement fails, so a missing file still means a failed simulation
+            new_lines.append('echo measurements > %s\n' % meas_fname)
+            commands = self.measure_commands(args[0], vectors)
+            new_lines.extend(command + '\n' for _, command in commands)
+            new_lines.extend('print %s >> %s\n' % (name, meas_fname) for name, _ in commands if name is not None)
+        return new_lines
+
+    def stop_transient(self, lines):
+        """
+        replaces the stop time of the transient analysis by tran_stop
+        """
+        stopped = []
+        for line in lines:
+            found = self.TRAN_REGEX.match(line)
+            if found is not None:
+                self.full_tran_stop = found.group(2)
+                line = found.group(1) + '%g' % self.tran_stop + line[found.end():]
+            stopped.append(line)
+        if self.full_tran_stop is None:
+            raise ValueError('tran_stop is set but %s has no transient analysis' % self.base_design_name)
+        return stopped
+
+    def _record_transient(self, future):
+        """
+        adds a simulated design to the transient_time of the wrapper, timeouts did not get to the stop time
+        """
+        if future.cancelled() or future.exception() is not None:
+            return
+        state, _, info = future.result()
+        if info == NgSpiceWrapper.INFO_TIMEOUT:
+            return
+        full = self.template.evaluate(self.full_tran_stop, state)
+        with self._transient_lock:
+            self.transient_time['designs'] += 1
+            self.transient_time['simulated'] += min(self.tran_stop, full)
+            self.transient_time['full'] += full
+
+    def transient_savings(self):
+        """
+        :return: dict(designs, simulated, full, saved) the simulated seconds of transient over the designs simulated
+        so far, with tran_stop and with the stop time of the netlist, and the fraction saved. None without tran_stop.
+        """
+        if self.tran_stop is None:
+            return None
+        with self._transient_lock:
+            savings = dict(self.transient_time)
+        savings['saved'] = 1.0 - savings['simulated'] / savings['full'] if savings['full'] > 0 else 0.0
+        return savings
+
+    def declared_outputs(self):
+        """
+        :return: dict(wrdata_fname, dict(vectors, window)), the OUTPUTS of the testbench
+        """
+        return self.OUTPUTS
+
+    def output_window(self, fname):
+        """
+        :return: (start, stop) of the scale used from a wrdata output, None for open ends
+        """
+        window = self.declared_outputs().get(fname, {}).get('window') or (None, None)
+        return tuple(float(bound.format(**self.measure_params)) if isinstance(bound, str) else bound
+                     for bound in window)
+
+    def reduce_outputs(self, lines):
+        """
+        limits the testbench to its declared outputs: the wrdata commands only write the vectors that are used,
+        the transient analysis starts recording at the start of the windows and only the nodes and branches the
+        control commands refer to are saved
+        """
+        outputs = self.declared_outputs()
+        reduced = []
+        for line in lines:
+            found = self.WRDATA_REGEX.search(line)
+            if found is not None and outputs.get(found.group(1), {}).get('vectors') is not None:
+                args = self.WRDATA_ARG_REGEX.findall(line.strip())
+                positions = tuple(outputs[found.group(1)]['vectors'])
+                self.output_positions[found.group(1)] = (positions, len(args) - 2)
+                line = ' '.join(args[:2] + [args[2 + i] for i in positions]) + '\n'
+            reduced.append(line)
+
+        starts = [self.output_window(fname)[0] for fname in outputs]
+        if starts and None not in starts:
+            reduced = self.start_transient(reduced, min(starts))
+
+        _, control_lines = self.split_control(reduced)
+        nodes = OrderedDict.fromkeys(node.lower() for line in control_lines
+                                     for node in self.NODE_REGEX.findall(line))
+        if nodes:
+            for i, line in enumerate(reduced):
+                if line.strip().lower().startswith('.control'):
+                    reduced.insert(i, '.save %s\n' % ' '.join(nodes))
+                    break
+        return reduced
+
+    @classmethod
+    def start_transient(cls, lines, tstart):
+        """
+        sets the tstart of the transient analysis, the points before it are simulated but not recorded
+        """
+        started = []
+        for line in lines:
+            found = cls.TRAN_REGEX.match(line)
+            if found is not None:
+                fields = line[found.end():].split()
+                if fields and fields[0].lower() != 'uic':
+                    fields[0] = '%g' % tstart
+                else:
+                    fields.insert(0, '%g' % tstart)
+                line = found.group(0) + ' ' + ' '.join(fields) + '\n'
+            started.append(line)
+        return started
+
+    def output_fnames(self):
+        """
+        :return: file names of all the outputs the testbench writes, wrdata tables and measurement files
+        """
+        return list(self.output_vectors) + list(self.output_measurements)
+
+    @classmethod
+    def split_control(cls, lines):
+        """
+        separates the netlist into the circuit description and the commands of its .control section
+        :param lines: template lines
+        :return:
+            circuit_lines: all the lines outside of .control/.endc
+            control_lines: the lines inside .control/.endc
+        """
+        circuit_lines, control_lines = [], []
+        in_control = False
+        for line in lines:
+            keyword = line.strip().lower()
+            if keyword.startswith('.control'):
+                in_control = True
+            elif keyword.startswith('.endc'):
+                in_control = False
+            elif in_control:
+                control_lines.append(line)
+            else:
+                circuit_lines.append(line)
+        return circuit_lines, control_lines
+
+    def get_backend(self):
+        if self._backend is None:
+            if self.backend == 'shared':
+                from framework.wrapper.ngspice_shared import SharedBackend
+                self._backend = SharedBackend(self)
+            elif self.backend == 'pool':
+                from framework.wrapper.ngspice_pool import PoolBackend
+                self._backend = PoolBackend(self)
+        return self._backend
+
+    def get_design_hash(self, state):
+        return design_id(self.base_design_name, state)
 
     def get_design_name(self, state):
-        fname = self.base_design_name
-        for keyword, value in state.items():
-            fname += "_" + keyword + "_" + str(value)
-        return fname
+        """
+        :return: <base_design_name>_<hash of the parameters>, use design_index to get the parameters back
+        """
+        return '%s_%s' % (self.base_design_name, self.get_design_hash(state))
 
-    def create_design(self, state):
-        new_fname = self.get_design_name(state)
-        design_folder = os.path.join(self.gen_dir, new_fname)
+    def get_design_folder(self, state):
+        """
+        :return: the permanent folder of the design, gen_dir/ab/cd/<design name> where abcd are the first digits of
+        the design hash
+        """
+        design_folder = shard_path(self.gen_dir, self.get_design_name(state), self.get_design_hash(state))
         os.makedirs(design_folder, exist_ok=True)
+        return design_folder
 
-        fpath = os.path.join(design_folder, new_fname + '.cir')
+    def register_design(self, state):
+        self.design_index.add(self.get_design_name(state), self.base_design_name, state)
 
-        lines = copy.deepcopy(self.tmp_lines)
-        for line_num, line in enumerate(lines):
-            if '.param' in line:
-                for key, value in state.items():
-                    regex = re.compile("%s=(\S+)" % (key))
-                    found = regex.search(line)
-                    if found:
-                        new_replacement = "%s=%s" % (key, str(value))
-                        lines[line_num] = lines[line_num].replace(found.group(0), new_replacement)
-            if 'wrdata' in line:
-                regex = re.compile("wrdata\s*(\w+\.\w+)\s*")
-                found = regex.search(line)
-                if found:
-                    replacement = os.path.join(design_folder, found.group(1))
-                    lines[line_num] = lines[line_num].replace(found.group(1), replacement)
-
-        with open(fpath, 'w') as f:
-            f.writelines(lines)
-            f.close()
+    def acquire_folder(self, state):
+        """
+        :return: the folder a job simulating the design writes into
+        """
+        if self.workspace is None:
+            return self.get_design_folder(state)
+        return self.workspace.acquire()
+
+    def release_folder(self, state, design_folder, specs=None, failed=False):
+        """
+        called once the outputs in design_folder are parsed, the workspace recycles (or keeps) the folder
+        """
+        if self.workspace is not None:
+            self.workspace.release(design_folder, self.get_design_name(state), specs, failed)
+
+    def create_design(self, state, design_folder=None):
+        new_fname = self.get_design_name(state)
+        if design_folder is None:
+            design_folder = self.get_design_folder(state)
+
+        fpath = os.path.join(design_folder, new_fname + '.cir')
+        self.template.write(fpath, state, design_folder)
         return design_folder, fpath
 
-    def simulate(self, fpath):
-        info = 0 # this means no error occurred
-        command = "ngspice -b %s >/dev/null 2>&1" %fpath
-        exit_code = os.system(command)
+    def output_file(self, fname):
+        """
+        :param fname: the file name used in a wrdata command of the testbench, or a measurement file
+        :return: name of the file the output actually ends up in, measurement files are text in every format
+        """
+        if self.output_format == 'raw' and not fname.endswith('.meas'):
+            return os.path.splitext(fname)[0] + '.raw'
+        return fname
+
+    def get_control_commands(self, design_folder):
+        """
+        :param design_folder: where the outputs of the design should be written
+        :return: the .control commands of the testbench with their wrdata outputs pointing into design_folder
+        """
+        lines = self.control_template.render({}, design_folder).splitlines(True)
+        if self.output_format == 'raw':
+            lines.insert(0, 'set filetype=binary\n')
+        return lines
+
+    def simulate(self, fpath, n_designs=1):
+        """
+        runs ngspice on a netlist, the process is killed if it exceeds its time limits
+        :param n_designs: number of designs in the netlist, the limits apply per design
+        :return:
+            info: INFO_OK, INFO_ERROR if ngspice exited with an error or INFO_TIMEOUT if it was killed
+        """
+        command = ['ngspice', '-b', fpath]
         if debug:
-            print(command)
-            print(fpath)
+            print(' '.join(command))
+        # a session of its own so that the kill takes anything ngspice spawned along
+        proc = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL, start_new_session=True)
+        self._limit_cpu(proc.pid, n_designs)
+        try:
+            return_code = proc.wait(timeout=self._wall_limit(n_designs))
+        except subprocess.TimeoutExpired:
+            self._kill(proc.pid)
+            proc.wait()
+            return NgSpiceWrapper.INFO_TIMEOUT
+        return self._exit_info(return_code)
 
-        if (exit_code % 256):
-           # raise RuntimeError('program {} failed!'.format(command))
-            info = 1 # this means an error has occurred
-        return info
+    def _wall_limit(self, n_designs=1):
+        return self.wall_timeout * n_designs if self.wall_timeout is not None else None
 
+    def _limit_cpu(self, pid, n_designs=1):
+        """
+        sets RLIMIT_CPU on a running ngspice process, it gets SIGXCPU at the limit and SIGKILL a second later.
+        Setting the limit after the fact (instead of in preexec_fn) is safe with the thread executor.
+        """
+        if self.cpu_timeout is None or not hasattr(resource, 'prlimit'):
+            return
+        limit = int(math.ceil(self.cpu_timeout * n_designs))
+        try:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (limit, limit + 1))
+        except (OSError, ValueError):
+            # the process is already gone
+            pass
+
+    @classmethod
+    def _kill(cls, pid):
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    @classmethod
+    def _exit_info(cls, return_code):
+        if return_code in (-signal.SIGXCPU, -signal.SIGKILL):
+            return NgSpiceWrapper.INFO_TIMEOUT
+        return NgSpiceWrapper.INFO_OK if return_code == 0 else NgSpiceWrapper.INFO_ERROR
 
     def create_design_and_simulate(self, state, verbose=False):
+        cached = self.lookup(state)
+        if cached is not None:
+            return cached
+        return self._simulate_design(state, verbose)
+
+    def _simulate_design(self, state, verbose=False):
         if debug:
             print('state', state)
             print('verbose', verbose)
         dsn_name = self.get_design_name(state)
         if verbose:
             print(dsn_name)
-        design_folder, fpath = self.create_design(state)
-        info = self.simulate(fpath)
-        specs = self.translate_result(design_folder)
+        self.template.check_state(state)
+        self.register_design(state)
+        design_folder = self.acquire_folder(state)
+        specs, info = None, NgSpiceWrapper.INFO_ERROR
+        try:
+            if self.backend == 'batch':
+                _, fpath = self.create_design(state, design_folder)
+                info = self.simulate(fpath)
+                specs, info = self._translate_and_store(state, design_folder, info)
+            else:
+                info, outputs = self.get_backend().simulate(state, design_folder)
+                NgSpiceWrapper._mem_outputs[design_folder] = outputs
+                try:
+                    specs, info = self._translate_and_store(state, design_folder, info)
+                finally:
+                    NgSpiceWrapper._mem_outputs.pop(design_folder, None)
+        finally:
+            self.release_folder(state, design_folder, specs, failed=specs is None or info != 0)
         return state, specs, info
 
+    def parser_settings(self):
+        """
+        :return: dict of the settings that shape the specs parsed from the outputs but don't all show in the
+        netlist: the measurement mode, measure_params (e.g. tot_err, sampling instants) and the vectors and
+        windows kept from every output
+        """
+        outputs = {fname: [self.output_positions.get(fname), self.output_window(fname)]
+                   for fname in self.output_vectors}
+        return dict(measure=self.measure, export_waveforms=self.export_waveforms,
+                    measure_params=self.measure_params, outputs=outputs)
+
+    def cache_key(self, state):
+        """
+        content address of the simulation of a design, see SimulationCache.make_key. The parser is the wrapper class
+        together with its parser_settings.
+        """
+        settings = json.dumps(self.parser_settings(), sort_keys=True, default=repr)
+        parser = '%s.%s %s' % (type(self).__module__, type(self).__name__, settings)
+        return SimulationCache.make_key(self.template.render(state, ''), self.model_paths, parser)
+
+    def lookup(self, state):
+        """
+        :return: the cached (state, specs, info) of the design, None if it has to be simulated. Known failures are
+        returned with specs None as well.
+        """
+        if self.cache is None:
+            return None
+        design_folder = self.get_design_folder(state) if self.cache.store_waveforms else None
+        cached = self.cache.get(self.cache_key(state), design_folder)
+        if cached is None:
+            return None
+        specs, info = cached
+        return state, specs, info
+
+    def missing_outputs(self, design_folder):
+        """
+        :return: file names of the outputs that the simulation of design_folder did not produce
+        """
+        mem_outputs = NgSpiceWrapper._mem_outputs.get(design_folder)
+        return [fname for fname in self.output_fnames()
+                if not (mem_outputs is not None and fname in mem_outputs) and
+                not os.path.isfile(os.path.join(design_folder, self.output_file(fname)))]
+
+    def _translate_and_store(self, state, design_folder, info):
+        """
+        parses the outputs of a simulation, unless it was killed or did not write all of them
+        :return: (specs, info), specs is None and info one of the failure codes if nothing could be parsed
+        """
+        if info == NgSpiceWrapper.INFO_TIMEOUT:
+            return None, info
+        # only the results of a clean exit are cached, a design that was killed (e.g. out of memory) or whose
+        # worker crashed may well succeed the next time
+        clean_exit = info == NgSpiceWrapper.INFO_OK
+        specs = None
+        if self.missing_outputs(design_folder):
+            info = NgSpiceWrapper.INFO_MISSING
+        else:
+            try:
+                specs = self.translate(design_folder)
+            except Exception as e:
+                # the failure is reported through info, like the other failures of a design
+                if debug:
+                    print('%s: the outputs could not be parsed (%r)' % (self.get_design_name(state), e))
+                info = NgSpiceWrapper.INFO_PARSE_ERROR
+        if self.cache is not None and clean_exit and info not in NgSpiceWrapper.TRANSIENT_INFOS:
+            output_files = [os.path.join(design_folder, self.output_file(fname)) for fname in self.output_fnames()]
+            self.cache.put(self.cache_key(state), specs, info, output_files if specs is not None else ())
+        return specs, info
+
+    def get_deck_size(self):
+        """
+        :return: number of designs that go into one ngspice deck, decks are only packed by the batch backend
+        """
+        if self.backend != 'batch':
+            return 1
+        if self.deck_tuner is not None:
+            return self.deck_tuner.size()
+        return max(1, int(self.designs_per_deck))
+
+    def max_deck_size(self):
+        if self.backend != 'batch':
+            return 1
+        if self.deck_tuner is not None:
+            return self.deck_tuner.max_size
+        return max(1, int(self.designs_per_deck))
+
+    def create_deck(self, states, design_folders):
+        """
+        writes a single netlist that simulates all the states one after the other: the circuit is loaded once and
+        the .control section is unrolled per design, with alterparam/reset setting the parameters and the wrdata
+        outputs pointing into the folder of that design.
+        :return: path of the deck
+        """
+        circuit_lines = [line for line in self.circuit_lines if line.strip().lower() != '.end']
+        lines = list(circuit_lines)
+        lines.append('.control\n')
+        for state, design_folder in zip(states, design_folders):
+            self.template.check_state(state)
+            self.register_design(state)
+            lines.append('* %s\n' % self.get_design_name(state))
+            for key, value in state.items():
+                lines.append('alterparam %s=%s\n' % (key, str(value)))
+            lines.append('reset\n')
+            lines.extend(self.get_control_commands(design_folder))
+            # drop the plots so that a design whose analyses fail can't write out the vectors of the previous one
+            lines.append('destroy all\n')
+        lines.append('.endc\n')
+        lines.append('.end\n')
+
+        deck_dir = self.workspace.root if self.workspace is not None else self.gen_dir
+        fd, fpath = tempfile.mkstemp(prefix='deck_', suffix='.cir', dir=deck_dir)
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(lines)
+        return fpath
+
+    def simulate_deck(self, states, verbose=False):
+        """
+        simulates several designs in a single ngspice process. Designs that did not write all of their outputs
+        (e.g. the simulator bailed out in the middle of the deck) are simulated again on their own, so one bad
+        design does not take the rest of the deck down with it.
+        :return:
+            results: [(state, specs, info) or the exception raised for that design] in the order of states
+            elapsed: wall time of the deck simulation
+        """
+        design_folders = [self.acquire_folder(state) for state in states]
+        for design_folder in design_folders:
+            # outputs of an earlier run of the same design would hide a failure
+            for fname in self.output_fnames():
+                fpath = os.path.join(design_folder, self.output_file(fname))
+                if os.path.isfile(fpath):
+                    os.remove(fpath)
+
+        start = time.time()
+        fpath = self.create_deck(states, design_folders)
+        try:
+            self.simulate(fpath, n_designs=len(states))
+        finally:
+            os.remove(fpath)
+        elapsed = time.time() - start
+
+        results = []
+        for state, design_folder in zip(states, design_folders):
+            if verbose:
+                print(self.get_design_name(state))
+            complete = not self.missing_outputs(design_folder)
+            # errors are handed back per design, they only fail the future of that design
+            specs = None
+            try:
+                if complete:
+                    specs, info = self._translate_and_store(state, design_folder, NgSpiceWrapper.INFO_OK)
+                    results.append((state, specs, info))
+            except Exception as e:
+                results.append(e)
+            finally:
+                # incomplete designs are not failures yet, they get a folder of their own below
+                self.release_folder(state, design_folder, specs, failed=complete and specs is None)
+            if not complete:
+                try:
+                    results.append(self._simulate_design(state, verbose))
+                except Exception as e:
+                    results.append(e)
+        return results, elapsed
+
+    def submit(self, state, verbose=False):
+        """
+        schedules a single design on the executor. When decks are packed the design waits until the deck is full
+        or flush() is called.
+        :return: a future that resolves to (state, specs, info)
+        """
+        cached = self.lookup(state)
+        if cached is not None:
+            return self._done_future(result=cached)
+
+        if self.max_deck_size() <= 1:
+            future = self.get_executor().submit(self._simulate_design, state, verbose)
+            if self.tran_stop is not None:
+                future.add_done_callback(self._record_transient)
+            return future
+
+        future = concurrent.futures.Future()
+        if self.tran_stop is not None:
+            future.add_done_callback(self._record_transient)
+        with self._deck_lock:
+            self._pending_deck.append((state, verbose, future))
+            if len(self._pending_deck) < self.get_deck_size():
+                return future
+            deck, self._pending_deck = self._pending_deck, []
+        self._submit_deck(deck)
+        return future
+
+    def flush(self):
+        """
+        submits the designs that are waiting for their deck to fill up
+        """
+        with self._deck_lock:
+            deck, self._pending_deck = self._pending_deck, []
+        if deck:
+            self._submit_deck(deck)
+
+    def _submit_deck(self, deck):
+        states = [state for state, _, _ in deck]
+        verbose = any(verbose for _, verbose, _ in deck)
+        futures = [future for _, _, future in deck]
+
+        def distribute(deck_future):
+            try:
+                results, elapsed = deck_future.result()
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                return
+            if self.deck_tuner is not None:
+                self.deck_tuner.record(len(states), elapsed)
+            for future, result in zip(futures, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+        deck_future = self.get_executor().submit(self.simulate_deck, states, verbose)
+        deck_future.add_done_callback(distribute)
+
+    @classmethod
+    def _done_future(cls, result=None, exception=None):
+        future = concurrent.futures.Future()
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+        return future
 
     def run(self, states, verbose=False):
         """
@@ -100,11 +801,244 @@ class NgSpiceWrapper(object):
         :return:
             results = [(state: dict(param_kwds, param_value), specs: dict(spec_kwds, spec_value), info: int)]
         """
-        pool = ThreadPool(processes=self.num_process)
-        arg_list = [(state, verbose) for state in states]
-        specs = pool.starmap(self.create_design_and_simulate, arg_list)
-        pool.close()
-        return specs
+        futures = self.submit_all(states, verbose=verbose)
+        return [future.result() for future in futures]
+
+    def submit_all(self, states, callback=None, verbose=False):
+        """
+        schedules all the states without waiting for them
+        :param callback: if given, called with (state, specs, info) as soon as a design is done, from the thread
+        that completed it
+        :return: list of futures that resolve to (state, specs, info), in the order of states
+        """
+        futures = [self.submit(state, verbose) for state in states]
+        self.flush()
+        if callback is not None:
+            def on_done(future):
+                if future.exception() is None:
+                    callback(*future.result())
+            for future in futures:
+                future.add_done_callback(on_done)
+        return futures
+
+    def run_iter(self, states, verbose=False):
+        """
+        streaming version of run
+        :return:
+            generator of (state, specs, info) in the order the simulations finish
+        """
+        for future in concurrent.futures.as_completed(self.submit_all(states, verbose=verbose)):
+            yield future.result()
+
+    @classmethod
+    def set_async_concurrency(cls, max_processes):
+        """
+        sets the number of ngspice processes the coroutine API may run at once, applies to event loops that did not
+        start simulating yet
+        """
+        NgSpiceWrapper.async_max_processes = max_processes
+        NgSpiceWrapper._async_semaphores.clear()
+
+    @classmethod
+    def get_async_semaphore(cls):
+        loop = asyncio.get_event_loop()
+        semaphore = NgSpiceWrapper._async_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(NgSpiceWrapper.async_max_processes)
+            NgSpiceWrapper._async_semaphores[loop] = semaphore
+        return semaphore
+
+    async def simulate_process_async(self, fpath):
+        """
+        coroutine version of simulate, cancelling it kills the ngspice process
+        """
+        proc = await asyncio.create_subprocess_exec('ngspice', '-b', fpath, stdin=asyncio.subprocess.DEVNULL,
+                                                    stdout=asyncio.subprocess.DEVNULL,
+                                                    stderr=asyncio.subprocess.DEVNULL, start_new_session=True)
+        self._limit_cpu(proc.pid)
+        try:
+            return_code = await asyncio.wait_for(proc.wait(), self._wall_limit())
+        except asyncio.TimeoutError:
+            self._kill(proc.pid)
+            await proc.wait()
+            return NgSpiceWrapper.INFO_TIMEOUT
+        except asyncio.CancelledError:
+            if proc.returncode is None:
+                self._kill(proc.pid)
+                await proc.wait()
+            raise
+        return self._exit_info(return_code)
+
+    async def simulate_async(self, state, verbose=False):
+        """
+        coroutine version of create_design_and_simulate. With the batch backend the ngspice process is run with
+        asyncio, a pending coroutine holds no thread and no process. The other backends run on the executor.
+        :return: (state, specs, info)
+        """
+        cached = self.lookup(state)
+        if cached is not None:
+            return cached
+        if self.backend != 'batch':
+            return await asyncio.wrap_future(self.get_executor().submit(self._simulate_design, state, verbose))
+
+        self.template.check_state(state)
+        if verbose:
+            print(self.get_design_name(state))
+        loop = asyncio.get_event_loop()
+        async with self.get_async_semaphore():
+            self.register_design(state)
+            design_folder = self.acquire_folder(state)
+            specs, info = None, NgSpiceWrapper.INFO_ERROR
+            try:
+                _, fpath = self.create_design(state, design_folder)
+                info = await self.simulate_process_async(fpath)
+                # parsing runs in the default executor to keep the event loop responsive
+                specs, info = await loop.run_in_executor(None, self._translate_and_store, state, design_folder,
+                                                         info)
+            finally:
+                self.release_folder(state, design_folder, specs, failed=specs is None or info != 0)
+        return state, specs, info
+
+    async def run_async(self, states, verbose=False):
+        """
+        coroutine version of run, all states are simulated concurrently (bounded by the global semaphore)
+        :return: [(state, specs, info)] in the order of states
+        """
+        return await asyncio.gather(*(self.simulate_async(state, verbose) for state in states))
+
+    def load_output(self, output_path, fname):
+        """
+        Returns the table written by a wrdata command of the testbench, in the same shape np.genfromtxt gives for
+        the file. Backends that keep the results in memory are served without touching the disk.
+
+        :param output_path: the design folder passed to translate_result
+        :param fname: the file name used in the wrdata command, e.g. 'ac.csv'
+        :return:
+            np.array of the wrdata columns
+        """
+        mem_outputs = NgSpiceWrapper._mem_outputs.get(output_path)
+        if mem_outputs is not None and fname in mem_outputs:
+            table = mem_outputs[fname]
+            # genfromtxt returns a flat array for single row files (e.g. op results)
+            return table[0] if table.shape[0] == 1 else table
+
+        fpath = os.path.join(output_path, fname)
+        if not os.path.isfile(fpath):
+            print("%s file doesn't exist: %s" % (fname, output_path))
+        return np.genfromtxt(fpath, skip_header=1)
+
+    def load_vectors(self, output_path, fname):
+        """
+        Returns the vectors written by a wrdata command of the testbench. With the raw output format the vectors
+        are views into the memory mapped rawfile, otherwise they are columns of the wrdata table.
+
+        :param output_path: the design folder passed to translate_result
+        :param fname: the file name used in the wrdata command, e.g. 'ac.csv'
+        :return:
+            Vectors, the scale of the plot and one array per vector of the wrdata command, in the same order
+        """
+        n_vectors = len(self.output_vectors[fname])
+        mem_outputs = NgSpiceWrapper._mem_outputs.get(output_path)
+        if mem_outputs is not None and fname in mem_outputs:
+            vectors = Vectors.from_wrdata(self.load_output(output_path, fname), n_vectors)
+        else:
+            fpath = os.path.join(output_path, self.output_file(fname))
+            if not os.path.isfile(fpath):
+                print("%s file doesn't exist: %s" % (fname, output_path))
+            if self.output_format == 'raw':
+                vectors = read_raw(fpath)[0].vectors(n_vectors)
+            else:
+                vectors = self.read_wrdata(fpath, n_vectors)
+
+        if fname in self.output_positions:
+            # vectors that were not written stay None, so they keep the positions of the netlist command
+            positions, n_netlist = self.output_positions[fname]
+            values, names = [None] * n_netlist, [None] * n_netlist
+            for position, value, name in zip(positions, vectors.values, vectors.names):
+                values[position], names[position] = value, name
+            vectors = Vectors(vectors.scale, values, names)
+        window = self.output_window(fname)
+        if window != (None, None):
+            vectors = vectors.window(*window)
+        return vectors
+
+    @classmethod
+    def read_wrdata(cls, fpath, n_vectors):
+        """
+        reads a wrdata table, the scale once and the value columns of the vectors. wrdata writes a copy of the
+        scale in front of every vector, those columns are skipped.
+        :return: Vectors
+        """
+        with open(fpath, 'r') as f:
+            f.readline()
+            n_columns = len(f.readline().split())
+        # a scale column and one (real) or two (complex) value columns per vector
+        width = max(n_columns // n_vectors, 2)
+        columns = [0] + [i * width + j for i in range(n_vectors) for j in range(1, width)]
+        table = np.atleast_2d(np.genfromtxt(fpath, skip_header=1, usecols=columns))
+        values = []
+        for i in range(n_vectors):
+            start = 1 + i * (width - 1)
+            if width == 3:
+                values.append(table[:, start] + 1j * table[:, start + 1])
+            else:
+                values.append(table[:, start])
+        return Vectors(table[:, 0], values)
+
+    def load_measurements(self, output_path, fname):
+        """
+        Returns the measurements computed from a wrdata output of the testbench (see MEASUREMENTS).
+
+        :param output_path: the design folder passed to translate_measurements
+        :param fname: the file name used in the wrdata command, e.g. 'ac.csv'
+        :return:
+            dict(name, value), measurements that failed in the simulator (e.g. no crossing) are left out
+        """
+        meas_fname = self.measure_file(fname)
+        mem_outputs = NgSpiceWrapper._mem_outputs.get(output_path)
+        if mem_outputs is not None and meas_fname in mem_outputs:
+            return dict(mem_outputs[meas_fname])
+
+        measurements = dict()
+        with open(os.path.join(output_path, meas_fname), 'r') as f:
+            for line in f:
+                # print writes name = value, complex scalars as name = real,imag
+                found = self.MEAS_LINE_REGEX.match(line)
+                if found is not None:
+                    try:
+                        measurements[found.group(1).lower()] = float(found.group(2))
+                    except ValueError:
+                        pass
+        return measurements
+
+    def translate(self, output_path):
+        """
+        specs of a simulation, measured by ngspice in measurement mode (translate_measurements) or parsed from the
+        waveforms otherwise (translate_result). With export_waveforms the entries of translate_result that were not
+        measured (the waveforms) are added to the measured specs.
+
+        :param output_path: the design folder
+        :return
+            result: dict(spec_kwds, spec_value)
+        """
+        if not self.measure:
+            return self.translate_result(output_path)
+        spec = self.translate_measurements(output_path)
+        if self.export_waveforms:
+            for key, value in self.translate_result(output_path).items():
+                spec.setdefault(key, value)
+        return spec
+
+    def translate_measurements(self, output_path):
+        """
+        counterpart of translate_result in measurement mode, builds the same specs from load_measurements instead
+        of the waveforms. Wrappers that declare MEASUREMENTS overwrite it, the others parse their waveforms.
+
+        :param output_path:
+        :return
+            result: dict(spec_kwds, spec_value)
+        """
+        return self.translate_result(output_path)
 
     def translate_result(self, output_path):
         """
@@ -127,6 +1061,45 @@ class methods.
 """
 class CsAmpClass(NgSpiceWrapper):
 
+    MEASUREMENTS = {
+        'ac.csv': (
+            (None, 'let vout_mag = mag({0})'),
+            ('gain', 'let gain = vout_mag[0]'),
+            ('gain_last', 'let gain_last = vout_mag[length(vout_mag)-1]'),
+            ('freq_first', 'let freq_first = real(frequency[0])'),
+            ('freq_last', 'let freq_last = real(frequency[length(frequency)-1])'),
+            (None, 'let gain_norm = vout_mag / gain'),
+            ('bw', 'meas ac bw when gain_norm=0.70710678 cross=1'),
+        ),
+        'dc.csv': (
+            ('ibias_dc', 'let ibias_dc = -{0}[0]'),
+        ),
+    }
+
+    def translate_measurements(self, output_path):
+        """
+
+        :param output_path:
+        :return
+            result: dict(spec_kwds, spec_value)
+        """
+        ac = self.load_measurements(output_path, 'ac.csv')
+        dc = self.load_measurements(output_path, 'dc.csv')
+        gain = ac['gain']
+        bw = ac.get('bw')
+        if bw is None:
+            # no -3dB point in the sweep, same fallback as measure.crossing
+            gain_3dB = gain / np.sqrt(2)
+            bw = ac['freq_first'] if abs(gain - gain_3dB) < abs(ac['gain_last'] - gain_3dB) else ac['freq_last']
+
+        spec = dict(
+            bw=bw,
+            gain=gain,
+            Ibias=dc['ibias_dc']
+        )
+
+        return spec
+
     def translate_result(self, output_path):
         """
 
@@ -151,49 +1124,26 @@ class CsAmpClass(NgSpiceWrapper):
 
     def parse_output(self, output_path):
 
-        ac_fname = os.path.join(output_path, 'ac.csv')
-        dc_fname = os.path.join(output_path, 'dc.csv')
-
-        if not os.path.isfile(ac_fname) or not os.path.isfile(dc_fname):
-            print("ac/dc file doesn't exist: %s" % output_path)
-
-        ac_raw_outputs = np.genfromtxt(ac_fname, skip_header=1)
-        dc_raw_outputs = np.genfromtxt(dc_fname, skip_header=1)
-        freq = ac_raw_outputs[:, 0]
-        vout = ac_raw_outputs[:, 1]
-        ibias = -dc_raw_outputs[1]
+        ac_outputs = self.load_vectors(output_path, 'ac.csv')
+        dc_outputs = self.load_vectors(output_path, 'dc.csv')
+        freq = ac_outputs.scale
+        vout = ac_outputs[0].real
+        ibias = -dc_outputs[0][0]
 
         return freq, vout, ibias
 
     def find_dc_gain (self, vout):
-        return np.abs(vout)[0]
+        return measure.dc_gain(vout)[0]
 
     def find_bw(self, vout, freq):
-        gain = np.abs(vout)
-        gain_3dB = gain[0] / np.sqrt(2)
-        return self._get_best_crossing(freq, gain, gain_3dB)
-
-
-    def _get_best_crossing(cls, xvec, yvec, val):
-        interp_fun = interp.InterpolatedUnivariateSpline(xvec, yvec)
-
-        def fzero(x):
-            return interp_fun(x) - val
+        return measure.bandwidth_3db(freq, vout)[0]
+class CsAmpEvaluationCore(EvaluationCoreBase):
 
-        xstart, xstop = xvec[0], xvec[-1]
-        try:
-            return sciopt.brentq(fzero, xstart, xstop)
-        except ValueError:
-            # avoid no solution
-            if abs(fzero(xstart)) < abs(fzero(xstop)):
-                return xstart
-            return xstop
-class CsAmpEvaluationCore(object):
+    result_keys = ('cost', 'bw', 'gain', 'ibias')
 
     def __init__(self, cir_yaml):
-        import yaml
-        with open(cir_yaml, 'r') as f:
-            yaml_data = yaml.load(f)
+        super().__init__(cir_yaml)
+        yaml_data = self.yaml_data
 
         # specs
         specs = yaml_data['target_specs']
@@ -201,9 +1151,9 @@ class CsAmpEvaluationCore(object):
         self.gain_min   = specs['gain_min']
         self.bias_max   = specs['ibias_max']
 
-        num_process = yaml_data['num_process']
         dsn_netlist = yaml_data['dsn_netlist']
-        self.env = CsAmpClass(num_process=num_process, design_netlist=dsn_netlist)
+        self.env = self.make_env(CsAmpClass, dsn_netlist)
+        self.testbenches['cs'] = self.env
 
         params = yaml_data['params']
         self.res_vec = np.arange(params['rload'][0], params['rload'][1], params['rload'][2])
@@ -217,11 +1167,23 @@ class CsAmpEvaluationCore(object):
         :param verbose: if True will print the specification performance of the best individual
         :return:
         """
-        state = [{'rload': self.res_vec[res_idx], 'mul': self.mul_vec[mul_idx]}]
-        results = self.env.run(state, verbose=False)
-        bw_cur = results[0][1]['bw']
-        gain_cur = results[0][1]['gain']
-        ibias_cur = results[0][1]['Ibias']
+        results = self.cost_fun_batch([(res_idx, mul_idx)], verbose=verbose)
+        return results['cost'][0]
+
+    def decode_batch(self, designs):
+        """
+        :param designs: (n_designs x 2) array-like of (res_idx, mul_idx)
+        :return: list of states, dict(param_kwds, param_value)
+        """
+        designs = np.asarray(designs, dtype=int).reshape(-1, 2)
+        res_values = self.res_vec[designs[:, 0]]
+        mul_values = self.mul_vec[designs[:, 1]]
+        return [{'rload': res, 'mul': mul} for res, mul in zip(res_values, mul_values)]
+
+    def evaluate_design(self, results, verbose=False):
+        bw_cur = results['cs']['bw']
+        gain_cur = results['cs']['gain']
+        ibias_cur = results['cs']['Ibias']
 
         if verbose:
             print('bw = %f vs. bw_min = %f' %(bw_cur, self.bw_min))
@@ -235,7 +1197,7 @@ class CsAmpEvaluationCore(object):
             cost += abs(gain_cur/self.gain_min - 1.0)
         cost += abs(ibias_cur/self.bias_max)/10
 
-        return cost
+        return dict(cost=cost, bw=bw_cur, gain=gain_cur, ibias=ibias_cur)
 ## helper function for demonstration
 
 def cost_fc(ibias_cur, gain_cur, bw_cur):
@@ -0,0 +1,157 @@
+import mmap
+
+import numpy as np
+
+
+class Vectors(object):
+    """
+    The outputs of one wrdata (or write) command: the scale of the plot and the requested vectors, in the order
+    they were listed in the command. Vectors can be looked up by position or by name.
+    """
+
+    def __init__(self, scale, values, names=None):
+        self.scale = scale
+        self.values = list(values)
+        self.names = list(names) if names is not None else [None] * len(self.values)
+
+    @classmethod
+    def from_wrdata(cls, table, n_vectors, names=None):
+        """
+        :param table: the wrdata columns, for every vector a scale column followed by one (real) or two (complex)
+        value columns
+        :param n_vectors: number of vectors in the wrdata command
+        """
+        table = np.atleast_2d(table)
+        width = table.shape[1] // n_vectors
+        values = []
+        for i in range(n_vectors):
+            start = i * width
+            if width == 3:
+                values.append(table[:, start + 1] + 1j * table[:, start + 2])
+            else:
+                values.append(table[:, start + 1])
+        return cls(table[:, 0], values, names)
+
+    def window(self, start=None, stop=None):
+        """
+        :param start: first value of the scale that is kept, None keeps the points from the beginning
+        :param stop: last value of the scale that is kept, None keeps the points up to the end
+        :return: Vectors of the points whose scale lies within [start, stop], slices (views) of the arrays. The
+        scale has to be increasing (time, frequency).
+        """
+        first = 0 if start is None else np.searchsorted(self.scale, start, side='left')
+        last = len(self.scale) if stop is None else np.searchsorted(self.scale, stop, side='right')
+        values = [value[first:last] if value is not None else None for value in self.values]
+        return Vectors(self.scale[first:last], values, self.names)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self.names.index(key)
+        return self.values[key]
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+
+class RawPlot(object):
+    """
+    One plot of an ngspice binary rawfile. data is a (n_points x n_variables) array that maps the file directly,
+    columns are float64 for real plots and complex128 for complex ones (ngspice stores every variable of a complex
+    plot as complex, including the scale).
+    """
+
+    def __init__(self, header, names, types, data):
+        self.header = header
+        self.title = header.get('Title', '')
+        self.plotname = header.get('Plotname', '')
+        self.flags = header.get('Flags', '').split()
+        self.names = names
+        self.types = types
+        self.data = data
+
+    @property
+    def is_complex(self):
+        return 'complex' in self.flags
+
+    def __getitem__(self, key):
+        """
+        :param key: variable name or index
+        :return: a view of the column, no data is copied
+        """
+        if isinstance(key, str):
+            key = self.names.index(key)
+        return self.data[:, key]
+
+    def vectors(self, n_vectors=None):
+        """
+        :param n_vectors: number of vectors that were written, the variable in front of them (if any) is the scale
+        :return: Vectors made of column views of the plot
+        """
+        n_variables = len(self.names)
+        if n_vectors is None:
+            n_vectors = n_variables - 1
+        first = n_variables - n_vectors
+        if first > 0:
+            scale = self.data[:, 0].real
+        else:
+            scale = np.arange(self.data.shape[0], dtype=float)
+        values = [self.data[:, i] for i in range(first, n_variables)]
+        return Vectors(scale, values, self.names[first:])
+
+
+def read_raw(fpath):
+    """
+    Memory maps an ngspice binary rawfile (write command with filetype=binary). Files cut short by an aborted
+    simulation are read up to their last complete point.
+
+    :param fpath: path of the rawfile
+    :return:
+        list of RawPlot in the order they appear in the file
+    """
+    with open(fpath, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return []
+
+    plots = []
+    offset = 0
+    while offset < len(buf):
+        data_start = buf.find(b'Binary:\n', offset)
+        if data_start < 0:
+            if buf.find(b'Values:\n', offset) >= 0:
+                raise ValueError('%s is an ascii rawfile, set filetype=binary before writing it' % fpath)
+            break
+        header, names, types = _parse_header(buf[offset:data_start].decode('ascii', errors='replace'))
+        data_start += len(b'Binary:\n')
+
+        dtype = np.dtype(np.complex128 if 'complex' in header.get('Flags', '') else np.float64)
+        n_variables = len(names)
+        row_size = dtype.itemsize * n_variables
+        n_points = int(header.get('No. Points', 0))
+        n_points = min(n_points, (len(buf) - data_start) // row_size)
+
+        data = np.frombuffer(buf, dtype=dtype, count=n_points * n_variables, offset=data_start)
+        plots.append(RawPlot(header, names, types, data.reshape(n_points, n_variables)))
+        offset = data_start + n_points * row_size
+    return plots
+
+
+def _parse_header(text):
+    header, names, types = {}, [], []
+    lines = text.splitlines()
+    for i, line in enumerate(lines):
+        if line.startswith('Variables:'):
+            for var_line in lines[i + 1:]:
+                fields = var_line.split()
+                if len(fields) >= 3:
+                    names.append(fields[1])
+                    types.append(fields[2])
+            break
+        key, _, value = line.partition(':')
+        header[key.strip()] = value.strip()
+    return header, names, types
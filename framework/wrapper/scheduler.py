@@ -0,0 +1,166 @@
+import concurrent.futures
+import heapq
+import time
+
+import numpy as np
+
+
+class TestbenchScheduler(object):
+    """
+    Schedules the simulations of a batch of designs on an executor.
+
+    Every design is a small DAG: one simulation task per testbench (independent of each other) and a reduction
+    task (e.g. the cost function) that runs as a continuation once all of them are done. Independent tasks run
+    concurrently, and among the tasks that are ready the ones of the design with the fewest outstanding
+    simulations go first, so that finished designs stream out instead of all completing at the very end.
+
+    A design whose simulation failed (specs None) is reduced right away, its remaining testbenches are skipped.
+    """
+
+    def __init__(self, executor, max_in_flight=None, speculate_after=None, speculate_factor=2.0, controller=None):
+        """
+        :param executor: a SimulationExecutor (or anything with submit and num_workers)
+        :param max_in_flight: number of tasks handed to the executor at once, defaults to its number of workers
+        (times the deck size of testbenches that pack several designs into one deck). Keeping this small is what
+        lets the priorities matter, everything beyond it waits in the scheduler.
+        :param speculate_after: fraction of the designs of a batch that must be done before stragglers are
+        launched a second time, None disables speculation. A task is a straggler once it runs longer than
+        speculate_factor times the median duration of the finished tasks, the first copy to finish wins.
+        Copies of a design must not share a folder, so speculation needs the wrappers to run in a Workspace.
+        :param controller: a ConcurrencyController, its number of workers replaces the one of the executor and it
+        is told about every finished simulation
+        """
+        self.executor = executor
+        self.max_in_flight = max_in_flight
+        self.speculate_after = speculate_after
+        self.speculate_factor = speculate_factor
+        self.n_speculated = 0
+        self.controller = controller
+
+    def run_iter(self, states, testbenches, reduce_fn, verbose=False):
+        """
+        :param states: list of states, dict(param_kwds, param_value), one per design
+        :param testbenches: dict(testbench_name, wrapper)
+        :param reduce_fn: called with dict(testbench_name, specs) and dict(testbench_name, info) when all
+        simulations of a design are done
+        :param verbose: passed on to the wrappers
+        :return:
+            generator of (design_idx, reduce_fn result) in completion order
+        """
+        if self.controller is None:
+            yield from self._run_iter(states, testbenches, reduce_fn, verbose)
+            return
+        # only the time spent in batches counts for the throughput
+        self.controller.begin()
+        try:
+            yield from self._run_iter(states, testbenches, reduce_fn, verbose)
+        finally:
+            self.controller.end()
+
+    def _run_iter(self, states, testbenches, reduce_fn, verbose):
+        names = list(testbenches.keys())
+        pending = [list(names) for _ in states]
+        outstanding = [len(names) for _ in states]
+        # None once the design is reduced, late copies of its tasks are dropped
+        results = [dict() for _ in states]
+        infos = [dict() for _ in states]
+        n_finished = 0
+
+        # heap of (outstanding simulations, design_idx, version), stale entries are skipped when popped
+        versions = [0 for _ in states]
+        ready = [(outstanding[idx], idx, 0) for idx in range(len(states)) if names]
+        heapq.heapify(ready)
+        # dict(future, (design_idx, testbench_name, submit time))
+        in_flight = dict()
+        durations = []
+        speculated = set()
+
+        # losing copies and the leftovers of failed designs are not waited for
+        while (ready or in_flight) and n_finished < len(states):
+            max_in_flight = self.max_in_flight or self._num_workers() * self._deck_size(testbenches)
+            while ready and len(in_flight) < max_in_flight:
+                n_outstanding, idx, version = heapq.heappop(ready)
+                if version != versions[idx] or not pending[idx]:
+                    continue
+                name = pending[idx].pop(0)
+                future = testbenches[name].submit(states[idx], verbose=verbose)
+                in_flight[future] = (idx, name, time.time())
+                if pending[idx]:
+                    heapq.heappush(ready, (n_outstanding, idx, version))
+
+            timeout = None
+            if self.speculate_after is not None and durations and n_finished >= self.speculate_after * len(states):
+                timeout = self._speculate(states, testbenches, in_flight, results, durations, speculated,
+                                         verbose)
+            for testbench in testbenches.values():
+                if hasattr(testbench, 'flush'):
+                    testbench.flush()
+
+            done, _ = concurrent.futures.wait(in_flight, timeout=timeout,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                idx, name, submitted = in_flight.pop(future)
+                if results[idx] is None or name in results[idx]:
+                    # another copy of the task won or the design already failed
+                    continue
+                durations.append(time.time() - submitted)
+                if self.controller is not None:
+                    self.controller.observe()
+                _, specs, info = future.result()
+                results[idx][name] = specs
+                infos[idx][name] = info
+                outstanding[idx] -= 1
+                if specs is None:
+                    # no point in simulating the other testbenches of a failed design
+                    outstanding[idx] = 0
+                    pending[idx] = []
+                if outstanding[idx] == 0:
+                    n_finished += 1
+                    yield idx, reduce_fn(results[idx], infos[idx])
+                    results[idx] = None
+                    infos[idx] = None
+                elif pending[idx]:
+                    # the design got closer to completion, bump its priority
+                    versions[idx] += 1
+                    heapq.heappush(ready, (outstanding[idx], idx, versions[idx]))
+
+    def _speculate(self, states, testbenches, in_flight, results, durations, speculated, verbose):
+        """
+        launches a second copy of the tasks that run for much longer than the median task
+        :return: seconds until the next task becomes a straggler, None if no task can become one
+        """
+        threshold = self.speculate_factor * float(np.median(durations))
+        now = time.time()
+        next_check = None
+        for idx, name, submitted in list(in_flight.values()):
+            if (idx, name) in speculated or results[idx] is None or name in results[idx]:
+                continue
+            remaining = submitted + threshold - now
+            if remaining <= 0:
+                speculated.add((idx, name))
+                self.n_speculated += 1
+                future = testbenches[name].submit(states[idx], verbose=verbose)
+                in_flight[future] = (idx, name, now)
+            elif next_check is None or remaining < next_check:
+                next_check = remaining
+        return next_check
+
+    def _num_workers(self):
+        if self.controller is not None:
+            return self.controller.workers
+        return self.executor.num_workers
+
+    @classmethod
+    def _deck_size(cls, testbenches):
+        sizes = [testbench.get_deck_size() for testbench in testbenches.values()
+                 if hasattr(testbench, 'get_deck_size')]
+        return max(sizes + [1])
+
+    def run(self, states, testbenches, reduce_fn, verbose=False):
+        """
+        same as run_iter but blocks until the whole batch is done and returns the results in the order of states
+        """
+        outputs = [None for _ in states]
+        for idx, output in self.run_iter(states, testbenches, reduce_fn, verbose=verbose):
+            outputs[idx] = output
+        return outputs
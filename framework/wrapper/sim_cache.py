@@ -0,0 +1,205 @@
+import hashlib
+import os
+import pickle
+import re
+import sqlite3
+import subprocess
+import threading
+import time
+import zlib
+
+
+INCLUDE_REGEX = re.compile(r"""^\s*\.(?:include|inc|lib)\s+(?:"([^"]+)"|'([^']+)'|(\S+))""", re.IGNORECASE)
+
+_file_digests = {}
+_simulator_version = None
+
+
+def file_digest(fpath):
+    """
+    sha256 of a file, memoized on its modification time and size
+    """
+    try:
+        stat = os.stat(fpath)
+    except OSError:
+        return 'missing:%s' % fpath
+    memo_key = (fpath, stat.st_mtime, stat.st_size)
+    if memo_key not in _file_digests:
+        with open(fpath, 'rb') as f:
+            _file_digests[memo_key] = hashlib.sha256(f.read()).hexdigest()
+    return _file_digests[memo_key]
+
+
+def model_files(lines, netlist_dir='.'):
+    """
+    :return: paths of the files pulled in by .include/.lib statements of the netlist
+    """
+    paths = []
+    for found in map(INCLUDE_REGEX.match, lines):
+        if found:
+            fpath = next(group for group in found.groups() if group is not None)
+            paths.append(os.path.join(netlist_dir, fpath))
+    return paths
+
+
+def simulator_version():
+    """
+    :return: the version banner of the ngspice found on the path, 'unknown' if it can't be run
+    """
+    global _simulator_version
+    if _simulator_version is None:
+        try:
+            output = subprocess.run(['ngspice', '-v'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    stdin=subprocess.DEVNULL, timeout=30).stdout
+            _simulator_version = ' '.join(output.decode(errors='replace').split())
+        except (OSError, subprocess.SubprocessError):
+            _simulator_version = 'unknown'
+    return _simulator_version
+
+
+class SimulationCache(object):
+    """
+    Persistent cache of simulation results in an SQLite file, addressed by the content of the simulation: the
+    rendered netlist, the model files it includes, the simulator version and the parser that produced the specs.
+    Several processes (and threads) can share the same file. Failures of simulations that exited cleanly (missing
+    outputs, outputs that can't be parsed) are cached as well so known bad designs are never simulated again.
+
+    max_bytes bounds the size of the stored entries, the least recently used ones are evicted first.
+    With store_waveforms the output files of the design are kept (compressed) next to the specs and written back
+    into the design folder on a hit.
+    """
+
+    def __init__(self, path, max_bytes=None, store_waveforms=False):
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.store_waveforms = store_waveforms
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._connect()
+
+    def __getstate__(self):
+        # connections are per process and per thread, the hit counters of every process start at zero
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        state['_local'] = None
+        state['hits'] = 0
+        state['misses'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, info INTEGER, specs BLOB, '
+                         'waveforms BLOB, size INTEGER, created REAL, accessed REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @classmethod
+    def make_key(cls, netlist, model_paths=(), parser='', simulator=None):
+        """
+        :param netlist: the rendered netlist of the design, independent of where its outputs are written
+        :param model_paths: files included by the netlist, their content is part of the key
+        :param parser: identifies the code that turns the outputs into specs (e.g. the wrapper class)
+        :param simulator: simulator version, defaults to the ngspice on the path
+        :return: hex digest addressing the simulation result
+        """
+        digest = hashlib.sha256()
+        digest.update(netlist.encode())
+        for fpath in model_paths:
+            digest.update(file_digest(fpath).encode())
+        digest.update(parser.encode())
+        digest.update((simulator if simulator is not None else simulator_version()).encode())
+        return digest.hexdigest()
+
+    def get(self, key, design_folder=None):
+        """
+        :param key: see make_key
+        :param design_folder: where to restore the stored output files, if any
+        :return: (specs, info) or None if the simulation is not cached
+        """
+        conn = self._connect()
+        row = conn.execute('SELECT info, specs, waveforms FROM results WHERE key = ?', (key,)).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        conn.execute('UPDATE results SET accessed = ? WHERE key = ?', (time.time(), key))
+
+        info, specs, waveforms = row
+        if waveforms is not None and design_folder is not None:
+            os.makedirs(design_folder, exist_ok=True)
+            for fname, content in pickle.loads(zlib.decompress(waveforms)).items():
+                with open(os.path.join(design_folder, fname), 'wb') as f:
+                    f.write(content)
+        return pickle.loads(zlib.decompress(specs)), info
+
+    def put(self, key, specs, info, output_files=()):
+        """
+        :param specs: whatever the parser returned (None for simulations whose outputs could not be parsed)
+        :param info: 0 if no error occurred, 1 otherwise
+        :param output_files: paths of the output files, stored if store_waveforms is set
+        """
+        specs_blob = zlib.compress(pickle.dumps(specs, protocol=pickle.HIGHEST_PROTOCOL))
+        waveforms_blob = None
+        if self.store_waveforms and output_files:
+            waveforms = dict()
+            for fpath in output_files:
+                if os.path.isfile(fpath):
+                    with open(fpath, 'rb') as f:
+                        waveforms[os.path.basename(fpath)] = f.read()
+            waveforms_blob = zlib.compress(pickle.dumps(waveforms, protocol=pickle.HIGHEST_PROTOCOL))
+        size = len(specs_blob) + (len(waveforms_blob) if waveforms_blob is not None else 0)
+
+        now = time.time()
+        conn = self._connect()
+        conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (key, info, specs_blob, waveforms_blob, size, now, now))
+        if self.max_bytes is not None:
+            self.evict()
+
+    def evict(self):
+        """
+        drops the least recently used entries until the cache is within max_bytes again
+        """
+        conn = self._connect()
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            evicted = []
+            for key, size in conn.execute('SELECT key, size FROM results ORDER BY accessed'):
+                if total <= self.max_bytes:
+                    break
+                evicted.append((key,))
+                total -= size
+            conn.executemany('DELETE FROM results WHERE key = ?', evicted)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def stats(self):
+        """
+        :return: dict with the hit/miss counters of this process and the size of the cache
+        """
+        conn = self._connect()
+        entries, size, failures = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0), '
+                                               'COALESCE(SUM(info != 0), 0) FROM results').fetchone()
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, hit_rate=self.hits / lookups if lookups else 0.0,
+                    entries=entries, failures=failures, bytes=size)
@@ -0,0 +1,87 @@
+import concurrent.futures
+import threading
+
+
+class SingleFlight(object):
+    """
+    Coalesces duplicate work: while a key is pending or in flight, callers asking for the same key get the future of
+    the running call instead of starting another one. Works across threads and event loops (await the future with
+    asyncio.wrap_future).
+
+    The caller that claims a key first is its leader and has to resolve it, the others only wait.
+    """
+
+    def __init__(self):
+        self.n_calls = 0
+        self.n_coalesced = 0
+        # dict(key, future) of the keys that are pending or in flight
+        self._futures = dict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_futures'] = dict()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def claim(self, key, n_callers=1):
+        """
+        :param n_callers: number of requests for key the caller stands for (e.g. duplicates within a batch), all
+        but one of them are counted as coalesced
+        :return:
+            future: resolves to the result for key
+            leader: True if the caller has to do the work and resolve the future, False if it only waits
+        """
+        with self._lock:
+            self.n_calls += n_callers
+            future = self._futures.get(key)
+            if future is not None:
+                self.n_coalesced += n_callers
+                return future, False
+            self.n_coalesced += n_callers - 1
+            future = concurrent.futures.Future()
+            future.set_running_or_notify_cancel()
+            self._futures[key] = future
+            return future, True
+
+    def resolve(self, key, future, result=None, exception=None):
+        """
+        sets the result (or exception) of a claimed key, later calls for the key start over
+        """
+        with self._lock:
+            if self._futures.get(key) is future:
+                del self._futures[key]
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        runs fn(*args, **kwargs) unless a call for key is already in flight, in which case its result is returned
+        """
+        future, leader = self.claim(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self.resolve(key, future, exception=e)
+            raise
+        self.resolve(key, future, result)
+        return result
+
+    def __len__(self):
+        return len(self._futures)
+
+    def stats(self):
+        """
+        :return: dict with the number of calls and how many of them were coalesced, i.e. simulations saved
+        """
+        return dict(calls=self.n_calls, coalesced=self.n_coalesced, in_flight=len(self._futures))
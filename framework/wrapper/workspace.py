@@ -0,0 +1,130 @@
+import heapq
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+
+
+class Workspace(object):
+    """
+    Hands out scratch folders (slots) to simulation jobs and recycles them once the outputs are parsed, instead of
+    leaving one folder per design behind. Every job gets its own slot, so concurrent jobs never share a folder,
+    even when they simulate the same design.
+
+    Artifacts of a job can be kept by moving its slot to keep_dir:
+        keep: none, failed (jobs that errored or whose outputs could not be parsed) or all
+        top_k: the k best jobs according to the spec rank_by, rank_order is max or min
+    """
+
+    KEEP = ('none', 'failed', 'all')
+
+    def __init__(self, root=None, keep='failed', keep_dir=None, top_k=0, rank_by=None, rank_order='max'):
+        """
+        :param root: where the slots are created, preferably a tmpfs. Defaults to /dev/shm/circuit_drl if /dev/shm
+        exists and to /tmp/circuit_drl/scratch otherwise.
+        :param keep_dir: where kept artifacts go, defaults to /tmp/circuit_drl/kept
+        """
+        if keep not in Workspace.KEEP:
+            raise ValueError('unknown keep policy %s, expected one of %s' % (keep, Workspace.KEEP))
+        if rank_order not in ('max', 'min'):
+            raise ValueError('rank_order should be max or min, got %s' % rank_order)
+        if root is None:
+            root = '/dev/shm/circuit_drl' if os.path.isdir('/dev/shm') else '/tmp/circuit_drl/scratch'
+        self.root = os.path.abspath(root)
+        self.keep = keep
+        self.keep_dir = os.path.abspath(keep_dir or '/tmp/circuit_drl/kept')
+        self.top_k = top_k
+        self.rank_by = rank_by
+        self.rank_order = rank_order
+        os.makedirs(self.root, exist_ok=True)
+
+        self._free = []
+        self._top = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # every process recycles its own slots
+        state = self.__dict__.copy()
+        state['_free'] = []
+        state['_top'] = []
+        state['_counter'] = None
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        :return: path of an empty folder that belongs to the caller until release
+        """
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return tempfile.mkdtemp(prefix='slot_', dir=self.root)
+
+    def release(self, slot, name, specs=None, failed=False):
+        """
+        hands the slot back once its outputs are parsed, keeping its artifacts if the policy asks for it
+        :param slot: folder returned by acquire
+        :param name: name of the design, used as folder name for kept artifacts
+        :param specs: specs parsed from the outputs, used for top_k ranking
+        :param failed: True if the simulation errored or the outputs could not be parsed
+        """
+        if self.keep == 'all' or (failed and self.keep == 'failed'):
+            self._move(slot, os.path.join(self.keep_dir, 'failed' if failed else 'all', name))
+            return
+        if not failed and self.top_k > 0 and self._rank(slot, name, specs):
+            return
+        self._clear(slot)
+        with self._lock:
+            self._free.append(slot)
+
+    def _rank(self, slot, name, specs):
+        try:
+            score = float(specs[self.rank_by])
+        except (TypeError, KeyError, ValueError):
+            return False
+        # the heap keeps the worst of the kept designs on top
+        key = score if self.rank_order == 'max' else -score
+        dest = os.path.join(self.keep_dir, 'top', name)
+        with self._lock:
+            if len(self._top) < self.top_k:
+                heapq.heappush(self._top, (key, next(self._counter), dest))
+                dropped = None
+            elif key > self._top[0][0]:
+                dropped = heapq.heapreplace(self._top, (key, next(self._counter), dest))[2]
+            else:
+                return False
+        if dropped is not None and dropped != dest:
+            shutil.rmtree(dropped, ignore_errors=True)
+        self._move(slot, dest)
+        return True
+
+    @classmethod
+    def _move(cls, slot, dest):
+        if os.path.exists(dest):
+            shutil.rmtree(dest, ignore_errors=True)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.move(slot, dest)
+
+    @classmethod
+    def _clear(cls, slot):
+        for entry in os.scandir(slot):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+
+    def close(self):
+        """
+        removes the idle slots of this process
+        """
+        with self._lock:
+            free, self._free = self._free, []
+        for slot in free:
+            shutil.rmtree(slot, ignore_errors=True)
@@ -47,7 +47,7 @@ class EvaluationCore(object):
         # specs
         import yaml
         with open(cir_yaml, 'r') as f:
-            yaml_data = yaml.load(f)
+            yaml_data = yaml.load(f, Loader=yaml.FullLoader)
 
         # specs
         specs = yaml_data['target_specs']
@@ -7,6 +7,7 @@ import os
 import yaml
 import importlib
 import copy
+from collections import OrderedDict
 import math
 import pickle
 import time
@@ -37,15 +38,20 @@ def generate_data_set(n, eval_core, evaluate=True):
             param_list.append(param_value)
 
         sample_dsn = Design(param_list)
-        if evaluate:
-            result = eval_core.cost_fun(sample_dsn)
-            sample_dsn.cost = result[0]
-            for i, key in enumerate(sample_dsn.specs.keys()):
-                sample_dsn.specs[key] = result[i+1]
         data_set.append(sample_dsn)
 
+    if evaluate:
+        evaluate_designs(data_set, eval_core)
+
     return data_set
 
+def evaluate_designs(designs, eval_core):
+    # the whole set is scheduled as one batch, each design is filled in as soon as its simulations finish
+    for i, row in eval_core.cost_fun_iter(designs):
+        designs[i].cost = row['cost']
+        for key, result_key in zip(designs[i].specs.keys(), eval_core.result_keys[1:]):
+            designs[i].specs[key] = row[result_key]
+
 def generate_offspring(population, eval_core, cxpb, mutpb):
 
     assert (cxpb + mutpb) <= 1.0, (
@@ -84,6 +90,8 @@ def run_ga(init_pop, pop_size, offspring_size, ngen, eval_core, stats, history,
     pop = copy.deepcopy(init_pop)
     for gen in range(1, ngen+1):
         offsprings = []
+        # dict(design indices, designs sharing them), duplicates are only simulated once
+        pending = OrderedDict()
         n_iter = 0
         while len(offsprings) < offspring_size and n_iter < max_iter:
             n_iter += 1
@@ -93,8 +101,13 @@ def run_ga(init_pop, pop_size, offspring_size, ngen, eval_core, stats, history,
                     # if design is already in the design pool skip ...
                     # print("[debug] design {} already exists".format(new_design))
                     continue
-                new_design.cost = eval_core.cost_fun(new_design)[0]
+                pending.setdefault(tuple(new_design), []).append(new_design)
             offsprings += new_designs
+        # the offsprings of the generation are scheduled as one batch, costs are filled in as they come back
+        unique_designs = [designs[0] for designs in pending.values()]
+        for i, row in eval_core.cost_fun_iter(unique_designs):
+            for new_design in pending[tuple(unique_designs[i])]:
+                new_design.cost = row['cost']
         total_n_evals += len(offsprings)
         pop[:] = es.select(pop+offsprings, pop_size)
 
@@ -127,12 +140,12 @@ def main():
     # get the yaml file
     cir_yaml = os.path.join(FRAMEWORK_YAML_DIR, args.yaml_fname+".yaml")
     with open(cir_yaml, 'r') as f:
-        yaml_data = yaml.load(f)
+        yaml_data = yaml.load(f, Loader=yaml.FullLoader)
 
     # setup the simulator module
     wrapper_name = yaml_data['wrapper_name']
     sim = importlib.import_module('framework.wrapper.%s' % wrapper_name)
-    eval_core = sim.EvaluationCore(cir_yaml)
+    eval_core = getattr(sim, yaml_data.get('core_name', 'EvaluationCore'))(cir_yaml)
 
     # setup the seed
     np.random.seed(args.seed)
@@ -154,6 +167,8 @@ def main():
         pop = generate_data_set(args.n_init_pop, eval_core)
         with open('genetic_nn/checkpoint/two_stage/init_data.pkl', 'wb') as f:
             pickle.dump(pop, f)
+    # designs of the initial population are never simulated again during the run
+    eval_core.preload_memo(pop)
 
     init_data_time = time.time()
     pop, total_n_evals = run_ga(init_pop=pop,
@@ -178,6 +193,12 @@ def main():
     print("[finished] best_solution = {}".format(pop_sorted[0]))
     print("[finished] cost = {}".format(pop_sorted[0].cost))
     print("[finished] performance \n{} ".format(pop_sorted[0].specs))
+    if eval_core.memo is not None:
+        print("[finished] memo = {}".format(eval_core.memo.stats()))
+    print("[finished] coalesced in-flight duplicates = {}".format(eval_core.single_flight.stats()))
+    for name, savings in eval_core.transient_savings().items():
+        print("[finished] {} transient: {:.1%} of the simulated time saved by tran_stop ({})".format(
+            name, savings['saved'], savings))
 
 if __name__ == '__main__':
     main()
@@ -83,15 +83,23 @@ def generate_data_set(n=10, evaluate=True):
         cc_idx =  random.randint(0 ,len(eval_core.cc_vec)-1)
 
         sample_dsn = Design([mp1_idx, mn1_idx, mn3_idx, mp3_idx, mn5_idx, mn4_idx, cc_idx])
-        if evaluate:
-            result = evaluate_individual(sample_dsn, verbose=False)
-            sample_dsn.cost = result[0]
-            for i, key in enumerate(sample_dsn.specs.keys()):
-                sample_dsn.specs[key] = result[i+1]
         data_set.append(sample_dsn)
 
+    if evaluate:
+        evaluate_designs(data_set)
+
     return data_set
 
+def set_design_results(dsn, row):
+    dsn.cost = row['cost']
+    for key, result_key in zip(dsn.specs.keys(), eval_core.result_keys[1:]):
+        dsn.specs[key] = row[result_key]
+
+def evaluate_designs(designs):
+    # the whole set is scheduled as one batch, each design is filled in as soon as its simulations finish
+    for i, row in eval_core.cost_fun_iter(designs):
+        set_design_results(designs[i], row)
+
 
 
 
@@ -445,6 +453,8 @@ def run_model(session, db, population, m_samples, ref_dsn, max_iter=1000):
 
     better_dsns = []
     better_dsns_pred = []
+    # the candidates of a model step are simulated in the background while the model keeps searching
+    pending = []
     sorted_population = sorted(population, key=lambda x: x.cost)
     for i in range(ref_dsn_idx):
         print("[Debug_test] dataset: {} -> {}".format(sorted_population[i], sorted_population[i].cost))
@@ -454,6 +464,7 @@ def run_model(session, db, population, m_samples, ref_dsn, max_iter=1000):
         # new_designs = generate_data_set(1, evaluate=False)
         # new_design = new_designs[0]
         new_designs = generate_offspring(copy.deepcopy(population), es.G.cxpb, es.G.mutpb)
+        step_dsns = []
         for new_design in new_designs:
             # print('[run_model]:', new_design)
             if any([(new_design == row) for row in db]):
@@ -475,6 +486,7 @@ def run_model(session, db, population, m_samples, ref_dsn, max_iter=1000):
             if np.argmax(prediction) == 0:
                 better_dsns.append(new_design)
                 better_dsns_pred.append(prediction)
+                step_dsns.append(new_design)
             else:
                 pass
             # just a sanity check for not too complicated circuit problems: run simulation for anything to make sure
@@ -484,6 +496,9 @@ def run_model(session, db, population, m_samples, ref_dsn, max_iter=1000):
             # if cost < cost_pool[ref_dsn_idx]:
             #     print("[debug] design {} with cost {} was better but missed with prediction {}".format(new_design, cost,
             #                                                                                            prediction))
+        if step_dsns:
+            on_done = lambda idx, row, dsns=step_dsns: set_design_results(dsns[idx], row)
+            pending += eval_core.cost_fun_submit(step_dsns, callback=on_done)
         if len(better_dsns) >= m_samples or cnt >= max_iter:
             break
 
@@ -493,11 +508,9 @@ def run_model(session, db, population, m_samples, ref_dsn, max_iter=1000):
     # print("[better designs]")
     # for better_dsn in better_dsns: print("{}" .format(better_dsn))
 
-    for i in range(len(better_dsns)):
-        result = evaluate_individual(better_dsns[i], verbose=False)
-        better_dsns[i].cost = result[0]
-        for j, key in enumerate(better_dsns[i].specs.keys()):
-            better_dsns[i].specs[key] = result[j+1]
+    # wait for the stragglers, result() re-raises simulation errors
+    for future in pending:
+        future.result()
 
     # print("[pop-]")
     # for ind in sorted_population: print("{}".format(ind.cost))
@@ -730,6 +743,7 @@ def main():
             saver.restore(session, os.path.join(args.model_dir, 'checkpoint.ckpt'))
             with open(os.path.join(args.model_dir, 'data.pkl'), 'rb') as f:
                 db = pickle.load(f)
+        eval_core.preload_memo(db)
 
         # test_swaping(session, db)
 
@@ -45,6 +45,12 @@ def evaluate_individual(individual, verbose=False):
     cost_val = eval_core.cost_fun(int(res_idx), int(mul_idx), verbose)
     return (cost_val,)
 
+def evaluate_population(evaluate, individuals):
+    # registered as toolbox.map: a whole generation is submitted to the evaluation core as one batch
+    designs = [(int(ind[0]), int(ind[1])) for ind in individuals]
+    costs = eval_core.cost_fun_batch(designs)['cost']
+    return [(cost,) for cost in costs]
+
 
 ######################################################################
 ## helper functions for opt_core
@@ -79,6 +85,7 @@ toolbox.register("individual", init_inividual)
 toolbox.register("population", tools.initRepeat, list, toolbox.individual)
 
 toolbox.register("evaluate", evaluate_individual)
+toolbox.register("map", evaluate_population)
 toolbox.register("select", tools.selBest)
 toolbox.register("mate", tools.cxOnePoint)
 toolbox.register("mutate", tools.mutUniformInt, low=[0, 0], up=[len(eval_core.res_vec)-1,
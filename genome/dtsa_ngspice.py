@@ -42,6 +42,11 @@ def evaluate_individual(individual, verbose=False):
     cost_val = eval_core.cost_fun(verbose=verbose, **param_dict)
     return (cost_val,)
 
+def evaluate_population(evaluate, individuals):
+    # registered as toolbox.map: a whole generation is submitted to the evaluation core as one batch
+    costs = eval_core.cost_fun_batch([list(ind) for ind in individuals])['cost']
+    return [(cost,) for cost in costs]
+
 
 ######################################################################
 ## helper functions for opt_core
@@ -78,6 +83,7 @@ toolbox.register("individual", init_inividual)
 toolbox.register("population", tools.initRepeat, list, toolbox.individual)
 
 toolbox.register("evaluate", evaluate_individual)
+toolbox.register("map", evaluate_population)
 toolbox.register("select", tools.selBest)
 toolbox.register("mate", tools.cxOnePoint)
 toolbox.register("mutate", tools.mutGaussian, mu=[50, 50, 50, 50, 50, 50, 50], sigma=[10, 10, 10, 10, 10, 10, 10], indpb=0.05)
@@ -53,10 +53,8 @@ def init_inividual():
                                mn4_idx,
                                cc_idx])
 
-def evaluate_individual(individual, verbose=False):
-    # TODO
-    # returns a scalar number representing the cost function of that individual
-    # return (sum(individual),)
+def individual_to_design(individual):
+    # individuals are [mp1, mn1, mn3, mp3, mn5, mn4, cc], the evaluation core wants the order of the yaml file
     mp1_idx = int(individual[0])
     mn1_idx = int(individual[1])
     mn3_idx = int(individual[2])
@@ -64,9 +62,21 @@ def evaluate_individual(individual, verbose=False):
     mn5_idx = int(individual[4])
     mn4_idx = int(individual[5])
     cc_idx  = int(individual[6])
-    cost_val = eval_core.cost_fun(mp1_idx, mn1_idx, mp3_idx, mn3_idx, mn4_idx, mn5_idx, cc_idx, verbose=verbose)
+    return [mp1_idx, mn1_idx, mp3_idx, mn3_idx, mn4_idx, mn5_idx, cc_idx]
+
+def evaluate_individual(individual, verbose=False):
+    # TODO
+    # returns a scalar number representing the cost function of that individual
+    # return (sum(individual),)
+    cost_val = eval_core.cost_fun(individual_to_design(individual), verbose=verbose)[0]
     return (cost_val,)
 
+def evaluate_population(evaluate, individuals):
+    # registered as toolbox.map: a whole generation is submitted to the evaluation core as one batch
+    designs = [individual_to_design(ind) for ind in individuals]
+    costs = eval_core.cost_fun_batch(designs)['cost']
+    return [(cost,) for cost in costs]
+
 
 ######################################################################
 ## helper functions for opt_core
@@ -103,6 +113,7 @@ toolbox.register("individual", init_inividual)
 toolbox.register("population", tools.initRepeat, list, toolbox.individual)
 
 toolbox.register("evaluate", evaluate_individual)
+toolbox.register("map", evaluate_population)
 toolbox.register("select", tools.selTournament, tournsize=2)
 toolbox.register("mate", tools.cxOnePoint)
 # toolbox.register("mutate", tools.mutGaussian, mu=[50, 50, 50, 50, 50, 50, 5e-12], sigma=[10, 10, 10, 10, 10, 10, 1e-12], indpb=0.05)
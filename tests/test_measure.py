@@ -0,0 +1,187 @@
+"""
+The batch kernels of framework.wrapper.measure against the per design scipy path they replaced: _get_best_crossing,
+find_phm and find_bw of the wrappers for the ac sweeps, get_tset and the quadratic interp1d of DTSA for the
+transients. The waveforms are synthetic, no simulator is needed.
+"""
+import numpy as np
+import pytest
+import scipy.interpolate as interp
+import scipy.optimize as sciopt
+
+from framework.wrapper import measure
+
+
+def two_pole_responses(n, seed=0):
+    """
+    :return: freq (n_points), vout (n x n_points) of two pole amplifiers with a right half plane zero, on the
+    sweep of the two stage testbenches (dec 10 1 10G)
+    """
+    rng = np.random.RandomState(seed)
+    freq = np.logspace(0, 10, 101)
+    s = 2j * np.pi * freq
+    gain = 10 ** rng.uniform(1.5, 4, size=(n, 1))
+    p1 = 10 ** rng.uniform(2, 5, size=(n, 1))
+    p2 = 10 ** rng.uniform(6, 9, size=(n, 1))
+    z = 10 ** rng.uniform(8, 10, size=(n, 1))
+    vout = gain * (1 - s / (2 * np.pi * z)) / ((1 + s / (2 * np.pi * p1)) * (1 + s / (2 * np.pi * p2)))
+    return freq, vout
+
+
+def step_responses(n, n_samples=2000, seed=0):
+    """
+    :return: t, vout, vin (n x n_samples) of underdamped unity gain buffers with a 20 mV input step, on a slightly
+    different time grid per design
+    """
+    rng = np.random.RandomState(seed)
+    t = np.sort(rng.uniform(0, 1e-6, size=(n, n_samples)), axis=1)
+    t[:, 0] = 0
+    wn = 2 * np.pi * 10 ** rng.uniform(7, 8.5, size=(n, 1))
+    zeta = rng.uniform(0.3, 0.95, size=(n, 1))
+    wd = wn * np.sqrt(1 - zeta ** 2)
+    step = 1 - np.exp(-zeta * wn * t) * (np.cos(wd * t) + zeta * wn / wd * np.sin(wd * t))
+    vin = 0.6 + 20e-3 * (t > 0)
+    vout = 0.6 + 20e-3 * step
+    return t, vout, vin
+
+
+def best_crossing(xvec, yvec, val):
+    interp_fun = interp.InterpolatedUnivariateSpline(xvec, yvec)
+
+    def fzero(x):
+        return interp_fun(x) - val
+
+    xstart, xstop = xvec[0], xvec[-1]
+    try:
+        return sciopt.brentq(fzero, xstart, xstop)
+    except ValueError:
+        if abs(fzero(xstart)) < abs(fzero(xstop)):
+            return xstart
+        return xstop
+
+
+def find_phm(freq, vout):
+    gain = np.abs(vout)
+    phase = np.rad2deg(np.unwrap(np.angle(vout)))
+    phase_fun = interp.interp1d(freq, phase, kind='quadratic')
+    ugbw = best_crossing(freq, gain, 1)
+    if phase_fun(ugbw) > 0:
+        return -180 + phase_fun(ugbw)
+    return 180 + phase_fun(ugbw)
+
+
+def get_tset(t, vout, vin, fbck, tot_err=0.1):
+    ref_value = 1 / fbck * vin
+    y = (vout - vout[0]) / (ref_value[-1] - ref_value[0])
+    last_idx = np.where(y < 1.0 - tot_err)[0][-1]
+    last_max_vec = np.where(y > 1.0 + tot_err)[0]
+    if last_max_vec.size > 0 and last_max_vec[-1] > last_idx:
+        last_idx = last_max_vec[-1]
+        last_val = 1.0 + tot_err
+    else:
+        last_val = 1.0 - tot_err
+    if last_idx == t.size - 1:
+        return t[-1]
+    f = interp.InterpolatedUnivariateSpline(t, y - last_val)
+    return sciopt.brentq(f, t[last_idx], t[last_idx + 1])
+
+
+def test_ac_specs_match_scipy_path():
+    freq, vout = two_pole_responses(50)
+    specs = measure.ac_specs(freq, vout)
+    bw = measure.bandwidth_3db(freq, vout)
+    for row in range(vout.shape[0]):
+        gain = np.abs(vout[row])
+        assert specs['gain'][row] == pytest.approx(gain[0])
+        assert specs['ugbw'][row] == pytest.approx(best_crossing(freq, gain, 1), rel=1e-9)
+        assert specs['phm'][row] == pytest.approx(find_phm(freq, vout[row]), abs=1e-6)
+        assert bw[row] == pytest.approx(best_crossing(freq, gain, gain[0] / np.sqrt(2)), rel=1e-9)
+
+
+def test_linear_crossing_is_close_to_scipy_path():
+    freq, vout = two_pole_responses(50)
+    ugbw = measure.unity_gain_frequency(freq, vout, refine=False)
+    reference = np.array([best_crossing(freq, np.abs(row), 1) for row in vout])
+    np.testing.assert_allclose(ugbw, reference, rtol=1e-2)
+
+
+def test_crossing_without_sign_change_takes_closer_end():
+    freq = np.logspace(0, 3, 31)
+    # always above 1 and getting closer to it, the fallback is the last point
+    gain = np.atleast_2d(10 - 8 * np.linspace(0, 1, 31))
+    x_cross, _, found = measure.crossing(freq, gain, 1.0, log_y=True)
+    assert not found[0]
+    assert x_cross[0] == pytest.approx(freq[-1])
+    assert x_cross[0] == pytest.approx(best_crossing(freq, gain[0], 1))
+
+
+def test_phase_margin_is_nan_for_positive_start():
+    freq, vout = two_pole_responses(1)
+    # a non inverting response that starts just above 0 degrees after unwrapping
+    shifted = vout * np.exp(1j * np.deg2rad(10))
+    assert np.isnan(measure.phase_margin(freq, shifted)[0])
+
+
+@pytest.mark.parametrize('tot_err', [0.01, 0.1])
+def test_settling_time_matches_get_tset(tot_err):
+    t, vout, vin = step_responses(20)
+    tset = measure.settling_time(t, vout, vin, 1.0, tot_err=tot_err)
+    for row in range(t.shape[0]):
+        assert tset[row] == pytest.approx(get_tset(t[row], vout[row], vin[row], 1.0, tot_err), rel=1e-6)
+
+
+def test_settling_time_of_unsettled_design_is_last_time():
+    t = np.linspace(0, 1e-6, 101)
+    vin = 0.6 + 20e-3 * (t > 0)
+    # a slow ramp that only reaches 50% of the step
+    vout = 0.6 + 10e-3 * t / t[-1]
+    vin[-1] = vin[-2]
+    assert measure.settling_time(t, vout, vin, 1.0)[0] == t[-1]
+    assert get_tset(t, vout, vin, 1.0) == t[-1]
+
+
+def test_settling_time_of_stacked_rows_of_different_lengths():
+    t, vout, vin = step_responses(3)
+    lengths = [2000, 1500, 1800]
+    t_rows, lengths_out = measure.stack([t[i, :n] for i, n in enumerate(lengths)])
+    vout_rows, _ = measure.stack([vout[i, :n] for i, n in enumerate(lengths)])
+    vin_rows, _ = measure.stack([vin[i, :n] for i, n in enumerate(lengths)])
+    tset = measure.settling_time(t_rows, vout_rows, vin_rows, 1.0, tot_err=0.01, lengths=lengths_out)
+    for i, n in enumerate(lengths):
+        single = measure.settling_time(t[i, :n], vout[i, :n], vin[i, :n], 1.0, tot_err=0.01)[0]
+        assert tset[i] == single
+
+
+def test_sample_at_matches_quadratic_interp1d():
+    t, vout, _ = step_responses(10)
+    times = (7e-9, 9e-9, 3e-7)
+    samples = measure.sample_at(t, vout, times)
+    for row in range(t.shape[0]):
+        vout_func = interp.interp1d(t[row], vout[row], kind='quadratic')
+        # interp1d fits a quadratic spline through the whole row, sample_at a parabola through three samples
+        np.testing.assert_allclose(samples[row], [vout_func(time) for time in times], rtol=0, atol=1e-3 * 20e-3)
+
+
+def test_mean_and_offset():
+    y, lengths = measure.stack([np.array([1.0, 2.0, 3.0]), np.array([4.0, 6.0])])
+    np.testing.assert_allclose(measure.mean(y, lengths), [2.0, 5.0])
+    np.testing.assert_allclose(measure.last_values(y, lengths), [3.0, 6.0])
+    assert measure.offset([[0.61, 0.7]], [[0.6, 0.62]], 1.0)[0] == pytest.approx(0.01)
+
+
+def test_time_average_weights_the_time_steps():
+    t, vout, _ = step_responses(5)
+    average = measure.time_average(t, vout)
+    for row in range(t.shape[0]):
+        # meas avg of ngspice: the trapezoidal integral over the time span
+        reference = np.sum(0.5 * (vout[row, 1:] + vout[row, :-1]) * np.diff(t[row])) / (t[row, -1] - t[row, 0])
+        assert average[row] == pytest.approx(reference, rel=1e-12)
+
+    # dense steps on the edge of a pulse do not pull the average towards it, unlike mean
+    t = np.array([0.0, 1e-12, 2e-12, 3e-12, 1e-9])
+    y = np.array([1.0, 1.0, 1.0, 0.0, 0.0])
+    assert measure.time_average(t, y)[0] == pytest.approx(2.5e-12 / 1e-9)
+    assert measure.mean(y)[0] == pytest.approx(0.6)
+
+    y_rows, lengths = measure.stack([y, y[:4]])
+    t_rows, _ = measure.stack([t, t[:4]])
+    np.testing.assert_allclose(measure.time_average(t_rows, y_rows, lengths), [2.5e-12 / 1e-9, 2.5 / 3])
@@ -0,0 +1,187 @@
+"""
+Round trips through the output formats of the wrappers: binary rawfiles (read_raw) and wrdata tables
+(NgSpiceWrapper.read_wrdata, Vectors.from_wrdata), real and complex, including files cut short by an aborted
+simulation.
+"""
+import numpy as np
+import pytest
+
+from framework.wrapper.rawfile import Vectors, read_raw
+from framework.wrapper.ngspice_wrapper import NgSpiceWrapper, CsAmpClass
+
+
+def raw_plot(names, data, plotname='Transient Analysis'):
+    """
+    :return: the bytes of one plot of a binary rawfile as ngspice writes it
+    """
+    flags = 'complex' if np.iscomplexobj(data) else 'real'
+    lines = ['Title: test', 'Date: today', 'Plotname: %s' % plotname, 'Flags: %s' % flags,
+             'No. Variables: %d' % len(names), 'No. Points: %d' % data.shape[0], 'Variables:']
+    lines += ['\t%d\t%s\t%s' % (i, name, 'time' if i == 0 else 'voltage') for i, name in enumerate(names)]
+    header = ('\n'.join(lines) + '\nBinary:\n').encode('ascii')
+    dtype = np.complex128 if flags == 'complex' else np.float64
+    return header + np.ascontiguousarray(data, dtype=dtype).tobytes()
+
+
+def write_wrdata(fpath, scale, values):
+    """
+    writes a wrdata table: a header line, then a scale column followed by the real (and imaginary) column of every
+    vector
+    """
+    columns = []
+    for value in values:
+        columns.append(scale)
+        if np.iscomplexobj(value):
+            columns += [value.real, value.imag]
+        else:
+            columns.append(value)
+    with open(fpath, 'w') as f:
+        f.write(' '.join('col%d' % i for i in range(len(columns))) + '\n')
+        np.savetxt(f, np.column_stack(columns), fmt='%.17e')
+    return np.column_stack(columns)
+
+
+def test_real_rawfile_round_trip(tmp_path):
+    time = np.linspace(0, 1e-9, 11)
+    data = np.column_stack([time, np.sin(time * 1e9), np.cos(time * 1e9)])
+    fpath = tmp_path / 'tran.raw'
+    fpath.write_bytes(raw_plot(['time', 'v(out)', 'v(in)'], data))
+
+    plots = read_raw(str(fpath))
+    assert len(plots) == 1
+    plot = plots[0]
+    assert not plot.is_complex
+    assert plot.names == ['time', 'v(out)', 'v(in)']
+    np.testing.assert_array_equal(plot['v(out)'], data[:, 1])
+
+    vectors = plot.vectors(2)
+    np.testing.assert_array_equal(vectors.scale, time)
+    np.testing.assert_array_equal(vectors['v(in)'], data[:, 2])
+    np.testing.assert_array_equal(vectors[0], data[:, 1])
+
+
+def test_complex_rawfile_round_trip(tmp_path):
+    freq = np.logspace(0, 9, 10)
+    vout = 100 / (1 + 1j * freq / 1e5)
+    data = np.column_stack([freq.astype(complex), vout])
+    fpath = tmp_path / 'ac.raw'
+    fpath.write_bytes(raw_plot(['frequency', 'v(out)'], data, plotname='AC Analysis'))
+
+    plot = read_raw(str(fpath))[0]
+    assert plot.is_complex
+    vectors = plot.vectors(1)
+    # the scale of complex plots is stored as complex as well, vectors hands back its real part
+    assert not np.iscomplexobj(vectors.scale)
+    np.testing.assert_array_equal(vectors.scale, freq)
+    np.testing.assert_array_equal(vectors[0], vout)
+
+
+def test_rawfile_with_several_plots(tmp_path):
+    time = np.linspace(0, 1, 5)
+    freq = np.logspace(0, 4, 3)
+    tran = np.column_stack([time, 2 * time])
+    ac = np.column_stack([freq.astype(complex), 1j * freq])
+    fpath = tmp_path / 'both.raw'
+    fpath.write_bytes(raw_plot(['time', 'v(out)'], tran) + raw_plot(['frequency', 'v(out)'], ac, 'AC Analysis'))
+
+    tran_plot, ac_plot = read_raw(str(fpath))
+    np.testing.assert_array_equal(tran_plot['v(out)'], tran[:, 1])
+    assert ac_plot.plotname == 'AC Analysis'
+    np.testing.assert_array_equal(ac_plot['v(out)'], ac[:, 1])
+
+
+def test_truncated_rawfile_keeps_complete_points(tmp_path):
+    time = np.linspace(0, 1, 10)
+    data = np.column_stack([time, time ** 2])
+    content = raw_plot(['time', 'v(out)'], data)
+    # the simulation was killed in the middle of the 8th point
+    fpath = tmp_path / 'tran.raw'
+    fpath.write_bytes(content[:len(content) - 2 * 16 - 8])
+
+    plot = read_raw(str(fpath))[0]
+    assert plot.data.shape == (7, 2)
+    np.testing.assert_array_equal(plot['v(out)'], data[:7, 1])
+
+
+def test_empty_and_ascii_rawfiles(tmp_path):
+    empty = tmp_path / 'empty.raw'
+    empty.write_bytes(b'')
+    assert read_raw(str(empty)) == []
+
+    ascii_raw = tmp_path / 'ascii.raw'
+    ascii_raw.write_bytes(b'Title: test\nPlotname: Transient Analysis\nFlags: real\nNo. Variables: 1\n'
+                          b'No. Points: 1\nVariables:\n\t0\ttime\ttime\nValues:\n0\t0.0\n')
+    with pytest.raises(ValueError):
+        read_raw(str(ascii_raw))
+
+
+def test_real_wrdata_round_trip(tmp_path):
+    time = np.linspace(0, 1e-9, 21)
+    values = [np.sin(time * 1e9), np.cos(time * 1e9), time * 1e9]
+    fpath = tmp_path / 'tran.csv'
+    table = write_wrdata(str(fpath), time, values)
+
+    vectors = NgSpiceWrapper.read_wrdata(str(fpath), len(values))
+    np.testing.assert_array_equal(vectors.scale, time)
+    for read, written in zip(vectors, values):
+        np.testing.assert_array_equal(read, written)
+
+    # the in-memory tables of the shared backend go through from_wrdata
+    from_table = Vectors.from_wrdata(table, len(values))
+    for read, written in zip(from_table, values):
+        np.testing.assert_array_equal(read, written)
+
+
+def test_complex_wrdata_round_trip(tmp_path):
+    freq = np.logspace(0, 9, 19)
+    values = [100 / (1 + 1j * freq / 1e5), 1 / (1 + 1j * freq / 1e7)]
+    fpath = tmp_path / 'ac.csv'
+    table = write_wrdata(str(fpath), freq, values)
+
+    vectors = NgSpiceWrapper.read_wrdata(str(fpath), len(values))
+    np.testing.assert_array_equal(vectors.scale, freq)
+    for read, written in zip(vectors, values):
+        assert np.iscomplexobj(read)
+        np.testing.assert_array_equal(read, written)
+
+    from_table = Vectors.from_wrdata(table, len(values))
+    for read, written in zip(from_table, values):
+        np.testing.assert_array_equal(read, written)
+
+
+def test_single_row_wrdata(tmp_path):
+    fpath = tmp_path / 'dc.csv'
+    write_wrdata(str(fpath), np.array([0.0]), [np.array([-1e-3])])
+    vectors = NgSpiceWrapper.read_wrdata(str(fpath), 1)
+    np.testing.assert_array_equal(vectors[0], [-1e-3])
+
+
+def test_window_keeps_views_of_the_scale_range():
+    time = np.linspace(0, 1, 11)
+    vectors = Vectors(time, [time * 2, None], names=['v(out)', 'v(in)'])
+    window = vectors.window(0.25, 0.5)
+    np.testing.assert_array_equal(window.scale, time[3:6])
+    np.testing.assert_array_equal(window['v(out)'], time[3:6] * 2)
+    assert window[1] is None
+    assert np.shares_memory(window[0], vectors[0])
+
+
+def test_truncated_wrdata_is_a_parse_error(tmp_path):
+    env = CsAmpClass(num_process=1, design_netlist='./framework/netlist/cs_amp.cir')
+    freq = np.logspace(0, 10, 101)
+    write_wrdata(str(tmp_path / 'dc.csv'), np.array([0.0]), [np.array([-1e-3])])
+    assert env._translate_and_store({}, str(tmp_path), NgSpiceWrapper.INFO_OK) == (None, NgSpiceWrapper.INFO_MISSING)
+
+    write_wrdata(str(tmp_path / 'ac.csv'), freq, [np.abs(10 / (1 + 1j * freq / 1e6))])
+    specs, info = env._translate_and_store({}, str(tmp_path), NgSpiceWrapper.INFO_OK)
+    assert info == NgSpiceWrapper.INFO_OK
+    assert specs['gain'] == pytest.approx(10, rel=1e-6)
+    assert specs['bw'] == pytest.approx(1e6, rel=1e-3)
+
+    # the simulation was killed while writing the last line
+    content = (tmp_path / 'ac.csv').read_text()
+    (tmp_path / 'ac.csv').write_text(content[:content.rindex(' ')])
+    with pytest.raises(ValueError):
+        NgSpiceWrapper.read_wrdata(str(tmp_path / 'ac.csv'), 1)
+    assert env._translate_and_store({}, str(tmp_path), NgSpiceWrapper.INFO_OK) == \
+        (None, NgSpiceWrapper.INFO_PARSE_ERROR)
@@ -0,0 +1,281 @@
+"""
+The bookkeeping around the simulations: CostMemo eviction, SingleFlight coalescing and TestbenchScheduler ordering
+and error propagation. The testbenches are fakes that return their specs without a simulator.
+"""
+import threading
+import time
+
+import pytest
+
+from framework.wrapper.TwoStageComplete import EvaluationCore
+from framework.wrapper.evaluation_core import EvaluationCoreBase
+from framework.wrapper.executor import SimulationExecutor
+from framework.wrapper.memo import CostMemo
+from framework.wrapper.ngspice_wrapper import NgSpiceWrapper
+from framework.wrapper import scheduler as scheduling
+from framework.wrapper.single_flight import SingleFlight
+
+
+class FakeTestbench(object):
+    """
+    Looks like a wrapper to the scheduler: submit returns a future of (state, specs, info). specs are
+    dict(value=state['x']) with info, fail holds the states whose simulation fails (specs None with fail_info) and
+    raise_on the states whose simulation raises. Every submit is logged as (state x, name).
+    """
+
+    TRANSIENT_INFOS = NgSpiceWrapper.TRANSIENT_INFOS
+
+    def __init__(self, name, executor, log, delay=0.0, fail=(), raise_on=(), info=NgSpiceWrapper.INFO_OK,
+                 fail_info=NgSpiceWrapper.INFO_MISSING):
+        self.name = name
+        self.executor = executor
+        self.log = log
+        self.delay = delay
+        self.fail = set(fail)
+        self.raise_on = set(raise_on)
+        self.info = info
+        self.fail_info = fail_info
+        self.n_submitted = 0
+
+    def submit(self, state, verbose=False):
+        self.n_submitted += 1
+        self.log.append((state['x'], self.name))
+        return self.executor.submit(self.simulate, state)
+
+    def simulate(self, state):
+        time.sleep(self.delay)
+        if state['x'] in self.raise_on:
+            raise RuntimeError('simulation of %d raised' % state['x'])
+        if state['x'] in self.fail:
+            return state, None, self.fail_info
+        return state, dict(value=state['x']), self.info
+
+
+def reduce_specs(results, infos):
+    return {name: specs['value'] for name, specs in results.items() if specs is not None}, dict(infos)
+
+
+@pytest.fixture
+def executor():
+    executor = SimulationExecutor(num_workers=2)
+    yield executor
+    executor.shutdown()
+
+
+def test_memo_evicts_least_recently_used():
+    memo = CostMemo(max_entries=2)
+    memo.put((1,), dict(cost=1.0))
+    memo.put((2,), dict(cost=2.0))
+    assert memo.get((1,)) == dict(cost=1.0)
+    memo.put((3,), dict(cost=3.0))
+    # (2,) was used last before (1,) was looked up again
+    assert memo.get((2,)) is None
+    assert memo.get((1,)) == dict(cost=1.0)
+    assert memo.get((3,)) == dict(cost=3.0)
+    assert memo.stats()['evictions'] == 1
+    assert memo.stats()['hits'] == 3
+
+
+def test_memo_bounded_by_bytes():
+    row = dict(cost=1.0, spec=2.0)
+    memo = CostMemo(max_bytes=2 * CostMemo.row_size(row))
+    for key in range(5):
+        memo.put((key,), dict(row))
+    assert len(memo) == 2
+    assert memo.nbytes <= memo.max_bytes
+    assert (4,) in memo and (0,) not in memo
+    # replacing a row does not count its old size twice
+    memo.put((4,), dict(row))
+    assert memo.nbytes == 2 * CostMemo.row_size(row)
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 42
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do('key', work)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do('key', work))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    while flight.stats()['calls'] < 4:
+        time.sleep(0.01)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert results == [42] * 4
+    assert len(calls) == 1
+    assert flight.stats() == dict(calls=4, coalesced=3, in_flight=0)
+    # once resolved the key starts over
+    assert flight.do('key', lambda: 7) == 7
+
+
+def test_single_flight_propagates_errors_to_waiters():
+    flight = SingleFlight()
+    future, leader = flight.claim('key', n_callers=2)
+    waiter, waiter_leads = flight.claim('key')
+    assert leader and not waiter_leads and waiter is future
+    flight.resolve('key', future, exception=ValueError('failed'))
+    with pytest.raises(ValueError):
+        waiter.result(1)
+    assert flight.stats()['coalesced'] == 2
+    assert len(flight) == 0
+    with pytest.raises(ValueError):
+        flight.do('other', lambda: int('x'))
+    assert len(flight) == 0
+
+
+def test_scheduler_reduces_every_design(executor):
+    log = []
+    testbenches = dict(ac=FakeTestbench('ac', executor, log), tran=FakeTestbench('tran', executor, log, info=1))
+    states = [dict(x=i) for i in range(6)]
+    outputs = scheduling.TestbenchScheduler(executor).run(states, testbenches, reduce_specs)
+    assert outputs == [(dict(ac=i, tran=i), dict(ac=0, tran=1)) for i in range(6)]
+    assert sorted(log) == sorted((i, name) for i in range(6) for name in ('ac', 'tran'))
+
+
+def test_scheduler_finishes_designs_before_starting_new_ones(executor):
+    log = []
+    testbenches = dict(ac=FakeTestbench('ac', executor, log, delay=0.01),
+                       tran=FakeTestbench('tran', executor, log, delay=0.01))
+    states = [dict(x=i) for i in range(4)]
+    scheduler = scheduling.TestbenchScheduler(executor, max_in_flight=1)
+    order = [idx for idx, _ in scheduler.run_iter(states, testbenches, reduce_specs)]
+    # one task at a time, the design with the fewest outstanding simulations goes first
+    assert order == [0, 1, 2, 3]
+    assert log == [(i, name) for i in range(4) for name in ('ac', 'tran')]
+
+
+def test_scheduler_skips_the_testbenches_of_failed_designs(executor):
+    log = []
+    ac = FakeTestbench('ac', executor, log, fail=[1])
+    tran = FakeTestbench('tran', executor, log)
+    states = [dict(x=i) for i in range(3)]
+    scheduler = scheduling.TestbenchScheduler(executor, max_in_flight=1)
+    outputs = scheduler.run(states, dict(ac=ac, tran=tran), reduce_specs)
+    assert outputs[1] == (dict(), dict(ac=NgSpiceWrapper.INFO_MISSING))
+    assert outputs[0][0] == dict(ac=0, tran=0) and outputs[2][0] == dict(ac=2, tran=2)
+    assert (1, 'tran') not in log
+
+
+def test_scheduler_propagates_simulation_errors(executor):
+    log = []
+    testbenches = dict(ac=FakeTestbench('ac', executor, log, raise_on=[2]))
+    states = [dict(x=i) for i in range(4)]
+    with pytest.raises(RuntimeError, match='simulation of 2 raised'):
+        scheduling.TestbenchScheduler(executor, max_in_flight=1).run(states, testbenches, reduce_specs)
+
+
+def test_scheduler_speculates_stragglers(executor):
+    log = []
+
+    class Straggler(FakeTestbench):
+        def simulate(self, state):
+            # only the first copy of design 3 hangs
+            if state['x'] == 3 and self.n_submitted == 4:
+                time.sleep(2)
+            return FakeTestbench.simulate(self, state)
+
+    testbench = Straggler('tran', executor, log, delay=0.01)
+    scheduler = scheduling.TestbenchScheduler(executor, speculate_after=0.5, speculate_factor=2.0)
+    start = time.time()
+    outputs = scheduler.run([dict(x=i) for i in range(4)], dict(tran=testbench), reduce_specs)
+    assert [specs['tran'] for specs, _ in outputs] == [0, 1, 2, 3]
+    assert scheduler.n_speculated >= 1
+    assert time.time() - start < 2
+
+
+class FakeCore(EvaluationCoreBase):
+    result_keys = ('cost', 'value')
+
+    def __init__(self, cir_yaml, **testbench_kwargs):
+        EvaluationCoreBase.__init__(self, cir_yaml)
+        self.log = []
+        self.testbenches['tran'] = FakeTestbench('tran', self.executor, self.log, **testbench_kwargs)
+
+    def decode_batch(self, designs):
+        return [dict(x=design[0]) for design in designs]
+
+    def evaluate_design(self, results, verbose=False):
+        return dict(cost=0.0, value=results['tran']['value'])
+
+
+@pytest.fixture
+def core_yaml(tmp_path):
+    fpath = tmp_path / 'core.yaml'
+    fpath.write_text('num_process: 2\nmemo_entries: 100\n')
+    return str(fpath)
+
+
+def test_core_memo_hits_come_first_and_duplicates_run_once(core_yaml):
+    with FakeCore(core_yaml, delay=0.01) as core:
+        core.cost_fun_batch([[1], [2]])
+        order = [idx for idx, _ in core.cost_fun_iter([[3], [1], [3], [2]])]
+        assert order[:2] == [1, 3]
+        assert sorted(order) == [0, 1, 2, 3]
+        assert sorted(core.log) == [(1, 'tran'), (2, 'tran'), (3, 'tran')]
+        columns = core.cost_fun_batch([[3], [1]])
+        assert list(columns['value']) == [3, 1]
+        assert len(core.log) == 3
+
+
+def test_core_does_not_memoize_timeouts_and_errors(core_yaml):
+    with FakeCore(core_yaml, fail=[1], fail_info=NgSpiceWrapper.INFO_TIMEOUT) as core:
+        columns = core.cost_fun_batch([[1], [2]])
+        assert list(columns['cost']) == [core.failure_cost, 0.0]
+        core.cost_fun_batch([[1], [2]])
+        assert sorted(core.log) == [(1, 'tran'), (1, 'tran'), (2, 'tran')]
+        assert (1,) not in core.memo
+
+    # ngspice exited with an error but its outputs were parsed
+    with FakeCore(core_yaml, info=NgSpiceWrapper.INFO_ERROR) as core:
+        core.cost_fun_batch([[2]])
+        core.cost_fun_batch([[2]])
+        assert core.log == [(2, 'tran'), (2, 'tran')]
+        assert len(core.memo) == 0
+
+    with FakeCore(core_yaml, fail=[1]) as core:
+        # a failure that does not depend on the machine (here INFO_MISSING) is memoized like any result
+        core.cost_fun_batch([[1], [2]])
+        core.cost_fun_batch([[1], [2]])
+        assert sorted(core.log) == [(1, 'tran'), (2, 'tran')]
+
+
+def test_core_propagates_errors_to_concurrent_callers(core_yaml):
+    with FakeCore(core_yaml, delay=0.2, raise_on=[5]) as core:
+        errors = []
+
+        def evaluate():
+            try:
+                core.cost_fun_batch([[5]])
+            except RuntimeError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=evaluate) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        assert len(errors) == 3
+        # the design was simulated once, the other calls waited for it
+        assert core.log == [(5, 'tran')]
+        assert len(core.single_flight) == 0
+
+
+def test_undefined_phase_margin_is_a_failed_design():
+    results = dict(ol=dict(ugbw=1e7, gain=300.0, phm=float('nan'), Ibias=1e-4), cm=dict(cm_gain=0.01),
+                   ps=dict(ps_gain=0.01), tran=dict(tset=1e-8, offset=1e-4))
+    with EvaluationCore('./framework/yaml_files/two_stage_full.yaml') as core:
+        assert core.evaluate_design(results) == core.failure_row()
+        results['ol']['phm'] = 60.0
+        assert core.evaluate_design(results)['phm'] == 60.0
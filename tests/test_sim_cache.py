@@ -0,0 +1,153 @@
+"""
+Stability of the SimulationCache keys: the same simulation must map to the same key across wrapper instances,
+processes (pickles) and runs, and any change of its content must change the key.
+"""
+import pickle
+
+from framework.wrapper.DTSA import DTSAOverdriveRecovery
+from framework.wrapper.ngspice_wrapper import CsAmpClass, NgSpiceWrapper
+from framework.wrapper.sim_cache import SimulationCache, model_files
+
+NETLIST = './framework/netlist/cs_amp.cir'
+STATE = dict(vbias=0.9, rload=1000.0, mul=10)
+
+
+def make_env(**kwargs):
+    return CsAmpClass(num_process=1, design_netlist=NETLIST, **kwargs)
+
+
+def test_make_key_is_deterministic(tmp_path):
+    model = tmp_path / 'model.lib'
+    model.write_text('.model nch nmos level=1\n')
+    key = SimulationCache.make_key('V1 a 0 1\n', [str(model)], 'parser', simulator='ngspice-42')
+    assert key == SimulationCache.make_key('V1 a 0 1\n', [str(model)], 'parser', simulator='ngspice-42')
+    assert len(key) == 64
+
+
+def test_make_key_depends_on_every_input(tmp_path):
+    model = tmp_path / 'model.lib'
+    model.write_text('.model nch nmos level=1\n')
+    args = dict(netlist='V1 a 0 1\n', model_paths=[str(model)], parser='parser', simulator='ngspice-42')
+    key = SimulationCache.make_key(**args)
+    for name, value in (('netlist', 'V1 a 0 2\n'), ('parser', 'other'), ('simulator', 'ngspice-43'),
+                        ('model_paths', [])):
+        assert SimulationCache.make_key(**dict(args, **{name: value})) != key
+
+    # the content of the model files counts, not their path
+    model.write_text('.model nch nmos level=3\n')
+    assert SimulationCache.make_key(**args) != key
+
+
+def test_model_files_of_include_statements():
+    lines = ['.include "models/45nm.lib"\n', ".lib 'corner.lib' tt\n", '.inc plain.lib\n', 'R1 a b 1k\n']
+    assert model_files(lines, 'netlist') == ['netlist/models/45nm.lib', 'netlist/corner.lib', 'netlist/plain.lib']
+
+
+def test_wrapper_cache_key_is_stable():
+    env, other = make_env(), make_env(output_format='raw')
+    key = env.cache_key(STATE)
+    assert key == make_env().cache_key(dict(STATE))
+    # the key does not depend on the order of the parameters
+    assert key == env.cache_key(dict(reversed(list(STATE.items()))))
+    assert key == pickle.loads(pickle.dumps(env)).cache_key(STATE)
+    assert key != env.cache_key(dict(STATE, mul=11))
+    # raw outputs are parsed differently, they get keys of their own
+    assert key != other.cache_key(STATE)
+
+
+def test_wrapper_cache_key_depends_on_the_parser():
+    class OtherParser(CsAmpClass):
+        pass
+
+    env = make_env()
+    other = OtherParser(num_process=1, design_netlist=NETLIST)
+    assert env.cache_key(STATE) != other.cache_key(STATE)
+
+
+def test_cache_round_trip_and_counters(tmp_path):
+    cache = SimulationCache(str(tmp_path / 'cache.db'))
+    key = SimulationCache.make_key('netlist', simulator='ngspice-42')
+    assert cache.get(key) is None
+    cache.put(key, dict(gain=3.0), 0)
+    assert cache.get(key) == (dict(gain=3.0), 0)
+    cache.put('failed', None, 3)
+    assert cache.get('failed') == (None, 3)
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # the counters are per process, the pickle of a cache does not change with them
+    copy = pickle.loads(pickle.dumps(cache))
+    assert (copy.hits, copy.misses) == (0, 0)
+    assert copy.get(key) == (dict(gain=3.0), 0)
+    assert pickle.dumps(cache) == pickle.dumps(copy)
+
+
+def test_cache_keeps_waveforms(tmp_path):
+    cache = SimulationCache(str(tmp_path / 'cache.db'), store_waveforms=True)
+    output = tmp_path / 'ac.csv'
+    output.write_text('frequency v(out)\n1 2\n')
+    cache.put('key', dict(gain=2.0), 0, [str(output)])
+    restored = tmp_path / 'restored'
+    assert cache.get('key', str(restored)) == (dict(gain=2.0), 0)
+    assert (restored / 'ac.csv').read_text() == output.read_text()
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = SimulationCache(str(tmp_path / 'cache.db'))
+    for key in ('a', 'b', 'c'):
+        cache.put(key, dict(value=key), 0)
+    cache.get('a')
+    size = cache._connect().execute('SELECT size FROM results WHERE key = ?', ('a',)).fetchone()[0]
+    cache.max_bytes = 2 * size
+    cache.evict()
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+
+
+
+def test_wrapper_cache_key_depends_on_the_parser_settings():
+    def make_dtsa(**measure_params):
+        return DTSAOverdriveRecovery(num_process=1, design_netlist='./framework/netlist/dtsa.cir',
+                                     measure_params=dict(dict(t_prev=500e-12, t_sample=700e-12), **measure_params))
+
+    state = dict(m1=1, m2=1, m3=1, m4=1, m5=1, m6=1, m7=1)
+    key = make_dtsa().cache_key(state)
+    assert key == make_dtsa().cache_key(state)
+    # the sampling instants only matter to translate_result, the netlist is the same
+    other = make_dtsa(t_sample=800e-12)
+    assert other.template.render(state, '') == make_dtsa().template.render(state, '')
+    assert other.cache_key(state) != key
+    assert make_env(measure_params=dict(tot_err=0.01)).cache_key(STATE) != make_env().cache_key(STATE)
+
+
+def test_only_deterministic_results_are_cached(tmp_path):
+    cache = SimulationCache(str(tmp_path / 'cache.db'))
+    env = make_env(cache=cache)
+    folder = tmp_path / 'design'
+    folder.mkdir()
+
+    def store(state, info):
+        return env._translate_and_store(state, str(folder), info)[1]
+
+    def cached(state):
+        found = env.lookup(state)
+        return found[2] if found is not None else None
+
+    states = [dict(STATE, mul=mul) for mul in range(1, 7)]
+    # no outputs: a clean exit that did not write them is cached, a killed or crashed process is not
+    assert store(states[0], NgSpiceWrapper.INFO_OK) == NgSpiceWrapper.INFO_MISSING
+    assert store(states[1], NgSpiceWrapper.INFO_ERROR) == NgSpiceWrapper.INFO_MISSING
+    assert store(states[2], NgSpiceWrapper.INFO_TIMEOUT) == NgSpiceWrapper.INFO_TIMEOUT
+    assert cached(states[0]) == NgSpiceWrapper.INFO_MISSING
+    assert cached(states[1]) is None and cached(states[2]) is None
+
+    (folder / 'dc.csv').write_text('v-sweep i(vdd)\n0 -1e-3\n')
+    (folder / 'ac.csv').write_text('frequency vm(vd)\n1 10\n10 10\n100 1\n1000 0.1\n')
+    # outputs written before ngspice exited with an error are parsed but not cached
+    assert store(states[3], NgSpiceWrapper.INFO_ERROR) == NgSpiceWrapper.INFO_ERROR
+    assert cached(states[3]) is None
+    assert store(states[4], NgSpiceWrapper.INFO_OK) == NgSpiceWrapper.INFO_OK
+    assert cached(states[4]) == NgSpiceWrapper.INFO_OK
+
+    (folder / 'ac.csv').write_text('frequency vm(vd)\n1 10\n10\n')
+    assert store(states[5], NgSpiceWrapper.INFO_OK) == NgSpiceWrapper.INFO_PARSE_ERROR
+    assert cached(states[5]) == NgSpiceWrapper.INFO_PARSE_ERROR